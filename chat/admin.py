@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserSettings, AIEndpoint, AIModel, Folder, Chat, Message, SavedPrompt, Idea # Add SavedPrompt, Idea
+from .models import UserSettings, AIEndpoint, AIModel, Folder, Chat, Message, SavedPrompt, Idea, BatchJob # Add SavedPrompt, Idea
 
 class UserSettingsAdmin(admin.ModelAdmin):
     list_display = ('user', 'default_model', 'theme', 'system_prompt')
@@ -128,3 +128,11 @@ class IdeaAdmin(admin.ModelAdmin):
     # class Media:
     #     css = {'all': ('https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css',)}
 admin.site.register(Idea, IdeaAdmin)
+
+class BatchJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'kind', 'status', 'ai_model', 'succeeded_count', 'failed_count', 'created_at', 'completed_at')
+    search_fields = ('user__username', 'provider_batch_id')
+    list_filter = ('status', 'kind', 'user')
+    raw_id_fields = ('user', 'ai_model')
+    readonly_fields = ('provider_batch_id', 'provider_input_file_id', 'submitted_at', 'completed_at')
+admin.site.register(BatchJob, BatchJobAdmin)
@@ -1,22 +1,26 @@
 # chat/api_client.py
 import anthropic
-from anthropic import AsyncAnthropic
 import openai # Added
-from openai import OpenAI, AsyncOpenAI # Added
 from openai import APIError as OpenAIAPIError, AuthenticationError as OpenAIAuthenticationError, APIConnectionError as OpenAIAPIConnectionError, RateLimitError as OpenAIRateLimitError, APIStatusError as OpenAIAPIStatusError # Added
+import asyncio
+import hashlib
 import json
+import time
 from typing import Callable, Awaitable, Dict, Any, List
 import httpx
-from google import genai
+from django.conf import settings
 from google.genai import types
 
-http_client_without_ssl_verification = httpx.Client(verify=False)
-http_async_client_without_ssl_verification = httpx.AsyncClient(verify=False)
+from . import cassettes, completion_cache, endpoint_router, fake_provider, google_cache, provider_clients, rate_limiter, resilience, timeouts
 
 
 # Define a type for the message structure, common in chat APIs
 ChatMessage = Dict[str, str]  # e.g., {"role": "user", "content": "Hello"}
 
+# Providers spoken to through the OpenAI SDK and the Chat Completions wire format.
+# 'openai_compatible' endpoints (vLLM, llama.cpp, ...) differ only by their base URL.
+OPENAI_WIRE_PROVIDERS = ('openai', 'openai_compatible')
+
 # Standardized response format for static completion (as a comment for now)
 # {
 #   "id": "provider_message_id",
@@ -37,19 +41,64 @@ ChatMessage = Dict[str, str]  # e.g., {"role": "user", "content": "Hello"}
 # { "type": "error", "message": "API error details" }
 # // For full message metadata (if applicable, like Anthropic's message_start/message_stop)
 # { "type": "metadata", "data": { ... } }
+# // While waiting for the endpoint's rate limiter (see rate_limiter.py)
+# { "type": "queued", "position": 3 }
+
+
+def _build_anthropic_payload(ai_model_id: str, messages: List[ChatMessage], temperature: float, max_tokens: int, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds the Anthropic Messages API payload. A "system" role message in `messages`
+    is moved to the top-level 'system' parameter.
+    """
+    payload = {
+        "model": ai_model_id,
+        "messages": messages,
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+
+    system_prompt_message = next((msg for msg in messages if msg.get("role") == "system"), None)
+    if system_prompt_message:
+        payload["system"] = system_prompt_message["content"]
+        payload["messages"] = [msg for msg in messages if msg.get("role") != "system"]
+    elif "system" in kwargs: # Allow passing system prompt via kwargs as well
+        payload["system"] = kwargs.pop("system")
+
+    payload.update(kwargs)
+    return payload
+
+
+def _build_openai_stream_payload(ai_model_id: str, messages: List[ChatMessage], temperature: float, max_tokens: int, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the OpenAI Chat Completions payload for a streaming call."""
+    payload = {
+        "model": ai_model_id,
+        "messages": messages,
+        "stream": True,
+        # stream_options include_usage for getting usage data in the last chunk
+        "stream_options": {"include_usage": True}
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+
+    payload.update(kwargs)
+    return payload
 
 
-def _test_anthropic_internal(api_key: str) -> Dict[str, Any]:
+def _test_anthropic_internal(endpoint) -> Dict[str, Any]:
     """
     Synchronously tests an Anthropic API endpoint by making a minimal call.
     Args:
-        api_key: The API key.
+        endpoint: The AIEndpoint model instance.
     Returns:
         A dictionary with 'status', 'message', and 'details'.
     """
     try:
         # Base URL is handled by the SDK environment variables or defaults
-        client = anthropic.Anthropic(api_key=api_key, http_client=http_client_without_ssl_verification)
+        client = provider_clients.get_anthropic_client(endpoint)
         # A lightweight call, like listing models or a very short completion, can be used.
         # client.models.list() is a good option if available and doesn't consume significant resources.
         response = client.models.list(limit=1) # Limit to 1 to be minimal
@@ -72,20 +121,21 @@ def _test_anthropic_internal(api_key: str) -> Dict[str, Any]:
     except Exception as e: 
         return {"status": "error", "message": "An unexpected error occurred during the Anthropic test.", "details": {"error_type": type(e).__name__, "error_message": str(e)}}
 
-def _test_openai_internal(api_key: str) -> Dict[str, Any]:
+def _test_openai_internal(endpoint) -> Dict[str, Any]:
     """
     Synchronously tests an OpenAI API endpoint by making a minimal call.
     Args:
-        api_key: The API key.
+        endpoint: The AIEndpoint model instance.
     Returns:
         A dictionary with 'status', 'message', and 'details'.
     """
     try:
-        client = OpenAI(api_key=api_key, http_client=http_client_without_ssl_verification)
-        response = client.models.list(limit=1) # Limit to 1 to be minimal
+        client = provider_clients.get_openai_client(endpoint)
+        response = client.models.list() # The models endpoint takes no page size; the listing is small
         return {
             "status": "success",
-            "message": "OpenAI endpoint test successful!"
+            "message": "OpenAI endpoint test successful!" if endpoint.provider == 'openai' else f"Server at {provider_clients.endpoint_base_url(endpoint)} responded.",
+            "details": {"models": [model_obj.id for model_obj in response.data][:20]} if endpoint.provider != 'openai' else None,
         }
     except OpenAIAuthenticationError as e:
         return {"status": "error", "message": "Authentication failed. Check API key.", "details": {"error_type": type(e).__name__, "error_message": str(e), "status_code": e.status_code if hasattr(e, 'status_code') else None}}
@@ -100,16 +150,16 @@ def _test_openai_internal(api_key: str) -> Dict[str, Any]:
     except Exception as e: 
         return {"status": "error", "message": "An unexpected error occurred during the OpenAI test.", "details": {"error_type": type(e).__name__, "error_message": str(e)}}
 
-def _test_google_internal(api_key: str) -> Dict[str, Any]:
+def _test_google_internal(endpoint) -> Dict[str, Any]:
     """
     Synchronously tests a Google API endpoint by making a minimal call.
     Args:
-        api_key: The API key.
+        endpoint: The AIEndpoint model instance.
     Returns:
         A dictionary with 'status', 'message', and 'details'.
     """
     try:
-        client = genai.Client(api_key=api_key)
+        client = provider_clients.get_google_client(endpoint)
         response = client.models.list() # Limit to 1 to be minimal
         return {
             "status": "success",
@@ -118,56 +168,82 @@ def _test_google_internal(api_key: str) -> Dict[str, Any]:
     except Exception as e: 
         return {"status": "error", "message": "An unexpected error occurred during the Google test.", "details": {"error_type": type(e).__name__, "error_message": str(e)}}
 
-def get_models_from_anthropic(api_key: str) -> Dict[str, Any]:
+def _list_models_error(provider_label: str, e: Exception) -> Dict[str, Any]:
+    """Maps an SDK exception from a model listing call to the standard error result."""
+    details = {"error_type": type(e).__name__, "error_message": str(e)}
+    if isinstance(e, (anthropic.AuthenticationError, OpenAIAuthenticationError)):
+        return {"status": "error", "message": "Authentication failed. Check API key.", "details": {**details, "status_code": e.status_code}, "models": []}
+    if isinstance(e, (anthropic.APIConnectionError, OpenAIAPIConnectionError)):
+        return {"status": "error", "message": "Connection error. Check API URL or network.", "details": details, "models": []}
+    if isinstance(e, (anthropic.RateLimitError, OpenAIRateLimitError)):
+        return {"status": "error", "message": "Rate limit exceeded.", "details": {**details, "status_code": e.status_code}, "models": []}
+    if isinstance(e, (anthropic.APIStatusError, OpenAIAPIStatusError)):
+        return {"status": "error", "message": f"API error (status {e.status_code}).", "details": {"error_type": type(e).__name__, "error_message": str(e.response.text if e.response else e), "status_code": e.status_code}, "models": []}
+    if isinstance(e, (anthropic.APIError, OpenAIAPIError)):
+        return {"status": "error", "message": f"An {provider_label} API error occurred.", "details": details, "models": []}
+    return {"status": "error", "message": f"An unexpected error occurred while fetching {provider_label} models.", "details": details, "models": []}
+
+
+async def get_models_from_anthropic(endpoint) -> Dict[str, Any]:
     """
-    Fetches a list of models from the Anthropic API.
+    Fetches the list of models from the Anthropic API.
     Args:
-        api_key: The Anthropic API key.
+        endpoint: The AIEndpoint model instance (Anthropic provider).
     Returns:
         A dictionary with 'status', 'models' (list of model dicts), or 'message' and 'details' on error.
         Each model dict in 'models' will have 'id' and 'name'.
     """
     try:
-        client = anthropic.Anthropic(api_key=api_key, http_client=http_client_without_ssl_verification)
-        # The SDK's models.list() returns a Page of Model objects.
-        # Each Model object has attributes like 'id', 'name', 'developer', etc.
-        # We are interested in 'id' and 'name'.
-        api_response = client.models.list() 
-        
+        client = provider_clients.get_async_anthropic_client(endpoint)
         models_data = []
-        for model_obj in api_response.data: # Iterate through the data attribute of the Page
-            # Assuming model_obj has 'id' and 'name' attributes based on typical SDK behavior.
-            # Adjust if the actual attributes are different (e.g., model_obj.id, model_obj.name).
-            # Based on Anthropic SDK, it should be model_obj.id and model_obj.name
-            # Correcting based on AttributeError: 'ModelInfo' object has no attribute 'name'
-            # Using model_obj.id for both 'id' and 'name' for now.
-            models_data.append({
-                "id": model_obj.id,
-                "name": model_obj.display_name # Use id as name if a separate name attribute is not available
-                # Potentially add other fields if available and useful, e.g., context_length
-                # "context_length": getattr(model_obj, 'context_length', None) 
-            })
-        
-        return {
-            "status": "success",
-            "models": models_data
-        }
-    except anthropic.AuthenticationError as e:
-        return {"status": "error", "message": "Authentication failed. Check API key.", "details": {"error_type": type(e).__name__, "error_message": str(e), "status_code": e.status_code if hasattr(e, 'status_code') else None}, "models": []}
-    except anthropic.APIConnectionError as e:
-        return {"status": "error", "message": "Connection error. Check API URL or network.", "details": {"error_type": type(e).__name__, "error_message": str(e)}, "models": []}
-    except anthropic.RateLimitError as e:
-        return {"status": "error", "message": "Rate limit exceeded.", "details": {"error_type": type(e).__name__, "error_message": str(e), "status_code": e.status_code if hasattr(e, 'status_code') else None}, "models": []}
-    except anthropic.APIStatusError as e: 
-        return {"status": "error", "message": f"API error (status {e.status_code}).", "details": {"error_type": type(e).__name__, "error_message": str(e.response.text if e.response else e), "status_code": e.status_code}, "models": []}
-    except anthropic.APIError as e: 
-        return {"status": "error", "message": "An Anthropic API error occurred.", "details": {"error_type": type(e).__name__, "error_message": str(e)}, "models": []}
-    except Exception as e: 
-        return {"status": "error", "message": "An unexpected error occurred while fetching Anthropic models.", "details": {"error_type": type(e).__name__, "error_message": str(e)}, "models": []}
+        # The async paginator follows next pages on its own
+        async for model_obj in client.models.list(limit=100):
+            # ModelInfo has no 'name'; display_name is the human-readable one
+            models_data.append({"id": model_obj.id, "name": model_obj.display_name or model_obj.id})
+        return {"status": "success", "models": models_data}
+    except Exception as e:
+        return _list_models_error("Anthropic", e)
+
+
+async def get_models_from_openai(endpoint) -> Dict[str, Any]:
+    """
+    Fetches the list of models from the OpenAI API, or from /v1/models of an
+    OpenAI-compatible server. Neither has display names, so the model id doubles
+    as the name.
+    """
+    try:
+        client = provider_clients.get_async_openai_client(endpoint)
+        models_data = []
+        async for model_obj in client.models.list():
+            models_data.append({"id": model_obj.id, "name": model_obj.id})
+        models_data.sort(key=lambda m: m["id"])
+        return {"status": "success", "models": models_data}
+    except Exception as e:
+        return _list_models_error("OpenAI" if endpoint.provider == 'openai' else provider_clients.endpoint_base_url(endpoint), e)
+
+
+async def get_models_from_google(endpoint) -> Dict[str, Any]:
+    """
+    Fetches the list of models from the Google Gemini API, keeping only those that
+    support generateContent (embedding-only models cannot be chatted with).
+    """
+    try:
+        client = provider_clients.get_google_client(endpoint)
+        models_data = []
+        async for model_obj in await client.aio.models.list(config={"page_size": 100}):
+            if model_obj.supported_actions and "generateContent" not in model_obj.supported_actions:
+                continue
+            model_id = model_obj.name.removeprefix("models/") # API names look like 'models/gemini-1.5-pro'
+            models_data.append({"id": model_id, "name": model_obj.display_name or model_id})
+        return {"status": "success", "models": models_data}
+    except Exception as e:
+        return _list_models_error("Google", e)
 
-def get_models_from_provider(endpoint) -> Dict[str, Any]: # endpoint is an AIEndpoint model instance
+
+async def get_models_from_provider(endpoint) -> Dict[str, Any]: # endpoint is an AIEndpoint model instance
     """
     Fetches models from the API provider based on the endpoint's configuration.
+    Callers normally go through model_catalog.py, which caches the result.
     Args:
         endpoint: The AIEndpoint model instance.
     Returns:
@@ -177,10 +253,15 @@ def get_models_from_provider(endpoint) -> Dict[str, Any]: # endpoint is an AIEnd
         return {"status": "error", "message": "API key is missing for this endpoint.", "models": []}
 
     if endpoint.provider == 'anthropic':
-        return get_models_from_anthropic(api_key=endpoint.apikey)
-    # Add elif for 'openai', 'google' etc. when implemented
-    # elif endpoint.provider == 'openai':
-    #     return get_models_from_openai(api_key=endpoint.apikey) 
+        return await get_models_from_anthropic(endpoint)
+    elif endpoint.provider in OPENAI_WIRE_PROVIDERS:
+        return await get_models_from_openai(endpoint)
+    elif endpoint.provider == 'google':
+        return await get_models_from_google(endpoint)
+    elif endpoint.provider == 'fake':
+        return fake_provider.list_models()
+    elif endpoint.provider == 'replay':
+        return cassettes.list_models(endpoint)
     else:
         return {"status": "error", "message": f"Model fetching not implemented for provider: {endpoint.provider}", "models": []}
 
@@ -196,50 +277,92 @@ def test_endpoint(endpoint) -> Dict[str, Any]: # endpoint is an AIEndpoint model
         return {"status": "error", "message": "API key is missing for this endpoint.", "details": None}
 
     if endpoint.provider == 'anthropic':
-        return _test_anthropic_internal(api_key=endpoint.apikey)
-    elif endpoint.provider == 'openai':
-        return _test_openai_internal(api_key=endpoint.apikey)
+        return _test_anthropic_internal(endpoint)
+    elif endpoint.provider in OPENAI_WIRE_PROVIDERS:
+        return _test_openai_internal(endpoint)
     elif endpoint.provider == 'google':
-        return _test_google_internal(api_key=endpoint.apikey)
+        return _test_google_internal(endpoint)
+    elif endpoint.provider == 'fake':
+        return fake_provider.test_endpoint(endpoint)
+    elif endpoint.provider == 'replay':
+        return cassettes.test_endpoint(endpoint)
     else:
         return {"status": "error", "message": f"Testing not implemented for provider: {endpoint.provider}", "details": None}
 
 
+# Rate-limit headers exposed by the providers on every response
+RATE_LIMIT_REMAINING_HEADERS = {
+    "anthropic": ("anthropic-ratelimit-requests-remaining", "anthropic-ratelimit-tokens-remaining"),
+    "openai": ("x-ratelimit-remaining-requests", "x-ratelimit-remaining-tokens"),
+}
+
+
+async def probe_endpoint(endpoint) -> Dict[str, Any]:
+    """
+    Cheap asynchronous health probe of an endpoint (a one-item model listing).
+    Used by the background prober in health.py.
+    Returns:
+        A dictionary with 'ok', 'latency' (seconds), 'status_code', 'throttled',
+        'requests_remaining', 'tokens_remaining' and 'message'.
+    """
+    result = {"ok": False, "latency": None, "status_code": None, "throttled": False, "requests_remaining": None, "tokens_remaining": None, "message": None}
+    if endpoint.provider == 'fake':
+        return await fake_provider.probe(endpoint)
+    if endpoint.provider == 'replay':
+        return {**result, "ok": True, "latency": 0.0, "status_code": 200} # Local files; nothing to probe
+    started_at = time.monotonic()
+    try:
+        headers = None
+        if endpoint.provider == 'anthropic':
+            raw = await provider_clients.get_async_anthropic_client(endpoint).models.with_raw_response.list(limit=1)
+            headers = raw.headers
+        elif endpoint.provider in OPENAI_WIRE_PROVIDERS:
+            raw = await provider_clients.get_async_openai_client(endpoint).models.with_raw_response.list()
+            headers = raw.headers
+        elif endpoint.provider == 'google':
+            await provider_clients.get_google_client(endpoint).aio.models.list(config={"page_size": 1})
+        else:
+            result["message"] = f"Probing not implemented for provider: {endpoint.provider}"
+            return result
+        result["ok"] = True
+        result["status_code"] = 200
+        if headers is not None:
+            # Local servers usually send no rate-limit headers; read OpenAI's names in case a proxy does
+            requests_header, tokens_header = RATE_LIMIT_REMAINING_HEADERS.get(endpoint.provider, RATE_LIMIT_REMAINING_HEADERS["openai"])
+            for key, header in (("requests_remaining", requests_header), ("tokens_remaining", tokens_header)):
+                try:
+                    result[key] = int(headers.get(header)) if headers.get(header) is not None else None
+                except ValueError:
+                    pass
+            result["throttled"] = result["requests_remaining"] == 0 or result["tokens_remaining"] == 0
+    except Exception as e:
+        details = resilience.error_details(e)
+        result["status_code"] = details.get("status_code")
+        result["throttled"] = details.get("status_code") == 429
+        result["message"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["latency"] = time.monotonic() - started_at
+    return result
+
+
 async def _get_static_completion_anthropic_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List[ChatMessage],
     temperature: float = None,
     max_tokens: int = None,
     **kwargs: Any
 ) -> Dict[str, Any]:
     """
-    Makes a static (non-streaming) API call to an Anthropic model.
+    Makes a static (non-streaming) API call to an Anthropic model without blocking the event loop.
     Returns a standardized dictionary.
     """
     try:
         # Base URL is handled by the SDK environment variables or defaults
-        client = anthropic.Anthropic(api_key=api_key, http_client=http_client_without_ssl_verification)
-        
-        payload = {
-            "model": ai_model_id,
-            "messages": messages,
-        }
-        if temperature is not None:
-            payload["temperature"] = temperature
-        if max_tokens is not None:
-            payload["max_tokens"] = max_tokens
-        
-        system_prompt_message = next((msg for msg in messages if msg.get("role") == "system"), None)
-        if system_prompt_message:
-            payload["system"] = system_prompt_message["content"]
-            payload["messages"] = [msg for msg in messages if msg.get("role") != "system"]
-        elif "system" in kwargs: # Allow passing system prompt via kwargs as well
-            payload["system"] = kwargs.pop("system")
-
-        payload.update(kwargs)
+        client = provider_clients.get_async_anthropic_client(endpoint)
+        payload = _build_anthropic_payload(ai_model_id, messages, temperature, max_tokens, kwargs)
         
-        api_response = client.messages.create(**payload)
+        api_response = await client.messages.create(**payload)
         
         # Normalize to standard format
         # For Anthropic, content is a list of blocks. We'll concatenate text blocks.
@@ -255,51 +378,45 @@ async def _get_static_completion_anthropic_internal(
             "role": api_response.role, # Should be 'assistant'
             "model_used": api_response.model,
             "stop_reason": api_response.stop_reason,
-            "usage": {"input_tokens": api_response.usage.input_tokens, "output_tokens": api_response.usage.output_tokens},
+            "usage": {
+                "input_tokens": api_response.usage.input_tokens,
+                "output_tokens": api_response.usage.output_tokens,
+                "cache_creation_input_tokens": getattr(api_response.usage, "cache_creation_input_tokens", None),
+                "cache_read_input_tokens": getattr(api_response.usage, "cache_read_input_tokens", None),
+            },
             "error": None
         }
     except anthropic.APIStatusError as e:
-        error_payload = {"type": type(e).__name__, "message": str(e.response.text if e.response else e), "status_code": e.status_code}
+        error_payload = {"type": type(e).__name__, "message": str(e.response.text if e.response else e), **resilience.error_details(e)}
         print(f"Anthropic API Error (Static): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
     except anthropic.APIConnectionError as e:
-        error_payload = {"type": type(e).__name__, "message": str(e)}
+        error_payload = {"type": type(e).__name__, "message": str(e), **resilience.error_details(e)}
         print(f"Anthropic Connection Error (Static): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
     except Exception as e: # Catch any other unexpected errors
-        error_payload = {"type": type(e).__name__, "message": str(e)}
+        error_payload = {"type": type(e).__name__, "message": str(e), **resilience.error_details(e)}
         print(f"Unexpected Error (Static Anthropic): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
 
 
 async def _get_static_completion_google_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List,
     temperature: float = None,
     max_tokens: int = None,
     **kwargs: Any
 ) -> Dict[str, Any]:
     """
-    Makes a static (non-streaming) API call to an Anthropic model.
+    Makes a static (non-streaming) API call to a Google model without blocking the event loop.
     Returns a standardized dictionary.
     """
     try:
         # Base URL is handled by the SDK environment variables or defaults
-        client = genai.Client(api_key=api_key)
-        contents = []
-        system_prompt_message = None
-
-        for msg in messages:
-            if msg.get('role') == "system":
-                system_prompt_message = msg.get('content')
-                continue
-            contents.append(
-                types.Content(
-                    role=msg.get('role'),
-                    parts=[types.Part.from_text(text=msg.get('content'))],
-                )
-            )
+        client = provider_clients.get_google_client(endpoint)
+        system_prompt_message, items = _google_items(messages)
+        contents = [google_cache.to_content(item) for item in items]
 
         generate_content_config = types.GenerateContentConfig(
             temperature=temperature,
@@ -308,7 +425,7 @@ async def _get_static_completion_google_internal(
             max_output_tokens=max_tokens,
         )
 
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model=ai_model_id,
             contents=contents,
             config=generate_content_config,
@@ -324,7 +441,7 @@ async def _get_static_completion_google_internal(
             "error": None
         }
     except Exception as e: # Catch any other unexpected errors
-        error_payload = {"type": type(e).__name__, "message": str(e)}
+        error_payload = {"type": type(e).__name__, "message": str(e), **resilience.error_details(e)}
         print(f"Unexpected Error (Static Google): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
 
@@ -335,10 +452,15 @@ async def get_static_completion(
     messages: List[ChatMessage],
     temperature: float = None,
     max_tokens: int = None,
+    use_cache: bool = False,
     **kwargs: Any
 ) -> Dict[str, Any]:
     """
     Public function for static completion. Dispatches to provider-specific implementation.
+    Transient failures are retried with backoff; requests fail fast while the endpoint's
+    circuit breaker is open (see resilience.py), and wait for its rate limiter (see rate_limiter.py).
+    With use_cache=True, identical requests are answered from the completion cache and
+    concurrent ones share a single upstream call (see completion_cache.py).
     """
     if not model.endpoint or not model.endpoint.apikey:
         return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None, "error": {"type": "ConfigurationError", "message": "Endpoint or API key is missing."}}
@@ -347,40 +469,178 @@ async def get_static_completion(
     effective_temperature = temperature if temperature is not None else model.default_temperature
     effective_max_tokens = max_tokens if max_tokens is not None else model.default_max_tokens
 
+    if use_cache:
+        key = completion_cache.make_key(model, messages, effective_temperature, effective_max_tokens, kwargs)
+        return await completion_cache.get_or_compute(
+            key, lambda: _static_completion_with_retries(model, messages, effective_temperature, effective_max_tokens, **kwargs)
+        )
+    return await _static_completion_with_retries(model, messages, effective_temperature, effective_max_tokens, **kwargs)
+
+
+async def _static_completion_with_retries(
+    model, # AIModel instance
+    messages: List[ChatMessage],
+    temperature: float,
+    max_tokens: int,
+    **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Runs a static completion against the model's endpoint, retrying transient errors.
+    """
+    endpoint = model.endpoint
+    breaker = resilience.get_breaker(endpoint)
+    attempt = 0
+    while True:
+        if not breaker.allow_request():
+            resilience.record(endpoint, 'short_circuited')
+            return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None, "error": {"type": "CircuitOpenError", **resilience.circuit_open_error(endpoint)}}
+
+        resilience.record(endpoint, 'requests')
+        is_trial = breaker.holds_trial()
+        response = None
+        try:
+            permit = await rate_limiter.acquire(endpoint, rate_limiter.estimate_input_tokens(messages, kwargs.get("system")))
+            try:
+                response = await timeouts.run_static_attempt(
+                    model, lambda: _dispatch_static_completion(model, messages, temperature, max_tokens, **kwargs)
+                )
+            finally:
+                error = (response or {}).get("error") or {}
+                usage = (response or {}).get("usage") or {}
+                rate_limiter.release(
+                    permit,
+                    throttled=error.get("status_code") == 429,
+                    retry_after=error.get("retry_after"),
+                    actual_tokens=usage.get("input_tokens"), # The TPM limit counts input tokens only
+                )
+        except BaseException:
+            # Cancelled or raised: no outcome to judge the endpoint by
+            if is_trial:
+                breaker.abandon_trial()
+            raise
+        if not error:
+            breaker.record_success()
+            return response
+
+        if resilience.counts_against_breaker(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success() # The provider answered; the request itself was bad or throttled
+
+        delay = None
+        if error.get("retryable") and attempt < resilience.max_retries():
+            delay = resilience.backoff_delay(attempt, error.get("retry_after"))
+        if delay is None:
+            resilience.record(endpoint, 'failures')
+            return response
+
+        resilience.record(endpoint, 'retries')
+        print(f"Retrying static completion on endpoint {endpoint.id} in {delay:.2f}s (attempt {attempt + 1}): {error.get('message')}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def prime_prompt_cache(
+    model, # AIModel instance (Anthropic)
+    messages: List[ChatMessage],
+) -> Dict[str, Any]:
+    """
+    Sends a minimal Anthropic request (one output token) so that the cache breakpoints in
+    `messages` write their prefixes to the provider's prompt cache (see cache_prewarm.py).
+    Goes through the endpoint's circuit breaker, rate limiter and timeout budgets, but is
+    never retried: a failed priming only means the next send is not a cache read.
+    Returns:
+        A standardized static completion dictionary.
+    """
+    endpoint = model.endpoint
+    if not endpoint or not endpoint.apikey:
+        return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None, "error": {"type": "ConfigurationError", "message": "Endpoint or API key is missing."}}
+    breaker = resilience.get_breaker(endpoint)
+    if not breaker.allow_request():
+        resilience.record(endpoint, 'short_circuited')
+        return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None, "error": {"type": "CircuitOpenError", **resilience.circuit_open_error(endpoint)}}
+
+    resilience.record(endpoint, 'requests')
+    is_trial = breaker.holds_trial()
+    response = None
+    try:
+        permit = await rate_limiter.acquire(endpoint, rate_limiter.estimate_input_tokens(messages))
+        try:
+            response = await timeouts.run_static_attempt(
+                model, lambda: _get_static_completion_anthropic_internal(model.model_id, endpoint, messages, temperature=None, max_tokens=1)
+            )
+        finally:
+            error = (response or {}).get("error") or {}
+            usage = (response or {}).get("usage") or {}
+            rate_limiter.release(
+                permit,
+                throttled=error.get("status_code") == 429,
+                retry_after=error.get("retry_after"),
+                # The TPM limit counts input tokens only; the prefix written to the cache is input too
+                actual_tokens=(usage.get("input_tokens") or 0) + (usage.get("cache_creation_input_tokens") or 0) if usage.get("input_tokens") is not None else None,
+            )
+    except BaseException:
+        # Cancelled or raised: no outcome to judge the endpoint by
+        if is_trial:
+            breaker.abandon_trial()
+        raise
+    if resilience.counts_against_breaker(error):
+        breaker.record_failure()
+    else:
+        breaker.record_success() # Succeeded, or the provider answered and the request itself was refused
+    if error:
+        resilience.record(endpoint, 'failures')
+    return response
+
+
+async def _dispatch_static_completion(
+    model, # AIModel instance
+    messages: List[ChatMessage],
+    temperature: float,
+    max_tokens: int,
+    **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Makes a single static completion attempt against the model's provider.
+    """
     if model.endpoint.provider == 'anthropic':
         return await _get_static_completion_anthropic_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
-    elif model.endpoint.provider == 'openai':
+    elif model.endpoint.provider in OPENAI_WIRE_PROVIDERS:
         return await _get_static_completion_openai_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
     elif model.endpoint.provider == 'google':
         return await _get_static_completion_google_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
+    elif model.endpoint.provider == 'fake':
+        return await fake_provider.get_static_completion(model.endpoint, model.model_id, messages, max_tokens=max_tokens, system=kwargs.get("system"))
+    elif model.endpoint.provider == 'replay':
+        return await cassettes.replay_static(model.endpoint, model.model_id, messages, system=kwargs.get("system"))
     else:
         return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None, "error": {"type": "UnsupportedProviderError", "message": f"Static completion not implemented for provider: {model.endpoint.provider}"}}
 
 
 async def _stream_completion_anthropic_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List[ChatMessage],
     on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]], # Callback expects standardized chunk
     temperature: float = None,
@@ -392,25 +652,8 @@ async def _stream_completion_anthropic_internal(
     """
     try:
         # Base URL is handled by the SDK environment variables or defaults
-        client = AsyncAnthropic(api_key=api_key, http_client=http_async_client_without_ssl_verification)
-        
-        payload = {
-            "model": ai_model_id,
-            "messages": messages,
-        }
-        if temperature is not None:
-            payload["temperature"] = temperature
-        if max_tokens is not None:
-            payload["max_tokens"] = max_tokens
-
-        system_prompt_message = next((msg for msg in messages if msg.get("role") == "system"), None)
-        if system_prompt_message:
-            payload["system"] = system_prompt_message["content"]
-            payload["messages"] = [msg for msg in messages if msg.get("role") != "system"]
-        elif "system" in kwargs:
-            payload["system"] = kwargs.pop("system")
-            
-        payload.update(kwargs)
+        client = provider_clients.get_async_anthropic_client(endpoint)
+        payload = _build_anthropic_payload(ai_model_id, messages, temperature, max_tokens, kwargs)
 
         async with client.messages.stream(**payload) as stream:
             async for event in stream:
@@ -454,13 +697,13 @@ async def _stream_completion_anthropic_internal(
                     await on_chunk_callback(standardized_chunk)
 
     except anthropic.APIStatusError as e:
-        error_detail = {"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}"}
+        error_detail = {"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
     except anthropic.APIConnectionError as e:
-        error_detail = {"type": "error", "message": f"Connection Error: {str(e)}"}
+        error_detail = {"type": "error", "message": f"Connection Error: {str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
     except Exception as e:
-        error_detail = {"type": "error", "message": f"Unexpected error during Anthropic stream: {str(e)}"}
+        error_detail = {"type": "error", "message": f"Unexpected error during Anthropic stream: {str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
 
 
@@ -468,7 +711,7 @@ async def _stream_completion_anthropic_internal(
 
 async def _stream_completion_google_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List[ChatMessage],
     on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]], # Callback expects standardized chunk
     temperature: float = None,
@@ -476,92 +719,103 @@ async def _stream_completion_google_internal(
     **kwargs: Any
 ):
     """
-    Makes a streaming API call to an Anthropic model and invokes a callback with standardized chunks.
+    Makes a streaming API call to a Google model and invokes a callback with standardized chunks.
+    The stable prefix of the history is served from a provider-side context cache when one
+    exists (see google_cache.py); cached tokens are reported as cache_read_input_tokens.
     """
+    system_text, items = _google_items(messages)
+    handle = None
+    if google_cache.enabled():
+        handle = google_cache.lookup(endpoint, ai_model_id, system_text, items)
+        google_cache.schedule_refresh(endpoint, ai_model_id, system_text, items, handle)
+
+    state = {"delivered": False}
     try:
-        client = genai.Client(api_key=api_key)
-        contents = []
-        system_prompt_message = None
+        await _stream_google_attempt(ai_model_id, endpoint, system_text, items, handle, on_chunk_callback, temperature, max_tokens, state)
+        return
+    except Exception as e:
+        if handle is None or state["delivered"]:
+            error_detail = {"type": "error", "message": f"Unexpected error during Google stream: {str(e)}", **resilience.error_details(e)}
+            await on_chunk_callback(error_detail)
+            return
+        # The cache may have been deleted or expired provider-side; retry with the full history
+        print(f"Google stream with context cache {handle.name} failed ({type(e).__name__} {e}); retrying uncached")
+        google_cache.invalidate(endpoint, ai_model_id, system_text, items, handle)
+    try:
+        await _stream_google_attempt(ai_model_id, endpoint, system_text, items, None, on_chunk_callback, temperature, max_tokens, state)
+    except Exception as e:
+        error_detail = {"type": "error", "message": f"Unexpected error during Google stream: {str(e)}", **resilience.error_details(e)}
+        await on_chunk_callback(error_detail)
 
-        for msg in messages:
-            if msg.get('role') == "system":
-                system_prompt_message = msg.get('content')
-                continue
-            contents.append(
-                types.Content(
-                    role=msg.get('role'),
-                    parts=[types.Part.from_text(text=msg.get('content'))],
-                )
-            )
 
-        payload = {
-            'model': ai_model_id,
-            'contents': contents,
-            'config': {
-                'temperature': temperature,
-                'response_mime_type': 'text/plain',
-                'system_instruction': system_prompt_message,
-                'max_output_tokens': max_tokens,
-            }
-        }
+def _google_items(messages: List[ChatMessage]):
+    """
+    Splits messages into the system instruction and (role, text) items in Gemini's roles.
+    Content given as a list of blocks (as the chat consumer sends it) is flattened to text.
+    """
+    system_text = None
+    items = []
+    for msg in messages:
+        content = msg.get('content')
+        if isinstance(content, list):
+            content = "".join(block.get("text", "") for block in content if isinstance(block, dict))
+        if msg.get('role') == "system":
+            system_text = content
+            continue
+        items.append({"role": "model" if msg.get('role') == "assistant" else msg.get('role'), "text": content or ""})
+    return system_text, items
 
-        # payload = {
-        #     "model": ai_model_id,
-        #     "messages": messages,
-        # }
-        # if temperature is not None:
-        #     payload["temperature"] = temperature
-        # if max_tokens is not None:
-        #     payload["max_tokens"] = max_tokens
-
-        # system_prompt_message = next((msg for msg in messages if msg.get("role") == "system"), None)
-        # if system_prompt_message:
-        #     payload["system"] = system_prompt_message["content"]
-        #     payload["messages"] = [msg for msg in messages if msg.get("role") != "system"]
-        # elif "system" in kwargs:
-        #     payload["system"] = kwargs.pop("system")
-            
-        # payload.update(kwargs)
-
-        async for chunk in await client.aio.models.generate_content_stream(**payload):
-            # async for event in chunk:
-                if not chunk.candidates[0].finish_reason:
-                    standardized_chunk = {"type": "delta", "text_delta": chunk.text}
-                else:
-                    standardized_chunk = {
-                        "text_delta": chunk.text,
-                        "type": "stop", 
-                        "stop_reason": chunk.candidates[0].finish_reason
-                    }
-                # if event.type == "message_start":
-                #     standardized_chunk = {
-                #         "type": "metadata", 
-                #         "data": {
-                #             "id": event.message.id,
-                #             "input_tokens": event.message.usage.input_tokens
-                #         }
-                #     }
-                # elif event.type == "content_block_delta":
-                #     if event.delta.type == "text_delta" and event.delta.text:
-                #         standardized_chunk = {"type": "delta", "text_delta": event.delta.text}
-                # elif event.type == "message_delta": # Anthropic sends this for stop_reason and output_tokens
-                #     standardized_chunk = {
-                #         "type": "stop", 
-                #         "stop_reason": event.delta.stop_reason,
-                #         "usage": {"output_tokens": event.usage.output_tokens}
-                #     }
-                # elif event.type == "message_stop":
-                #     # This is a final confirmation, often doesn't carry new data beyond what message_delta provided.
-                #     # We can choose to send a specific "final_stop" or rely on message_delta's stop.
-                #     # For simplicity, we can ignore this if message_delta already signals stop.
-                #     # If message_delta didn't have usage, this might be a place to confirm it.
-                #     pass # Already handled by message_delta for stop_reason and usage
 
-                if standardized_chunk:
-                    await on_chunk_callback(standardized_chunk)
-    except Exception as e:
-        error_detail = {"type": "error", "message": f"Unexpected error during Google stream: {str(e)}"}
-        await on_chunk_callback(error_detail)
+async def _stream_google_attempt(ai_model_id, endpoint, system_text, items, handle, on_chunk_callback, temperature, max_tokens, state):
+    client = provider_clients.get_google_client(endpoint)
+    config = {
+        'temperature': temperature,
+        'response_mime_type': 'text/plain',
+        'max_output_tokens': max_tokens,
+    }
+    if handle is not None:
+        config['cached_content'] = handle.name # The cache holds the system instruction and the prefix
+        uncached_items = items[handle.prefix_len:]
+    else:
+        config['system_instruction'] = system_text
+        uncached_items = items
+    payload = {
+        'model': ai_model_id,
+        'contents': [google_cache.to_content(item) for item in uncached_items],
+        'config': config,
+    }
+
+    stream = await client.aio.models.generate_content_stream(**payload)
+    try:
+        await _consume_google_stream(stream, on_chunk_callback, state)
+    finally:
+        # On cancellation, close the generator now so the HTTP response is released right away, not at GC
+        await stream.aclose()
+
+
+async def _consume_google_stream(stream, on_chunk_callback, state):
+    async for chunk in stream:
+        if not chunk.candidates or not chunk.candidates[0].finish_reason:
+            standardized_chunk = {"type": "delta", "text_delta": chunk.text or ""}
+        else:
+            usage = chunk.usage_metadata
+            if usage is not None and usage.prompt_token_count is not None:
+                # prompt_token_count includes cached tokens; report them separately like Anthropic does
+                cached_tokens = usage.cached_content_token_count or 0
+                await on_chunk_callback({"type": "metadata", "data": {
+                    "id": chunk.response_id,
+                    "input_tokens": usage.prompt_token_count - cached_tokens,
+                    "cache_read_input_tokens": cached_tokens,
+                }})
+            standardized_chunk = {
+                "text_delta": chunk.text or "",
+                "type": "stop",
+                "stop_reason": chunk.candidates[0].finish_reason,
+                "usage": {"output_tokens": usage.candidates_token_count if usage is not None else None},
+            }
+        if standardized_chunk.get("text_delta") or standardized_chunk["type"] == "stop":
+            state["delivered"] = True
+            await on_chunk_callback(standardized_chunk)
 
 async def stream_completion(
     model, # AIModel instance
@@ -573,6 +827,12 @@ async def stream_completion(
 ):
     """
     Public function for streaming completion. Dispatches to provider-specific implementation.
+
+    When the same model_id is configured on several of the user's endpoints, the request is
+    routed to the endpoint with the best recent time-to-first-token and error rate, failing
+    over to the next one if it errors before streaming starts (see endpoint_router.py).
+    Transient errors on the last remaining endpoint are retried with backoff, and requests
+    fail fast while an endpoint's circuit breaker is open (see resilience.py).
     """
     if not model.endpoint or not model.endpoint.apikey:
         await on_chunk_callback({"type": "error", "message": "Endpoint or API key is missing."})
@@ -581,36 +841,233 @@ async def stream_completion(
     effective_temperature = temperature if temperature is not None else model.default_temperature
     effective_max_tokens = max_tokens if max_tokens is not None else model.default_max_tokens
 
-    if model.endpoint.provider == 'anthropic':
+    candidates = endpoint_router.rank(await endpoint_router.find_equivalent_models(model))
+    if (kwargs.get("n") or 1) > 1:
+        # An endpoint that cannot sample natively would stream one sample for all of them
+        candidates = [candidate for candidate in candidates if supports_native_sampling(candidate)]
+        if not candidates:
+            await on_chunk_callback({"type": "error", "message": "None of the model's endpoints can return several samples in one request."})
+            return
+    for index, candidate in enumerate(candidates):
+        is_last_candidate = index == len(candidates) - 1
+        outcome = await _stream_completion_with_retries(
+            candidate, messages, on_chunk_callback, effective_temperature, effective_max_tokens,
+            allow_retries=is_last_candidate, # Failing over beats waiting out a backoff
+            **kwargs
+        )
+        if outcome["error"] is None or outcome["delivered"]:
+            return
+        if is_last_candidate:
+            await on_chunk_callback(outcome["error"])
+            return
+        print(f"Failing over from endpoint {candidate.endpoint.id} to {candidates[index + 1].endpoint.id}: {outcome['error'].get('message')}")
+
+
+async def _stream_completion_with_retries(
+    model, # AIModel instance
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float,
+    max_tokens: int,
+    allow_retries: bool = True,
+    **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Streams from a single endpoint, retrying transient errors until the first token is delivered.
+    Each attempt runs under the model's timeout budgets (see timeouts.py); a timeout is a retryable error.
+    Each attempt waits for the endpoint's rate limiter, reporting its queue position as "queued" chunks.
+    Errors after delivery are forwarded to on_chunk_callback; an error that ends the attempt
+    before delivery is returned instead, so the caller can fail over or report it.
+    Returns:
+        A dictionary with 'delivered' (bool) and 'error' (the final error chunk or None).
+    """
+    endpoint = model.endpoint
+    breaker = resilience.get_breaker(endpoint)
+    estimated_tokens = rate_limiter.estimate_input_tokens(messages, kwargs.get("system"))
+    attempt = 0
+    while True:
+        if not breaker.allow_request():
+            resilience.record(endpoint, 'short_circuited')
+            return {"delivered": False, "error": {"type": "error", **resilience.circuit_open_error(endpoint)}}
+
+        resilience.record(endpoint, 'requests')
+
+        async def report_queue_position(position):
+            await on_chunk_callback({"type": "queued", "position": position})
+
+        attempt_state = {"delivered": False, "error": None, "started_at": time.monotonic(), "ttft": None, "input_tokens": None}
+
+        async def guarded_callback(chunk):
+            chunk_type = chunk.get("type")
+            # Real input usage, to correct the limiter's token estimate (OpenAI reports it at the end)
+            if chunk_type == "metadata":
+                data = chunk.get("data") or {}
+                if data.get("input_tokens") is not None:
+                    attempt_state["input_tokens"] = data["input_tokens"]
+            elif chunk_type == "stop" and attempt_state["input_tokens"] is None and (chunk.get("usage") or {}).get("input_tokens") is not None:
+                attempt_state["input_tokens"] = chunk["usage"]["input_tokens"]
+
+            if chunk_type == "error":
+                attempt_state["error"] = chunk
+                if not attempt_state["delivered"]:
+                    return # Held back until we know whether this attempt will be retried
+            elif chunk_type in ("delta", "stop"):
+                if not attempt_state["delivered"]:
+                    attempt_state["delivered"] = True
+                    attempt_state["ttft"] = time.monotonic() - attempt_state["started_at"]
+            await on_chunk_callback(chunk)
+
+        is_trial = breaker.holds_trial()
+        try:
+            permit = await rate_limiter.acquire(endpoint, estimated_tokens, on_queued=report_queue_position)
+            try:
+                # Tells the caller which endpoint (and AIModel row, for pricing) serves the attempt and how long it queued
+                await on_chunk_callback({"type": "metadata", "data": {"endpoint_id": endpoint.id, "ai_model_id": model.id, "queue_wait_ms": round(permit.queue_wait * 1000)}})
+                attempt_state["started_at"] = time.monotonic()
+                # Bounded by the model's first-token, idle and total budgets; a timeout cancels the attempt
+                timeout = await timeouts.run_stream_attempt(
+                    model,
+                    lambda callback: _dispatch_stream_completion(model, messages, callback, temperature, max_tokens, **kwargs),
+                    guarded_callback,
+                )
+                if timeout is not None:
+                    await guarded_callback({"type": "error", **timeout})
+            finally:
+                rate_limiter.release(
+                    permit,
+                    throttled=(attempt_state["error"] or {}).get("status_code") == 429,
+                    retry_after=(attempt_state["error"] or {}).get("retry_after"),
+                    actual_tokens=attempt_state["input_tokens"], # The TPM limit counts input tokens only
+                )
+        except BaseException:
+            # Cancelled (user cancel, timeout, disconnect) or raised: no outcome to judge the endpoint by
+            if is_trial:
+                breaker.abandon_trial()
+            raise
+        error = attempt_state["error"]
+        endpoint_router.record_result(endpoint, ttft=attempt_state["ttft"], error=error is not None)
+        if error is None:
+            breaker.record_success()
+            return {"delivered": attempt_state["delivered"], "error": None}
+
+        if resilience.counts_against_breaker(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success() # The provider answered; the request itself was bad or throttled
+
+        if attempt_state["delivered"]:
+            # Tokens already reached the client; the error has been forwarded as-is.
+            resilience.record(endpoint, 'failures')
+            return {"delivered": True, "error": error}
+
+        delay = None
+        if allow_retries and error.get("retryable") and attempt < resilience.max_retries():
+            delay = resilience.backoff_delay(attempt, error.get("retry_after"))
+        if delay is None:
+            resilience.record(endpoint, 'failures')
+            return {"delivered": False, "error": error}
+
+        resilience.record(endpoint, 'retries')
+        print(f"Retrying stream on endpoint {endpoint.id} in {delay:.2f}s (attempt {attempt + 1}): {error.get('message')}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _dispatch_stream_completion(
+    model, # AIModel instance
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float,
+    max_tokens: int,
+    **kwargs: Any
+):
+    """
+    Makes a single streaming attempt against the model's provider, recording it as a
+    cassette when NEURONEKO_CASSETTE_RECORD_DIR is set (see cassettes.py).
+    """
+    if model.endpoint.provider in cassettes.NON_RECORDED_PROVIDERS or not cassettes.recording_enabled():
+        await _dispatch_stream_completion_to_provider(model, messages, on_chunk_callback, temperature, max_tokens, **kwargs)
+        return
+    recorder = cassettes.Recorder(model.endpoint.provider, model.model_id, messages, kwargs.get("system"))
+    try:
+        await _dispatch_stream_completion_to_provider(model, messages, recorder.wrap(on_chunk_callback), temperature, max_tokens, **kwargs)
+    finally:
+        await recorder.save()
+
+
+async def _dispatch_stream_completion_to_provider(
+    model, # AIModel instance
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float,
+    max_tokens: int,
+    **kwargs: Any
+):
+    """
+    Streams one attempt from the model's provider.
+    """
+    conversation_state = kwargs.pop("conversation_state", None) # Only the OpenAI Responses mode uses it
+    if not supports_native_sampling(model):
+        kwargs.pop("n", None) # Never sent where it would be ignored or rejected (the Responses API has no `n`)
+    if model.endpoint.provider == 'openai' and openai_chaining_enabled(model.endpoint):
+        await _stream_completion_openai_responses_internal(
+            ai_model_id=model.model_id,
+            endpoint=model.endpoint,
+            messages=messages,
+            on_chunk_callback=on_chunk_callback,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            conversation_state=conversation_state,
+            **kwargs
+        )
+    elif _use_raw_sse_engine(model.endpoint.provider):
+        raw_stream_function = (
+            _stream_completion_anthropic_raw_internal if model.endpoint.provider == 'anthropic'
+            else _stream_completion_openai_raw_internal
+        )
+        await raw_stream_function(
+            ai_model_id=model.model_id,
+            endpoint=model.endpoint,
+            messages=messages,
+            on_chunk_callback=on_chunk_callback,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+    elif model.endpoint.provider == 'anthropic':
         await _stream_completion_anthropic_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
             on_chunk_callback=on_chunk_callback,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
-    elif model.endpoint.provider == 'openai':
+    elif model.endpoint.provider in OPENAI_WIRE_PROVIDERS:
         await _stream_completion_openai_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
             on_chunk_callback=on_chunk_callback,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
     elif model.endpoint.provider == 'google':
         await _stream_completion_google_internal(
             ai_model_id=model.model_id,
-            api_key=model.endpoint.apikey,
+            endpoint=model.endpoint,
             messages=messages,
             on_chunk_callback=on_chunk_callback,
-            temperature=effective_temperature,
-            max_tokens=effective_max_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
             **kwargs
         )
+    elif model.endpoint.provider == 'fake':
+        await fake_provider.stream_completion(model.endpoint, model.model_id, messages, on_chunk_callback, max_tokens=max_tokens, system=kwargs.get("system"), n=kwargs.get("n"))
+    elif model.endpoint.provider == 'replay':
+        await cassettes.replay_stream(model.endpoint, model.model_id, messages, on_chunk_callback, system=kwargs.get("system"))
     else:
         await on_chunk_callback({"type": "error", "message": f"Streaming not implemented for provider: {model.endpoint.provider}"})
 
@@ -655,18 +1112,18 @@ async def stream_completion(
 
 async def _get_static_completion_openai_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List[ChatMessage],
     temperature: float = None,
     max_tokens: int = None,
     **kwargs: Any
 ) -> Dict[str, Any]:
     """
-    Makes a static (non-streaming) API call to an OpenAI model.
+    Makes a static (non-streaming) API call to an OpenAI model without blocking the event loop.
     Returns a standardized dictionary.
     """
     try:
-        client = OpenAI(api_key=api_key, http_client=http_client_without_ssl_verification)
+        client = provider_clients.get_async_openai_client(endpoint)
         
         payload = {
             "model": ai_model_id,
@@ -682,7 +1139,7 @@ async def _get_static_completion_openai_internal(
         # No special handling for 'system' in kwargs needed here unless it's for other parameters.
         payload.update(kwargs) # For other potential OpenAI params like 'top_p', 'frequency_penalty', etc.
         
-        api_response = client.chat.completions.create(**payload)
+        api_response = await client.chat.completions.create(**payload)
         
         choice = api_response.choices[0]
         
@@ -699,21 +1156,83 @@ async def _get_static_completion_openai_internal(
             "error": None
         }
     except OpenAIAPIStatusError as e:
-        error_payload = {"type": type(e).__name__, "message": str(e.response.text if e.response else e), "status_code": e.status_code}
+        error_payload = {"type": type(e).__name__, "message": str(e.response.text if e.response else e), **resilience.error_details(e)}
         print(f"OpenAI API Error (Static): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
     except OpenAIAPIConnectionError as e:
-        error_payload = {"type": type(e).__name__, "message": str(e)}
+        error_payload = {"type": type(e).__name__, "message": str(e), **resilience.error_details(e)}
         print(f"OpenAI Connection Error (Static): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
     except Exception as e: 
-        error_payload = {"type": type(e).__name__, "message": str(e)}
+        error_payload = {"type": type(e).__name__, "message": str(e), **resilience.error_details(e)}
         print(f"Unexpected Error (Static OpenAI): {error_payload}")
         return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error_payload}
 
+# --- Native multi-sampling ---
+# Chat Completions can return several samples of one prompt in a single stream (the `n`
+# parameter), so the prompt is sent and billed once. With n > 1 the stream's deltas and
+# stops carry a "sample" key (the choice index); chunks without it concern every sample.
+
+def supports_native_sampling(model) -> bool:
+    """
+    Whether the model's endpoint returns n samples in one stream. On by default for OpenAI.
+    OpenAI-compatible servers differ (vLLM supports it, llama.cpp ignores it), so there it is
+    opt-in with the endpoint option {"native_sampling": true}, as it is for the fake provider.
+    The Responses API (chaining) has no `n`.
+    """
+    endpoint = model.endpoint
+    if endpoint.provider == 'fake':
+        return bool((getattr(endpoint, "options", None) or {}).get("native_sampling"))
+    if endpoint.provider not in OPENAI_WIRE_PROVIDERS:
+        return False
+    if endpoint.provider == 'openai' and openai_chaining_enabled(endpoint):
+        return False
+    option = (getattr(endpoint, "options", None) or {}).get("native_sampling")
+    return bool(option) if option is not None else endpoint.provider == 'openai'
+
+
+class _SampleDemux:
+    """
+    Per-sample bookkeeping for an n > 1 stream. Stops are held until the stream ends, because
+    usage arrives in a trailing chunk and covers all samples together. The prompt tokens are
+    attributed to sample 0, since they are billed once. The completion tokens are split by
+    each sample's share of the generated text.
+    """
+    def __init__(self):
+        self.chars: Dict[int, int] = {}
+        self.stop_reasons: Dict[int, str] = {}
+
+    def delta(self, index: int, text: str) -> Dict[str, Any]:
+        self.chars[index] = self.chars.get(index, 0) + len(text)
+        return {"type": "delta", "text_delta": text, "sample": index}
+
+    def finish(self, index: int, stop_reason: str):
+        self.stop_reasons[index] = stop_reason
+
+    def stop_chunks(self, usage: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        indices = sorted(self.stop_reasons)
+        total_chars = sum(self.chars.get(index, 0) for index in indices)
+        remaining = (usage or {}).get("output_tokens")
+        chunks = []
+        for position, index in enumerate(indices):
+            sample_usage = None
+            if usage:
+                if remaining is None:
+                    output_tokens = None
+                elif position == len(indices) - 1:
+                    output_tokens = remaining
+                else:
+                    share = self.chars.get(index, 0) / total_chars if total_chars else 1 / len(indices)
+                    output_tokens = min(remaining, round(usage["output_tokens"] * share))
+                    remaining -= output_tokens
+                sample_usage = {"input_tokens": usage.get("input_tokens") if position == 0 else 0, "output_tokens": output_tokens}
+            chunks.append({"type": "stop", "stop_reason": self.stop_reasons[index], "usage": sample_usage, "sample": index})
+        return chunks
+
+
 async def _stream_completion_openai_internal(
     ai_model_id: str,
-    api_key: str,
+    endpoint,
     messages: List[ChatMessage],
     on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
     temperature: float = None,
@@ -724,24 +1243,13 @@ async def _stream_completion_openai_internal(
     Makes a streaming API call to an OpenAI model and invokes a callback with standardized chunks.
     """
     try:
-        client = AsyncOpenAI(api_key=api_key, http_client=http_async_client_without_ssl_verification)
-        
-        payload = {
-            "model": ai_model_id,
-            "messages": messages,
-            "stream": True,
-            # stream_options include_usage for getting usage data in the last chunk
-            "stream_options": {"include_usage": True} 
-        }
-        if temperature is not None:
-            payload["temperature"] = temperature
-        if max_tokens is not None:
-            payload["max_tokens"] = max_tokens
-        
-        payload.update(kwargs)
+        client = provider_clients.get_async_openai_client(endpoint)
+        payload = _build_openai_stream_payload(ai_model_id, messages, temperature, max_tokens, kwargs)
 
         stream_id = None # To store the ID from the first chunk if available
         # final_usage variable might not be needed if usage is consistently in the stop chunk
+        samples = _SampleDemux() if (payload.get("n") or 1) > 1 else None
+        samples_usage = None
 
         api_response_object = await client.chat.completions.with_raw_response.create(**payload)
         async with api_response_object.parse() as parsed_stream: # parsed_stream is an AsyncStream
@@ -759,6 +1267,16 @@ async def _stream_completion_openai_internal(
                     await on_chunk_callback(standardized_chunk)
                     standardized_chunk = None # Reset for actual content
 
+                if samples is not None:
+                    for choice in chunk_event.choices or []:
+                        if choice.delta and choice.delta.content:
+                            await on_chunk_callback(samples.delta(choice.index, choice.delta.content))
+                        if choice.finish_reason:
+                            samples.finish(choice.index, choice.finish_reason)
+                    if chunk_event.usage:
+                        samples_usage = {"input_tokens": chunk_event.usage.prompt_tokens, "output_tokens": chunk_event.usage.completion_tokens}
+                    continue
+
                 if chunk_event.choices:
                     delta = chunk_event.choices[0].delta
                     finish_reason = chunk_event.choices[0].finish_reason
@@ -795,12 +1313,354 @@ async def _stream_completion_openai_internal(
                 if standardized_chunk:
                     await on_chunk_callback(standardized_chunk)
 
+        if samples is not None:
+            for stop_chunk in samples.stop_chunks(samples_usage):
+                await on_chunk_callback(stop_chunk)
+
     except OpenAIAPIStatusError as e:
-        error_detail = {"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}"}
+        error_detail = {"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
     except OpenAIAPIConnectionError as e:
-        error_detail = {"type": "error", "message": f"Connection Error: {str(e)}"}
+        error_detail = {"type": "error", "message": f"Connection Error: {str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
     except Exception as e:
-        error_detail = {"type": "error", "message": f"Unexpected error during OpenAI stream: {str(e)}"}
+        error_detail = {"type": "error", "message": f"Unexpected error during OpenAI stream: {str(e)}", **resilience.error_details(e)}
         await on_chunk_callback(error_detail)
+
+
+# --- OpenAI server-side conversation state ---
+# Opt-in (settings.NEURONEKO_OPENAI_CHAIN_RESPONSES, or an endpoint's "chain_responses" option)
+# mode that streams through the Responses API with store=True. Each assistant Message keeps
+# the id of the response that produced it and a hash of the conversation that response
+# covers. The next turn sends only the messages after it, with previous_response_id. Any
+# node can be branched from, because the chain is found by walking back along the path being
+# generated. When that hash no longer matches the current history (an edit), or the provider
+# no longer has the response, the full history is sent instead.
+
+def openai_chaining_enabled(endpoint) -> bool:
+    option = (getattr(endpoint, "options", None) or {}).get("chain_responses")
+    return option if option is not None else getattr(settings, 'NEURONEKO_OPENAI_CHAIN_RESPONSES', False)
+
+
+def _flatten_content(content) -> str:
+    if isinstance(content, list):
+        return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return content or ""
+
+
+def conversation_state_hash(messages: List[ChatMessage]) -> str:
+    """Hash of the roles and texts of a conversation, ignoring block formatting such as cache_control."""
+    canonical = json.dumps([[msg.get("role"), _flatten_content(msg.get("content"))] for msg in messages])
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _resolve_previous_response(messages: List[ChatMessage], conversation_state: Dict[str, Any] = None):
+    """
+    Returns (previous_response_id, messages still to send). The id is None when the chain
+    is broken (no state, or the history it covered has changed).
+    """
+    if conversation_state and conversation_state.get("previous_response_id"):
+        index = conversation_state.get("history_index")
+        if isinstance(index, int) and 0 <= index < len(messages) - 1 and conversation_state_hash(messages[:index + 1]) == conversation_state.get("context_hash"):
+            return conversation_state["previous_response_id"], messages[index + 1:]
+        print(f"OpenAI response chain broken at {conversation_state.get('previous_response_id')}; sending full history")
+    return None, messages
+
+
+async def _stream_completion_openai_responses_internal(
+    ai_model_id: str,
+    endpoint,
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float = None,
+    max_tokens: int = None,
+    conversation_state: Dict[str, Any] = None,
+    **kwargs: Any
+):
+    """
+    Streams through the OpenAI Responses API, chaining from the previous stored response
+    when possible. Emits the new response id as 'provider_response_id' in a metadata chunk.
+    """
+    system_text = next((_flatten_content(msg.get("content")) for msg in messages if msg.get("role") == "system"), None)
+    previous_response_id, to_send = _resolve_previous_response(messages, conversation_state)
+    state = {"delivered": False}
+    if previous_response_id is not None:
+        try:
+            await _stream_openai_responses_attempt(ai_model_id, endpoint, system_text, to_send, previous_response_id, on_chunk_callback, temperature, max_tokens, state, kwargs)
+            return
+        except OpenAIAPIStatusError as e:
+            if state["delivered"] or e.status_code not in (400, 404):
+                await on_chunk_callback({"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}", **resilience.error_details(e)})
+                return
+            # Expired, deleted or owned by another key (after failover): rebuild from the full history
+            print(f"OpenAI previous response {previous_response_id} unusable (status {e.status_code}); sending full history")
+        except Exception as e:
+            await on_chunk_callback({"type": "error", "message": f"Unexpected error during OpenAI stream: {str(e)}", **resilience.error_details(e)})
+            return
+    try:
+        await _stream_openai_responses_attempt(ai_model_id, endpoint, system_text, messages, None, on_chunk_callback, temperature, max_tokens, state, kwargs)
+    except OpenAIAPIStatusError as e:
+        await on_chunk_callback({"type": "error", "message": f"API Error (status {e.status_code}): {e.response.text if e.response else str(e)}", **resilience.error_details(e)})
+    except OpenAIAPIConnectionError as e:
+        await on_chunk_callback({"type": "error", "message": f"Connection Error: {str(e)}", **resilience.error_details(e)})
+    except Exception as e:
+        await on_chunk_callback({"type": "error", "message": f"Unexpected error during OpenAI stream: {str(e)}", **resilience.error_details(e)})
+
+
+async def _stream_openai_responses_attempt(ai_model_id, endpoint, system_text, messages, previous_response_id, on_chunk_callback, temperature, max_tokens, state, kwargs):
+    client = provider_clients.get_async_openai_client(endpoint)
+    payload = {
+        "model": ai_model_id,
+        "input": [{"role": msg.get("role"), "content": _flatten_content(msg.get("content"))} for msg in messages if msg.get("role") != "system"],
+        "store": True, # Required for the next turn to chain from this response
+        "stream": True,
+    }
+    if system_text:
+        payload["instructions"] = system_text # Instructions are not carried over from previous responses
+    if previous_response_id:
+        payload["previous_response_id"] = previous_response_id
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if max_tokens is not None:
+        payload["max_output_tokens"] = max_tokens
+    payload.update(kwargs)
+
+    stream = await client.responses.create(**payload)
+    async with stream: # Closes the HTTP response on cancellation too
+        await _consume_openai_responses_stream(stream, on_chunk_callback, state)
+
+
+async def _consume_openai_responses_stream(stream, on_chunk_callback, state):
+    async for event in stream:
+        if event.type == "response.created":
+            await on_chunk_callback({"type": "metadata", "data": {"id": event.response.id, "provider_response_id": event.response.id, "model_used": event.response.model}})
+        elif event.type == "response.output_text.delta":
+            if event.delta:
+                state["delivered"] = True
+                await on_chunk_callback({"type": "delta", "text_delta": event.delta})
+        elif event.type in ("response.completed", "response.incomplete"):
+            response = event.response
+            usage = response.usage
+            usage_data = None
+            if usage is not None:
+                cached_tokens = (usage.input_tokens_details.cached_tokens if usage.input_tokens_details else 0) or 0
+                usage_data = {"input_tokens": usage.input_tokens - cached_tokens, "output_tokens": usage.output_tokens}
+                await on_chunk_callback({"type": "metadata", "data": {"input_tokens": usage.input_tokens - cached_tokens, "cache_read_input_tokens": cached_tokens}})
+            stop_reason = "stop"
+            if event.type == "response.incomplete":
+                stop_reason = "length" if response.incomplete_details and response.incomplete_details.reason == "max_output_tokens" else (response.incomplete_details.reason if response.incomplete_details else "incomplete")
+            state["delivered"] = True
+            await on_chunk_callback({"type": "stop", "stop_reason": stop_reason, "usage": usage_data})
+        elif event.type in ("response.failed", "error"):
+            error = getattr(getattr(event, "response", None), "error", None) or event
+            message = getattr(error, "message", None) or str(error)
+            await on_chunk_callback({"type": "error", "message": f"OpenAI response failed: {message}", "status_code": None, "retryable": False, "retry_after": None})
+            return
+
+
+# --- Raw SSE streaming engine ---
+# Opt-in (settings.NEURONEKO_STREAM_ENGINE = 'raw_sse') fast path that reads the provider's
+# server-sent events directly from the pooled httpx client instead of building SDK event
+# objects for every token. Only the fields we use (text delta, usage, stop reason) are
+# decoded, and the same standardized chunks as the SDK path are emitted.
+
+ANTHROPIC_API_VERSION = "2023-06-01"
+RAW_SSE_PROVIDERS = ('anthropic', 'openai', 'openai_compatible')
+
+
+def _use_raw_sse_engine(provider: str) -> bool:
+    return getattr(settings, 'NEURONEKO_STREAM_ENGINE', 'sdk') == 'raw_sse' and provider in RAW_SSE_PROVIDERS
+
+
+async def _iter_sse_events(response: httpx.Response):
+    """
+    Yields (event_name, data) pairs from a server-sent events response.
+    event_name is None when the server does not send an 'event:' field (OpenAI).
+    """
+    event_name = None
+    data_lines = []
+    async for line in response.aiter_lines():
+        if not line:
+            if data_lines:
+                yield event_name, "\n".join(data_lines)
+            event_name = None
+            data_lines = []
+        elif line.startswith("data:"):
+            data_lines.append(line[6:] if line.startswith("data: ") else line[5:])
+        elif line.startswith("event:"):
+            event_name = line[6:].strip()
+        # Comment lines (":") and other fields (id, retry) are ignored
+    if data_lines:
+        yield event_name, "\n".join(data_lines)
+
+
+async def _raw_sse_error_chunk(response: httpx.Response) -> Dict[str, Any]:
+    body = (await response.aread()).decode("utf-8", errors="replace")
+    return {
+        "type": "error",
+        "message": f"API Error (status {response.status_code}): {body}",
+        **resilience.response_error_details(response.status_code, response.headers)
+    }
+
+
+async def _stream_completion_anthropic_raw_internal(
+    ai_model_id: str,
+    endpoint,
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float = None,
+    max_tokens: int = None,
+    **kwargs: Any
+):
+    """
+    Streams an Anthropic completion by parsing the raw SSE byte stream over httpx.
+    Emits the same standardized chunks as _stream_completion_anthropic_internal.
+    """
+    try:
+        # The SDK client is only used for its resolved base URL (honours ANTHROPIC_BASE_URL)
+        base_url = str(provider_clients.get_async_anthropic_client(endpoint).base_url).rstrip("/")
+        http_client = provider_clients.get_async_http_client(endpoint)
+        payload = _build_anthropic_payload(ai_model_id, messages, temperature, max_tokens, kwargs)
+        payload["stream"] = True
+        headers = {
+            "x-api-key": endpoint.apikey,
+            "anthropic-version": ANTHROPIC_API_VERSION,
+            "accept": "text/event-stream",
+        }
+
+        async with http_client.stream("POST", f"{base_url}/v1/messages", json=payload, headers=headers) as response:
+            if response.status_code >= 400:
+                await on_chunk_callback(await _raw_sse_error_chunk(response))
+                return
+
+            async for event_name, data in _iter_sse_events(response):
+                # Dispatch on the SSE event name first so ping/content_block_start/stop
+                # and message_stop are skipped without decoding their JSON.
+                if event_name == "content_block_delta":
+                    delta = json.loads(data)["delta"]
+                    if delta.get("type") == "text_delta" and delta.get("text"):
+                        await on_chunk_callback({"type": "delta", "text_delta": delta["text"]})
+                elif event_name == "message_start":
+                    message = json.loads(data)["message"]
+                    usage = message.get("usage") or {}
+                    await on_chunk_callback({
+                        "type": "metadata",
+                        "data": {
+                            "id": message.get("id"),
+                            "input_tokens": usage.get("input_tokens"),
+                            "cache_creation_input_tokens": usage.get("cache_creation_input_tokens"),
+                            "cache_read_input_tokens": usage.get("cache_read_input_tokens")
+                        }
+                    })
+                elif event_name == "message_delta":
+                    event = json.loads(data)
+                    await on_chunk_callback({
+                        "type": "stop",
+                        "stop_reason": event.get("delta", {}).get("stop_reason"),
+                        "usage": {"output_tokens": (event.get("usage") or {}).get("output_tokens")}
+                    })
+                elif event_name == "error":
+                    error = json.loads(data).get("error", {})
+                    await on_chunk_callback({
+                        "type": "error",
+                        "message": f"API Error ({error.get('type')}): {error.get('message')}",
+                        **resilience.stream_error_event_details(error.get('type'))
+                    })
+                    return
+
+    except httpx.TransportError as e:
+        await on_chunk_callback({"type": "error", "message": f"Connection Error: {str(e)}", **resilience.error_details(e)})
+    except Exception as e:
+        await on_chunk_callback({"type": "error", "message": f"Unexpected error during Anthropic stream: {str(e)}", **resilience.error_details(e)})
+
+
+async def _stream_completion_openai_raw_internal(
+    ai_model_id: str,
+    endpoint,
+    messages: List[ChatMessage],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    temperature: float = None,
+    max_tokens: int = None,
+    **kwargs: Any
+):
+    """
+    Streams an OpenAI chat completion by parsing the raw SSE byte stream over httpx.
+    Emits the same standardized chunks as _stream_completion_openai_internal.
+    """
+    try:
+        base_url = str(provider_clients.get_async_openai_client(endpoint).base_url).rstrip("/")
+        http_client = provider_clients.get_async_http_client(endpoint)
+        payload = _build_openai_stream_payload(ai_model_id, messages, temperature, max_tokens, kwargs)
+        headers = {
+            "authorization": f"Bearer {endpoint.apikey}",
+            "accept": "text/event-stream",
+        }
+
+        async with http_client.stream("POST", f"{base_url}/chat/completions", json=payload, headers=headers) as response:
+            if response.status_code >= 400:
+                await on_chunk_callback(await _raw_sse_error_chunk(response))
+                return
+
+            stream_id = None
+            pending_stop = None
+            samples = _SampleDemux() if (payload.get("n") or 1) > 1 else None
+            samples_usage = None
+            async for _, data in _iter_sse_events(response):
+                if data == "[DONE]":
+                    break
+                chunk_event = json.loads(data)
+                if "error" in chunk_event:
+                    error = chunk_event["error"] or {}
+                    await on_chunk_callback({
+                        "type": "error",
+                        "message": f"API Error: {error.get('message', error)}",
+                        **resilience.openai_stream_error_details(error)
+                    })
+                    return
+
+                if not stream_id and chunk_event.get("id"):
+                    stream_id = chunk_event["id"]
+                    await on_chunk_callback({
+                        "type": "metadata",
+                        "data": {"id": stream_id, "model_used": chunk_event.get("model")}
+                    })
+
+                if samples is not None:
+                    for choice in chunk_event.get("choices") or []:
+                        content = (choice.get("delta") or {}).get("content")
+                        if content:
+                            await on_chunk_callback(samples.delta(choice.get("index", 0), content))
+                        if choice.get("finish_reason"):
+                            samples.finish(choice.get("index", 0), choice["finish_reason"])
+                    usage = chunk_event.get("usage")
+                    if usage:
+                        samples_usage = {"input_tokens": usage.get("prompt_tokens"), "output_tokens": usage.get("completion_tokens")}
+                    continue
+
+                choices = chunk_event.get("choices")
+                if choices:
+                    choice = choices[0]
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        await on_chunk_callback({"type": "delta", "text_delta": content})
+                    if choice.get("finish_reason"):
+                        pending_stop = {"type": "stop", "stop_reason": choice["finish_reason"], "usage": None}
+
+                usage = chunk_event.get("usage")
+                if usage and pending_stop:
+                    # With include_usage, the usage arrives in a trailing chunk after finish_reason
+                    pending_stop["usage"] = {
+                        "input_tokens": usage.get("prompt_tokens"),
+                        "output_tokens": usage.get("completion_tokens")
+                    }
+
+            if pending_stop:
+                await on_chunk_callback(pending_stop)
+            if samples is not None:
+                for stop_chunk in samples.stop_chunks(samples_usage):
+                    await on_chunk_callback(stop_chunk)
+
+    except httpx.TransportError as e:
+        await on_chunk_callback({"type": "error", "message": f"Connection Error: {str(e)}", **resilience.error_details(e)})
+    except Exception as e:
+        await on_chunk_callback({"type": "error", "message": f"Unexpected error during OpenAI stream: {str(e)}", **resilience.error_details(e)})
@@ -0,0 +1,304 @@
+# chat/batch.py
+"""
+Bulk offline work through the providers' batch APIs.
+
+A BatchJob freezes one prompt per chat when it is created, is submitted as a single
+Anthropic Message Batch or OpenAI Batch (JSONL input file), and is polled until the
+provider has finished; results are then written back to Chat (titles) or Message
+(folder prompts). Batch requests are billed at a discount and do not compete with
+the interactive path's rate limits, at the cost of latency (minutes to hours).
+
+The jobs are driven by the create_batch_job and run_batch_jobs management commands.
+For local testing, point NEURONEKO_BATCH_BASE_URLS at the stand-in server in
+batch_standin.py.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+import anthropic
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from openai import OpenAI
+
+from . import provider_clients
+from .api_client import _build_anthropic_payload
+from .models import BatchJob, Chat, Message
+from .utils import build_title_prompt_messages, clean_generated_title
+
+BATCH_PROVIDERS = ('anthropic', 'openai')
+TITLE_MAX_TOKENS = 30
+DEFAULT_MAX_TOKENS = 1024 # Anthropic requires max_tokens on every request
+OPENAI_BATCH_URL = "/v1/chat/completions"
+OPENAI_FINISHED_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchError(Exception):
+    """Raised for jobs that cannot be created or submitted."""
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def _anthropic_client(endpoint) -> anthropic.Anthropic:
+    base_url = _setting('NEURONEKO_BATCH_BASE_URLS', {}).get('anthropic')
+    if base_url:
+        return anthropic.Anthropic(api_key=endpoint.apikey, base_url=base_url, http_client=provider_clients.get_http_client(endpoint), max_retries=2)
+    return provider_clients.get_anthropic_client(endpoint)
+
+
+def _openai_client(endpoint) -> OpenAI:
+    base_url = _setting('NEURONEKO_BATCH_BASE_URLS', {}).get('openai')
+    if base_url:
+        return OpenAI(api_key=endpoint.apikey, base_url=base_url, http_client=provider_clients.get_http_client(endpoint), max_retries=2)
+    return provider_clients.get_openai_client(endpoint)
+
+
+def _active_path(chat: Chat) -> List[Message]:
+    """The chat's messages from the root along active_child links."""
+    path = []
+    message = chat.root_message
+    seen = set()
+    while message is not None and message.id not in seen:
+        seen.add(message.id)
+        path.append(message)
+        message = message.active_child
+    return path
+
+
+def _check_model(ai_model):
+    if ai_model is None or not ai_model.endpoint or not ai_model.endpoint.apikey:
+        raise BatchError("The model's endpoint or API key is missing.")
+    if ai_model.endpoint.provider not in BATCH_PROVIDERS:
+        raise BatchError(f"Batch jobs are not supported for provider: {ai_model.endpoint.provider}")
+
+
+def create_title_job(user, ai_model, chats) -> BatchJob:
+    """
+    Creates a pending job that regenerates the title of each chat.
+    Chats without messages are skipped.
+    """
+    _check_model(ai_model)
+    items = []
+    for chat in chats:
+        prompt_messages = build_title_prompt_messages(chat)
+        if prompt_messages:
+            items.append({"custom_id": f"chat-{chat.id}", "chat_id": chat.id, "messages": prompt_messages})
+    if not items:
+        raise BatchError("None of the selected chats has messages to generate a title from.")
+    return BatchJob.objects.create(user=user, ai_model=ai_model, kind='chat_titles', items=items)
+
+
+def create_folder_prompt_job(user, ai_model, folder, prompt_text: str, system_prompt: Optional[str] = None) -> BatchJob:
+    """
+    Creates a pending job that sends `prompt_text` as a new user message to every chat in
+    the folder (after its active branch). Each reply is added below it as the new active branch.
+    """
+    _check_model(ai_model)
+    items = []
+    for chat in Chat.objects.filter(folder=folder, user=user).select_related('root_message'):
+        path = _active_path(chat)
+        if not path:
+            continue
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages += [{"role": m.role, "content": m.message} for m in path]
+        messages.append({"role": "user", "content": prompt_text})
+        items.append({"custom_id": f"chat-{chat.id}", "chat_id": chat.id, "parent_message_id": path[-1].id, "messages": messages})
+    if not items:
+        raise BatchError("The folder has no chats with messages.")
+    return BatchJob.objects.create(user=user, ai_model=ai_model, kind='folder_prompt', prompt_text=prompt_text, items=items)
+
+
+def _request_params(job: BatchJob) -> Dict[str, Any]:
+    ai_model = job.ai_model
+    max_tokens = TITLE_MAX_TOKENS if job.kind == 'chat_titles' else (ai_model.default_max_tokens or DEFAULT_MAX_TOKENS)
+    temperature = ai_model.default_temperature if ai_model.default_temperature is not None else (0.5 if job.kind == 'chat_titles' else None)
+    return {"temperature": temperature, "max_tokens": max_tokens}
+
+
+def submit(job: BatchJob):
+    """Submits a pending job to its provider's batch API."""
+    if job.status != 'pending':
+        raise BatchError(f"Job {job.id} is {job.status}, not pending.")
+    _check_model(job.ai_model)
+    endpoint = job.ai_model.endpoint
+    params = _request_params(job)
+
+    if endpoint.provider == 'anthropic':
+        requests = [
+            {
+                "custom_id": item["custom_id"],
+                "params": _build_anthropic_payload(job.ai_model.model_id, item["messages"], params["temperature"], params["max_tokens"], {}),
+            }
+            for item in job.items
+        ]
+        batch = _anthropic_client(endpoint).messages.batches.create(requests=requests)
+        job.provider_batch_id = batch.id
+    else: # openai
+        lines = []
+        for item in job.items:
+            body = {"model": job.ai_model.model_id, "messages": item["messages"], "max_tokens": params["max_tokens"]}
+            if params["temperature"] is not None:
+                body["temperature"] = params["temperature"]
+            lines.append(json.dumps({"custom_id": item["custom_id"], "method": "POST", "url": OPENAI_BATCH_URL, "body": body}))
+        client = _openai_client(endpoint)
+        input_file = client.files.create(file=(f"neuroneko-batch-{job.id}.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint=OPENAI_BATCH_URL, completion_window="24h")
+        job.provider_input_file_id = input_file.id
+        job.provider_batch_id = batch.id
+
+    job.status = 'submitted'
+    job.submitted_at = timezone.now()
+    job.save(update_fields=['provider_batch_id', 'provider_input_file_id', 'status', 'submitted_at'])
+    print(f"Submitted batch job {job.id} ({len(job.items)} requests) as {job.provider_batch_id}")
+
+
+def _anthropic_results(job: BatchJob) -> Optional[List[Dict[str, Any]]]:
+    client = _anthropic_client(job.ai_model.endpoint)
+    batch = client.messages.batches.retrieve(job.provider_batch_id)
+    if batch.processing_status != "ended":
+        return None
+    results = []
+    for entry in client.messages.batches.results(job.provider_batch_id):
+        if entry.result.type == "succeeded":
+            message = entry.result.message
+            text = "".join(block.text for block in message.content if getattr(block, "type", None) == "text")
+            results.append({"custom_id": entry.custom_id, "content": text, "input_tokens": message.usage.input_tokens, "output_tokens": message.usage.output_tokens})
+        else:
+            error = getattr(entry.result, "error", None)
+            results.append({"custom_id": entry.custom_id, "error": str(error) if error else entry.result.type})
+    return results
+
+
+def _openai_results(job: BatchJob) -> Optional[List[Dict[str, Any]]]:
+    client = _openai_client(job.ai_model.endpoint)
+    batch = client.batches.retrieve(job.provider_batch_id)
+    if batch.status not in OPENAI_FINISHED_STATUSES:
+        return None
+    results = []
+    # Expired and cancelled batches still return whatever finished in their output file
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            body = response.get("body") or {}
+            if response.get("status_code") == 200 and body.get("choices"):
+                usage = body.get("usage") or {}
+                results.append({"custom_id": entry["custom_id"], "content": body["choices"][0]["message"].get("content") or "", "input_tokens": usage.get("prompt_tokens"), "output_tokens": usage.get("completion_tokens")})
+            else:
+                results.append({"custom_id": entry["custom_id"], "error": json.dumps(entry.get("error") or body.get("error") or response)})
+    if not results and batch.status != 'completed':
+        raise BatchError(f"OpenAI batch {batch.id} ended with status '{batch.status}'.")
+    return results
+
+
+def _apply_result(job: BatchJob, item: Dict[str, Any], result: Dict[str, Any]) -> bool:
+    """Writes one successful result back. Returns False if its chat or message is gone."""
+    chat = Chat.objects.filter(id=item["chat_id"], user=job.user).first()
+    if chat is None:
+        return False
+    if job.kind == 'chat_titles':
+        new_title = clean_generated_title(result["content"])
+        if not new_title:
+            return False
+        chat.title = new_title
+        chat.save(update_fields=['title'])
+        return True
+
+    # folder_prompt: add the prompt and the reply below the branch the prompt was built from
+    parent = Message.objects.filter(id=item["parent_message_id"], chat=chat).first()
+    if parent is None:
+        return False
+    with transaction.atomic():
+        user_message = Message.objects.create(chat=chat, parent=parent, role='user', message=job.prompt_text)
+        assistant_message = Message.objects.create(
+            chat=chat, parent=user_message, role='assistant', message=result["content"],
+            input_tokens=result.get("input_tokens"), output_tokens=result.get("output_tokens"),
+        )
+        user_message.active_child = assistant_message
+        user_message.save(update_fields=['active_child'])
+        parent.active_child = user_message
+        parent.save(update_fields=['active_child'])
+    return True
+
+
+def poll(job: BatchJob) -> bool:
+    """
+    Checks a submitted job and writes its results back once the provider is done.
+    Safe to run from several pollers at once: the job is claimed before its results are
+    written, and they are written in one transaction.
+    Returns:
+        True if the job is finished (completed or failed), False if still processing.
+    """
+    if job.status != 'submitted':
+        return job.status in ('applying', 'completed', 'failed', 'cancelled')
+    try:
+        if job.ai_model is None:
+            raise BatchError("The job's model was deleted.")
+        results = _anthropic_results(job) if job.ai_model.endpoint.provider == 'anthropic' else _openai_results(job)
+    except BatchError as e:
+        job.status = 'failed'
+        job.error = str(e)
+        job.completed_at = timezone.now()
+        BatchJob.objects.filter(pk=job.pk, status='submitted').update(status=job.status, error=job.error, completed_at=job.completed_at)
+        return True
+    if results is None:
+        return False
+
+    with transaction.atomic():
+        # Only one poller writes the results back; a failure part way rolls back to 'submitted'
+        if not BatchJob.objects.filter(pk=job.pk, status='submitted').update(status='applying'):
+            print(f"Batch job {job.id} was claimed by another poller; skipping it")
+            return True
+        items_by_id = {item["custom_id"]: item for item in job.items}
+        errors = []
+        for result in results:
+            item = items_by_id.get(result["custom_id"])
+            if item is None:
+                continue
+            if "error" not in result and _apply_result(job, item, result):
+                job.succeeded_count += 1
+                job.input_tokens += result.get("input_tokens") or 0
+                job.output_tokens += result.get("output_tokens") or 0
+            else:
+                job.failed_count += 1
+                errors.append(f"{result['custom_id']}: {result.get('error', 'chat or message no longer exists')}")
+        job.failed_count += len(items_by_id) - len({r["custom_id"] for r in results} & set(items_by_id)) # No result at all
+        job.status = 'completed'
+        job.error = "\n".join(errors[:50])
+        job.completed_at = timezone.now()
+        job.save(update_fields=['status', 'succeeded_count', 'failed_count', 'input_tokens', 'output_tokens', 'error', 'completed_at'])
+    print(f"Batch job {job.id} finished: {job.succeeded_count} succeeded, {job.failed_count} failed")
+    return True
+
+
+def run_once() -> int:
+    """
+    Submits every pending job and polls every submitted one.
+    Returns:
+        The number of jobs still being processed by a provider.
+    """
+    for job in BatchJob.objects.filter(status='pending').select_related('ai_model__endpoint', 'user'):
+        try:
+            submit(job)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = f"{type(e).__name__}: {e}"
+            job.completed_at = timezone.now()
+            job.save(update_fields=['status', 'error', 'completed_at'])
+            print(f"Could not submit batch job {job.id}: {job.error}")
+    remaining = 0
+    for job in BatchJob.objects.filter(status='submitted').select_related('ai_model__endpoint', 'user'):
+        try:
+            if not poll(job):
+                remaining += 1
+        except Exception as e:
+            # Transient polling errors leave the job submitted; it is polled again next round
+            print(f"Error polling batch job {job.id}: {type(e).__name__} {e}")
+            remaining += 1
+    return remaining
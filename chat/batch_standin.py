@@ -0,0 +1,240 @@
+# chat/batch_standin.py
+"""
+A local stand-in for the Anthropic Message Batches and OpenAI Files/Batch APIs, for
+exercising chat/batch.py without real keys or real spend.
+
+Batches "finish" on the first poll after creation. Every reply echoes the start of the
+request's last user message, and usage is estimated from character counts. Only the
+calls batch.py makes are implemented. State lives in memory.
+
+Run it with:
+    python -m chat.batch_standin --port 8765
+and set NEURONEKO_BATCH_BASE_URLS = {'anthropic': 'http://127.0.0.1:8765',
+                                      'openai': 'http://127.0.0.1:8765/v1'}.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Any, Dict, List, Tuple
+from wsgiref.simple_server import make_server
+
+REPLY_PREFIX = "Stand-in reply to: "
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _last_user_text(messages: List[Dict[str, Any]]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, list): # Content blocks
+                return " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+            return content or ""
+    return ""
+
+
+def _reply_for(messages: List[Dict[str, Any]]) -> Tuple[str, int, int]:
+    """Returns (text, input_tokens, output_tokens) for a request."""
+    text = REPLY_PREFIX + _last_user_text(messages)[:60]
+    return text, _tokens(json.dumps(messages)), _tokens(text)
+
+
+class StandinBatchServer:
+    """WSGI application holding the stand-in's state."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.anthropic_batches: Dict[str, Dict[str, Any]] = {}
+        self.openai_batches: Dict[str, Dict[str, Any]] = {}
+        self.files: Dict[str, Dict[str, Any]] = {}
+
+    # --- Anthropic ---
+
+    def _anthropic_batch_view(self, batch: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+        count = len(batch["requests"])
+        ended = batch["polls"] > 0
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": batch["created_at"],
+            "expires_at": batch["created_at"],
+            "ended_at": batch["created_at"] if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{base_url}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+    def _anthropic_results(self, batch: Dict[str, Any]) -> str:
+        lines = []
+        for request in batch["requests"]:
+            params = request["params"]
+            text, input_tokens, output_tokens = _reply_for(params.get("messages", []))
+            lines.append(json.dumps({
+                "custom_id": request["custom_id"],
+                "result": {
+                    "type": "succeeded",
+                    "message": {
+                        "id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message", "role": "assistant", "model": params.get("model"),
+                        "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+                        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+                    },
+                },
+            }))
+        return "\n".join(lines) + "\n"
+
+    # --- OpenAI ---
+
+    def _openai_batch_view(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        count = len(batch["lines"])
+        ended = batch["polls"] > 0
+        if ended and batch["output_file_id"] is None:
+            batch["output_file_id"] = self._store_file("batch_output.jsonl", "batch_output", self._openai_output(batch).encode("utf-8"))
+        return {
+            "id": batch["id"], "object": "batch", "endpoint": batch["endpoint"], "errors": None,
+            "input_file_id": batch["input_file_id"], "completion_window": batch["completion_window"],
+            "status": "completed" if ended else "in_progress",
+            "output_file_id": batch["output_file_id"], "error_file_id": None,
+            "created_at": batch["created_at"], "completed_at": batch["created_at"] if ended else None,
+            "request_counts": {"total": count, "completed": count if ended else 0, "failed": 0},
+            "metadata": None,
+        }
+
+    def _openai_output(self, batch: Dict[str, Any]) -> str:
+        lines = []
+        for request in batch["lines"]:
+            body = request.get("body", {})
+            text, input_tokens, output_tokens = _reply_for(body.get("messages", []))
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": {
+                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+                    },
+                },
+                "error": None,
+            }))
+        return "\n".join(lines) + "\n"
+
+    def _store_file(self, filename: str, purpose: str, data: bytes) -> str:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed", "data": data}
+        return file_id
+
+    def _read_upload(self, environ, body: bytes) -> Tuple[str, str, bytes]:
+        """Parses the multipart/form-data upload of POST /v1/files."""
+        header = f"Content-Type: {environ.get('CONTENT_TYPE', '')}\r\n\r\n".encode("latin-1")
+        message = BytesParser(policy=HTTP).parsebytes(header + body)
+        filename, purpose, data = "upload.jsonl", "batch", b""
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "purpose":
+                purpose = part.get_content().strip()
+            elif name == "file":
+                filename = part.get_filename() or filename
+                data = part.get_payload(decode=True) or b""
+        return filename, purpose, data
+
+    # --- WSGI ---
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+        base_url = f"{environ.get('wsgi.url_scheme', 'http')}://{environ.get('HTTP_HOST', 'localhost')}"
+        parts = [p for p in path.split("/") if p]
+
+        with self._lock:
+            try:
+                status, payload = self._route(method, parts, environ, body, base_url)
+            except (KeyError, ValueError) as e:
+                status, payload = 400, {"error": {"type": "invalid_request_error", "message": f"{type(e).__name__}: {e}"}}
+
+        if isinstance(payload, (bytes, str)):
+            data = payload if isinstance(payload, bytes) else payload.encode("utf-8")
+            content_type = "application/octet-stream" if isinstance(payload, bytes) else "application/x-jsonl"
+        else:
+            data = json.dumps(payload).encode("utf-8")
+            content_type = "application/json"
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "OK")
+        start_response(f"{status} {reason}", [("Content-Type", content_type), ("Content-Length", str(len(data)))])
+        return [data]
+
+    def _route(self, method: str, parts: List[str], environ, body: bytes, base_url: str):
+        not_found = (404, {"error": {"type": "not_found_error", "message": "/" + "/".join(parts)}})
+
+        # Anthropic: /v1/messages/batches[/{id}[/results]]
+        if parts[:3] == ["v1", "messages", "batches"]:
+            if method == "POST" and len(parts) == 3:
+                batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+                requests = json.loads(body)["requests"]
+                self.anthropic_batches[batch_id] = {"id": batch_id, "requests": requests, "polls": 0, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+                return 200, self._anthropic_batch_view(self.anthropic_batches[batch_id], base_url)
+            batch = self.anthropic_batches.get(parts[3]) if len(parts) > 3 else None
+            if batch is None:
+                return not_found
+            if method == "GET" and len(parts) == 4:
+                batch["polls"] += 1
+                return 200, self._anthropic_batch_view(batch, base_url)
+            if method == "GET" and len(parts) == 5 and parts[4] == "results":
+                return 200, self._anthropic_results(batch)
+            return not_found
+
+        # OpenAI: /v1/files, /v1/files/{id}/content, /v1/batches[/{id}]
+        if parts[:2] == ["v1", "files"]:
+            if method == "POST" and len(parts) == 2:
+                filename, purpose, data = self._read_upload(environ, body)
+                file_id = self._store_file(filename, purpose, data)
+                return 200, {k: v for k, v in self.files[file_id].items() if k != "data"}
+            stored = self.files.get(parts[2]) if len(parts) > 2 else None
+            if stored is None:
+                return not_found
+            if method == "GET" and len(parts) == 4 and parts[3] == "content":
+                return 200, stored["data"]
+            return not_found
+
+        if parts[:2] == ["v1", "batches"]:
+            if method == "POST" and len(parts) == 2:
+                request = json.loads(body)
+                input_file = self.files[request["input_file_id"]]
+                lines = [json.loads(line) for line in input_file["data"].decode("utf-8").splitlines() if line.strip()]
+                batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+                self.openai_batches[batch_id] = {
+                    "id": batch_id, "lines": lines, "polls": 0, "created_at": int(time.time()), "endpoint": request["endpoint"],
+                    "input_file_id": request["input_file_id"], "completion_window": request["completion_window"], "output_file_id": None,
+                }
+                return 200, self._openai_batch_view(self.openai_batches[batch_id])
+            batch = self.openai_batches.get(parts[2]) if len(parts) > 2 else None
+            if batch is None or method != "GET":
+                return not_found
+            batch["polls"] += 1
+            return 200, self._openai_batch_view(batch)
+
+        return not_found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Anthropic and OpenAI batch APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    with make_server(args.host, args.port, StandinBatchServer()) as server:
+        print(f"Batch stand-in listening on http://{args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# chat/cache_prewarm.py
+"""
+Opt-in priming of the Anthropic prompt cache while the user is typing.
+
+The cost estimate (StreamingChatConsumer.handle_estimate_cost) already runs, debounced,
+as the user types, and formats the chat's active path. With
+NEURONEKO_PROMPT_CACHE_PREWARM enabled, it also passes that history here. A minimal
+request (one output token, see api_client.prime_prompt_cache) is then sent in the
+background with a breakpoint on the last saved message. This writes the whole prefix to
+the cache. When the user hits send, the new message's breakpoint finds that prefix within
+the lookback window and reads it instead of processing it again, so the first token
+arrives sooner.
+
+Each priming pays for a cache write and one output token. It is therefore limited per
+chat:
+- at most one request in flight;
+- at most one every NEURONEKO_PROMPT_CACHE_PREWARM_INTERVAL seconds;
+- an unchanged prefix is not primed again until its cache entry is about to expire.
+
+Prefixes shorter than the model's minimum cacheable length are skipped. The placeholder
+user turn that ends the request is fixed; the unsent draft is never sent.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import api_client, prompt_cache
+
+PRIMING_USER_TURN = {"role": "user", "content": [{"type": "text", "text": "."}]}
+
+# An unchanged prefix is primed again this long after the previous priming (before the default TTL runs out)
+REFRESH_AFTER_SECONDS = prompt_cache.DEFAULT_TTL_SECONDS - 60
+
+_chats: Dict[Any, Dict[str, Any]] = {} # chat id -> {'started', 'prefix', 'primed_at', 'task'}
+_background_tasks: set = set()
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def enabled() -> bool:
+    return _setting('NEURONEKO_PROMPT_CACHE_PREWARM', False) and prompt_cache.enabled()
+
+
+def primed_at(chat_id) -> Optional[datetime]:
+    """When the chat's prefix was last primed successfully, or None."""
+    state = _chats.get(chat_id)
+    return state["primed_at"] if state else None
+
+
+def _forget_stale(now: float):
+    stale_after = prompt_cache.DEFAULT_TTL_SECONDS * 2
+    for chat_id in [chat_id for chat_id, state in _chats.items() if now - state["started"] > stale_after and state["task"] is None]:
+        del _chats[chat_id]
+
+
+def maybe_prime(chat_id, ai_model, history: List[Dict[str, Any]]) -> bool:
+    """
+    Starts priming the cache for `history` in the background, if the chat's limits allow it.
+    Args:
+        chat_id: The chat's id, for per-chat limits.
+        ai_model: The AIModel the user has selected.
+        history: The chat's saved active path, formatted for the API (left unchanged).
+    Returns:
+        True if a priming request was started.
+    """
+    if not enabled() or not history or not ai_model.endpoint or ai_model.endpoint.provider != 'anthropic':
+        return False
+    now = time.monotonic()
+    _forget_stale(now)
+    state = _chats.get(chat_id)
+    if state is not None:
+        if state["task"] is not None or now - state["started"] < _setting('NEURONEKO_PROMPT_CACHE_PREWARM_INTERVAL', 30.0):
+            return False
+
+    history = copy.deepcopy(history)
+    if not prompt_cache.mark_for_priming(history, ai_model.model_id):
+        return False
+    prefix = hashlib.sha256(json.dumps([ai_model.endpoint.id, ai_model.model_id, history]).encode("utf-8")).hexdigest()
+    if state is not None and state["prefix"] == prefix and now - state["started"] < REFRESH_AFTER_SECONDS:
+        return False
+
+    state = {"started": now, "prefix": prefix, "primed_at": state["primed_at"] if state else None, "task": None}
+    _chats[chat_id] = state
+    task = asyncio.get_running_loop().create_task(_prime(chat_id, ai_model, history + [PRIMING_USER_TURN], state))
+    state["task"] = task
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return True
+
+
+async def _prime(chat_id, ai_model, messages: List[Dict[str, Any]], state: Dict[str, Any]):
+    try:
+        response = await api_client.prime_prompt_cache(ai_model, messages)
+        if response.get("error"):
+            print(f"Could not prime the prompt cache for chat {chat_id}: {response['error'].get('message')}")
+            return
+        state["primed_at"] = timezone.now()
+        usage = response.get("usage") or {}
+        print(f"Primed the prompt cache for chat {chat_id}: {usage.get('cache_creation_input_tokens')} tokens written, {usage.get('cache_read_input_tokens')} read")
+    except Exception as e:
+        print(f"Prompt cache priming failed for chat {chat_id}: {type(e).__name__} {e}")
+    finally:
+        state["task"] = None
@@ -0,0 +1,213 @@
+# chat/cassettes.py
+"""
+Record/replay of provider streams.
+
+With NEURONEKO_CASSETTE_RECORD_DIR set, every streaming attempt against a real provider
+is saved as a cassette: the standardized chunks api_client delivered, each stamped with
+its offset from the start of the attempt. A cassette is a gzipped JSON-lines file whose
+first line is a header (provider, model, prompt hash, recording time). Every later line is
+[offset_ms, chunk].
+
+Endpoints with the 'replay' provider play cassettes back from NEURONEKO_CASSETTE_DIR
+(or the endpoint's "cassette_dir" option). The model id selects the cassette by file
+name without extension. The special id "*" picks the cassette recorded for the same
+prompt if there is one, and otherwise cycles through all cassettes in name order. Timing
+is divided by the "speed" option: 1.0 replays in real time, 2.0 twice as fast, and 0
+without any delay. This gives regression benchmarks the traffic shapes of real
+providers, with no network involved.
+"""
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+CASSETTE_VERSION = 1
+CASSETTE_SUFFIX = ".jsonl.gz"
+ANY_CASSETTE = "*"
+NON_RECORDED_PROVIDERS = ('fake', 'replay') # Synthetic streams; nothing to learn from recording them
+
+_cycle_counter = itertools.count()
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def prompt_hash(messages: List[Dict[str, Any]], system: Optional[str] = None) -> str:
+    canonical = json.dumps({"messages": messages, "system": system}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# --- Recording ---
+
+def recording_enabled() -> bool:
+    return bool(_setting('NEURONEKO_CASSETTE_RECORD_DIR', None))
+
+
+class Recorder:
+    """Wraps an on_chunk_callback and records what passes through it."""
+
+    def __init__(self, provider: str, model_id: str, messages: List[Dict[str, Any]], system: Optional[str] = None):
+        self.header = {
+            "version": CASSETTE_VERSION,
+            "provider": provider,
+            "model_id": model_id,
+            "prompt_hash": prompt_hash(messages, system),
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.started_at = time.monotonic()
+        self.chunks: List[list] = []
+
+    def wrap(self, on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]]) -> Callable[[Dict[str, Any]], Awaitable[None]]:
+        async def recording_callback(chunk):
+            self.chunks.append([round((time.monotonic() - self.started_at) * 1000, 1), chunk])
+            await on_chunk_callback(chunk)
+        return recording_callback
+
+    def _write(self) -> str:
+        directory = _setting('NEURONEKO_CASSETTE_RECORD_DIR', None)
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        safe_model = "".join(c if c.isalnum() or c in "-_." else "_" for c in self.header["model_id"])
+        path = os.path.join(directory, f"{stamp}-{self.header['provider']}-{safe_model}-{self.header['prompt_hash'][:8]}{CASSETTE_SUFFIX}")
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(self.header) + "\n")
+            for entry in self.chunks:
+                f.write(json.dumps(entry, separators=(",", ":"), default=str) + "\n")
+        return path
+
+    async def save(self):
+        if not self.chunks:
+            return
+        try:
+            path = await asyncio.to_thread(self._write)
+            print(f"Recorded cassette {path} ({len(self.chunks)} chunks)")
+        except OSError as e:
+            print(f"Could not record cassette: {e}")
+
+
+# --- Replay ---
+
+def _cassette_dir(endpoint) -> Optional[str]:
+    return (getattr(endpoint, "options", None) or {}).get("cassette_dir") or _setting('NEURONEKO_CASSETTE_DIR', None)
+
+
+def _speed(endpoint) -> float:
+    speed = (getattr(endpoint, "options", None) or {}).get("speed")
+    return float(speed if speed is not None else _setting('NEURONEKO_CASSETTE_REPLAY_SPEED', 1.0))
+
+
+def list_cassettes(directory: Optional[str]) -> List[str]:
+    """Cassette names (file names without the suffix) in a directory, sorted."""
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len(CASSETTE_SUFFIX)] for name in os.listdir(directory) if name.endswith(CASSETTE_SUFFIX))
+
+
+def load(path: str) -> Dict[str, Any]:
+    """Reads a cassette. Returns a dict with 'header' and 'chunks' ([offset_ms, chunk] pairs)."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    header = json.loads(lines[0])
+    if header.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"Unsupported cassette version {header.get('version')} in {path}")
+    return {"header": header, "chunks": [json.loads(line) for line in lines[1:]]}
+
+
+def _select(endpoint, model_id: str, messages: List[Dict[str, Any]], system: Optional[str]) -> Dict[str, Any]:
+    directory = _cassette_dir(endpoint)
+    names = list_cassettes(directory)
+    if not names:
+        raise FileNotFoundError(f"No cassettes in {directory or '(NEURONEKO_CASSETTE_DIR is not set)'}")
+    if model_id != ANY_CASSETTE:
+        if model_id not in names:
+            raise FileNotFoundError(f"No cassette named '{model_id}' in {directory}")
+        return load(os.path.join(directory, model_id + CASSETTE_SUFFIX))
+    # Recorded names end with the prompt hash prefix; confirm against the header
+    wanted = prompt_hash(messages, system)
+    for name in names:
+        if name.endswith(wanted[:8]):
+            cassette = load(os.path.join(directory, name + CASSETTE_SUFFIX))
+            if cassette["header"].get("prompt_hash") == wanted:
+                return cassette
+    return load(os.path.join(directory, names[next(_cycle_counter) % len(names)] + CASSETTE_SUFFIX))
+
+
+def _error_chunk(e: Exception) -> Dict[str, Any]:
+    return {"type": "error", "message": f"Replay error: {type(e).__name__}: {e}", "status_code": None, "retryable": False, "retry_after": None}
+
+
+async def replay_stream(
+    endpoint,
+    model_id: str,
+    messages: List[Dict[str, Any]],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    system: Optional[str] = None,
+):
+    """Plays a cassette's chunks to on_chunk_callback at the recorded (scaled) offsets."""
+    try:
+        cassette = await asyncio.to_thread(_select, endpoint, model_id, messages, system)
+    except (OSError, ValueError) as e:
+        await on_chunk_callback(_error_chunk(e))
+        return
+    speed = _speed(endpoint)
+    started_at = time.monotonic()
+    for offset_ms, chunk in cassette["chunks"]:
+        if speed > 0:
+            # Scheduled against the start, so slow callbacks don't stretch the whole replay
+            delay = started_at + offset_ms / 1000.0 / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await on_chunk_callback(chunk)
+
+
+async def replay_static(endpoint, model_id: str, messages: List[Dict[str, Any]], system: Optional[str] = None) -> Dict[str, Any]:
+    """A static completion assembled from a cassette, returned after its (scaled) duration."""
+    result = {"id": None, "content": "", "role": "assistant", "model_used": model_id, "stop_reason": None, "usage": {"input_tokens": None, "output_tokens": None}, "error": None}
+
+    async def collect(chunk):
+        chunk_type = chunk.get("type")
+        if chunk_type == "delta":
+            result["content"] += chunk.get("text_delta", "")
+        elif chunk_type == "metadata":
+            data = chunk.get("data") or {}
+            result["id"] = data.get("id") or result["id"]
+            if data.get("input_tokens") is not None:
+                result["usage"]["input_tokens"] = data["input_tokens"]
+            if data.get("output_tokens") is not None:
+                result["usage"]["output_tokens"] = data["output_tokens"]
+        elif chunk_type == "stop":
+            result["stop_reason"] = chunk.get("stop_reason")
+            usage = chunk.get("usage") or {}
+            for key in ("input_tokens", "output_tokens"):
+                if usage.get(key) is not None:
+                    result["usage"][key] = usage[key]
+        elif chunk_type == "error":
+            result.update({"content": None, "role": "error", "stop_reason": "error", "usage": None,
+                           "error": {k: v for k, v in chunk.items() if k != "type"} | {"type": "ReplayedError"}})
+
+    await replay_stream(endpoint, model_id, messages, collect, system)
+    return result
+
+
+def list_models(endpoint) -> Dict[str, Any]:
+    directory = _cassette_dir(endpoint)
+    names = list_cassettes(directory)
+    if not names:
+        return {"status": "error", "message": f"No cassettes found in {directory or '(NEURONEKO_CASSETTE_DIR is not set)'}.", "models": []}
+    return {"status": "success", "models": [{"id": ANY_CASSETTE, "name": "Any cassette (matched by prompt, else cycled)"}] + [{"id": name, "name": name} for name in names]}
+
+
+def test_endpoint(endpoint) -> Dict[str, Any]:
+    directory = _cassette_dir(endpoint)
+    names = list_cassettes(directory)
+    if not names:
+        return {"status": "error", "message": f"No cassettes found in {directory or '(NEURONEKO_CASSETTE_DIR is not set)'}.", "details": None}
+    return {"status": "success", "message": f"{len(names)} cassette(s) available.", "details": {"cassette_dir": directory, "speed": _speed(endpoint)}}
@@ -0,0 +1,189 @@
+# chat/completion_cache.py
+"""
+Opt-in result cache for static (non-streaming) completions.
+
+Entries are keyed by provider, endpoint (id and base URL), model_id, the canonicalized
+messages, temperature, max_tokens and any extra request parameters. The in-memory cache is LRU-bounded
+with a TTL; if NEURONEKO_COMPLETION_CACHE_DIR is set, entries are also written there
+as JSON files so they survive restarts. Concurrent identical requests are
+single-flighted: the first caller makes the upstream call and the others await it.
+Only successful responses are cached.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from . import provider_clients
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def _canonical_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    content = message.get("content")
+    if isinstance(content, str):
+        content = content.strip()
+    return {"role": message.get("role"), "content": content}
+
+
+def make_key(model, messages: List[Dict[str, Any]], temperature: Optional[float], max_tokens: Optional[int], extra: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Returns the cache key for a request. Messages are reduced to role and (stripped)
+    content and serialized with sorted keys, so formatting differences do not matter.
+    """
+    canonical = {
+        "provider": model.endpoint.provider,
+        # Endpoints of one provider can serve different models under the same id (local servers, proxies)
+        "endpoint_id": model.endpoint.id,
+        "base_url": provider_clients.endpoint_base_url(model.endpoint),
+        "model_id": model.model_id,
+        "messages": [_canonical_message(m) for m in messages],
+        "temperature": float(temperature) if temperature is not None else None,
+        "max_tokens": max_tokens,
+        "extra": extra or {},
+    }
+    payload = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _MemoryCache:
+    def __init__(self):
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict() # key -> (expires_at, response)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, response: Dict[str, Any], expires_at: float):
+        max_entries = _setting('NEURONEKO_COMPLETION_CACHE_MAX_ENTRIES', 512)
+        with self._lock:
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_memory = _MemoryCache()
+
+
+def _disk_path(key: str) -> Optional[str]:
+    cache_dir = _setting('NEURONEKO_COMPLETION_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    return os.path.join(str(cache_dir), f"{key}.json")
+
+
+def _disk_get(key: str) -> Optional[tuple]:
+    path = _disk_path(key)
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable completion cache file {path}: {e}")
+        return None
+    if entry.get("expires_at", 0) <= time.time():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return entry["expires_at"], entry["response"]
+
+
+def _disk_set(key: str, response: Dict[str, Any], expires_at: float):
+    path = _disk_path(key)
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": expires_at, "response": response}, f)
+        os.replace(tmp_path, path) # Atomic, so readers never see a partial file
+    except OSError as e:
+        print(f"Could not write completion cache file {path}: {e}")
+
+
+# key -> (event loop, future) for the upstream call currently in flight
+_in_flight: Dict[str, tuple] = {}
+_in_flight_lock = threading.Lock()
+
+
+async def get_or_compute(key: str, compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Returns the cached response for `key`, or awaits `compute()` and caches its result
+    if it succeeded. Concurrent callers with the same key share one `compute()` call.
+    Cache hits are returned as copies marked with "cached": True.
+    """
+    response = _memory.get(key)
+    if response is None:
+        disk_entry = await asyncio.to_thread(_disk_get, key)
+        if disk_entry is not None:
+            _memory.set(key, disk_entry[1], disk_entry[0])
+            response = disk_entry[1]
+    if response is not None:
+        return {**response, "cached": True}
+
+    loop = asyncio.get_running_loop()
+    with _in_flight_lock:
+        flight = _in_flight.get(key)
+        # Futures cannot be awaited from another event loop; such callers just compute on their own.
+        leader = flight is None or flight[0] is not loop
+        if leader:
+            future = loop.create_future()
+            _in_flight[key] = (loop, future)
+    if not leader:
+        try:
+            shared = await asyncio.shield(flight[1])
+        except asyncio.CancelledError:
+            if flight[1].cancelled():
+                return await get_or_compute(key, compute) # The leader was cancelled; take over
+            raise
+        return {**shared, "cached": True} if not shared.get("error") else shared
+
+    try:
+        response = await compute()
+        if not response.get("error"):
+            expires_at = time.time() + _setting('NEURONEKO_COMPLETION_CACHE_TTL', 3600)
+            _memory.set(key, response, expires_at)
+            await asyncio.to_thread(_disk_set, key, response, expires_at)
+        future.set_result(response)
+        return response
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception() # Mark retrieved so a follower-less failure is not logged as unhandled
+        raise
+    finally:
+        with _in_flight_lock:
+            if _in_flight.get(key, (None, None))[1] is future:
+                del _in_flight[key]
+
+
+def clear():
+    """Empties the in-memory cache (disk entries expire on their own)."""
+    _memory.clear()
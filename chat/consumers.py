@@ -1,12 +1,15 @@
+import copy
 import json
 import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404 # For sync usage if needed, but prefer async alternatives
+from django.conf import settings
 
 from .models import Chat, Message, AIModel, UserSettings
-from .api_client import stream_completion
+from .api_client import conversation_state_hash, openai_chaining_enabled, stream_completion, supports_native_sampling
+from . import cache_prewarm, generation_registry, health, prewarm, prompt_cache, telemetry
 # Removed incorrect import of get_active_path_json from .views
 from .utils import count_tokens # Updated import
 
@@ -72,11 +75,16 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
         self.chat_id = None
         self.user = None
         self.room_group_name = None
-        self.current_stream_task = None
-        self.cancel_stream_flag = asyncio.Event()
+        self.current_stream_task = None # The generation this consumer started, while it runs
+        self.cancel_stream_flag = asyncio.Event() # Replaced by the generation's own flag when one starts
+        # The generation this socket receives frames from, and its relay; see generation_registry.py
+        self.attached_generation = None
+        self.generation_relay = None
+        self.prewarm_task = None # Keeps the chat model's provider connection open; see prewarm.py
 
     def _is_generation_active(self):
-        return self.current_stream_task and not self.current_stream_task.done()
+        # Generations outlive the socket that started them, so ask the registry
+        return self.user is not None and generation_registry.get_running(self.user.id, self.chat_id) is not None
 
     async def _handle_stream_chunk(self, chunk_data, assistant_msg_obj, stream_context):
         """
@@ -85,27 +93,33 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
         Returns True to continue streaming, False to stop.
         """
         if self.cancel_stream_flag.is_set():
-            assistant_msg_obj.message = stream_context['accumulated_content']
-            # Save partial content on cancellation
-            await database_sync_to_async(assistant_msg_obj.save)(update_fields=['message'])
-            await self.send_to_client({
-                'type': 'stream_cancelled',
-                'assistant_message_id': assistant_msg_obj.id,
-            })
+            await self._persist_cancelled_generation(assistant_msg_obj, stream_context)
             return False
 
         chunk_type = chunk_data.get("type")
 
         if chunk_type == "error":
             error_message = chunk_data.get("message", "Unknown API error during stream.")
-            assistant_msg_obj.message = f"Error: {error_message}"
-            await database_sync_to_async(assistant_msg_obj.save)(update_fields=['message'])
-            await self.send_error_to_client(f"API Error: {error_message}", assistant_msg_obj.id)
+            details = None
+            if chunk_data.get("timeout"):
+                # A distinct event per kind of timeout, so the client can tell them apart and offer a retry
+                details = {'error_code': f"timeout_{chunk_data['timeout']}", 'retryable': True}
+            update_fields = ['message']
+            if details and stream_context['accumulated_content']:
+                # A timeout after text was delivered ends the stream like a cancel: the text (and its timings) are kept
+                assistant_msg_obj.message = stream_context['accumulated_content']
+                details['content_kept'] = True
+                update_fields += self._apply_telemetry(assistant_msg_obj, stream_context)
+            else:
+                assistant_msg_obj.message = f"Error: {error_message}"
+            await database_sync_to_async(assistant_msg_obj.save)(update_fields=update_fields)
+            await self.send_error_to_client(f"API Error: {error_message}", assistant_msg_obj.id, details=details)
             return False
 
         if chunk_type == "delta":
             delta_text = chunk_data.get("text_delta", "")
             if delta_text:
+                stream_context['timer'].on_delta()
                 stream_context['accumulated_content'] += delta_text
                 await self.send_to_client({
                     'type': 'stream_chunk',
@@ -118,13 +132,25 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
 
             assistant_msg_obj.message = stream_context['accumulated_content']
 
-            usage_info = chunk_data.get("usage", {})
-            stream_context['output_tokens'] = usage_info.get('output_tokens')
+            usage_info = chunk_data.get("usage") or {} # OpenAI sends usage=None when it was not reported
+            if usage_info.get('output_tokens') is not None:
+                stream_context['output_tokens'] = usage_info.get('output_tokens')
+            if stream_context['input_tokens'] is None and usage_info.get('input_tokens') is not None:
+                stream_context['input_tokens'] = usage_info.get('input_tokens') # OpenAI reports input usage at the end
 
             assistant_msg_obj.input_tokens = stream_context['input_tokens']
             assistant_msg_obj.output_tokens = stream_context['output_tokens']
             assistant_msg_obj.cache_creation_input_tokens = stream_context['cache_creation_tokens']
             assistant_msg_obj.cache_read_input_tokens = stream_context['cache_read_tokens']
+            assistant_msg_obj.ai_model = stream_context['ai_model'] # Prices this message's usage (get_cost_details)
+            if stream_context['provider_response_id']:
+                # Lets the next turn (or a branch from this message) chain from the stored response
+                assistant_msg_obj.provider_response_id = stream_context['provider_response_id']
+                assistant_msg_obj.provider_response_context_hash = conversation_state_hash(
+                    stream_context['api_messages'] + [{"role": "assistant", "content": stream_context['accumulated_content']}]
+                )
+
+            self._apply_telemetry(assistant_msg_obj, stream_context)
 
             await database_sync_to_async(assistant_msg_obj.save)(
                 update_fields=[
@@ -132,7 +158,11 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                     'input_tokens',
                     'output_tokens',
                     'cache_creation_input_tokens',
-                    'cache_read_input_tokens'
+                    'cache_read_input_tokens',
+                    'ai_model',
+                    'provider_response_id',
+                    'provider_response_context_hash',
+                    *telemetry.MESSAGE_FIELDS,
                 ]
             )
             
@@ -150,49 +180,220 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                     'cache_creation_input_tokens': stream_context['cache_creation_tokens'],
                     'cache_read_input_tokens': stream_context['cache_read_tokens'],
                 },
-                'cost_details': cost_details
+                'cost_details': cost_details,
+                'telemetry': assistant_msg_obj.get_telemetry(),
             })
             return False
+        elif chunk_type == "queued":
+            # Waiting for the endpoint's rate limiter; not an error, just tell the user where they stand
+            await self.send_to_client({
+                'type': 'stream_queued',
+                'assistant_message_id': assistant_msg_obj.id,
+                'position': chunk_data.get('position'),
+            })
         elif chunk_type == "metadata":
             data_payload = chunk_data.get('data', {})
-            stream_context['input_tokens'] = data_payload.get('input_tokens')
-            stream_context['cache_creation_tokens'] = data_payload.get('cache_creation_input_tokens')
-            stream_context['cache_read_tokens'] = data_payload.get('cache_read_input_tokens')
+            stream_context['timer'].on_metadata(data_payload)
+            serving_model_id = data_payload.get('ai_model_id')
+            if serving_model_id is not None and serving_model_id != stream_context['ai_model'].id:
+                # Failed over to an equivalent endpoint: its AIModel row prices the answer
+                serving_model = await database_sync_to_async(AIModel.objects.select_related('endpoint').filter(id=serving_model_id).first)()
+                if serving_model is not None:
+                    stream_context['ai_model'] = serving_model
+            # Metadata arrives in several chunks (routing, message start, usage); only overwrite what each one carries
+            if 'input_tokens' in data_payload:
+                stream_context['input_tokens'] = data_payload.get('input_tokens')
+            if 'cache_creation_input_tokens' in data_payload:
+                stream_context['cache_creation_tokens'] = data_payload.get('cache_creation_input_tokens')
+            if 'cache_read_input_tokens' in data_payload:
+                stream_context['cache_read_tokens'] = data_payload.get('cache_read_input_tokens')
+            if data_payload.get('output_tokens') is not None:
+                stream_context['output_tokens'] = data_payload.get('output_tokens')
+            if data_payload.get('provider_response_id'):
+                stream_context['provider_response_id'] = data_payload['provider_response_id']
             # print(f"Stream metadata received: {data_payload}")
 
         return True
 
-    async def _perform_streamed_generation(self, ai_model_instance, api_messages, assistant_msg_obj, temperature, max_tokens):
-        await self.send_to_client({'type': 'lock_sidebar'})
-        
-        stream_context = {
+    def _new_stream_context(self, api_messages, ai_model_instance):
+        return {
+            'ai_model': ai_model_instance,
             'accumulated_content': "",
             'input_tokens': None,
             'cache_creation_tokens': None,
             'cache_read_tokens': None,
-            'output_tokens': None
+            'output_tokens': None,
+            'timer': telemetry.GenerationTimer(),
+            'api_messages': api_messages,
+            'provider_response_id': None,
+            'ended': False, # Set once the message got its stop, error or cancellation
         }
 
+    async def _attach_generation(self, generation, after_offset=None, resume=False):
+        """
+        Starts receiving a generation's frames on this socket: from the start for the socket
+        that starts it, otherwise replayed from `after_offset` (see generation_registry.py).
+        """
+        # A socket too far behind is closed; the page reconnects and replays from its last offset
+        if resume:
+            relay = generation.reattach(self._send_frame, after_offset, on_overflow=self.close)
+        else:
+            relay = generation.attach(self._send_frame, on_overflow=self.close)
+        self.attached_generation, self.generation_relay = generation, relay
+
+    async def _detach_generation(self):
+        generation, relay = self.attached_generation, self.generation_relay
+        self.attached_generation, self.generation_relay = None, None
+        if generation is not None:
+            await generation.detach(relay)
+
+    def _apply_telemetry(self, assistant_msg_obj, stream_context):
+        """Sets the generation's latency figures on the message. Returns the fields to save."""
+        generation_telemetry = stream_context['timer'].summary(output_tokens=stream_context['output_tokens'])
+        for field_name, value in generation_telemetry.items():
+            setattr(assistant_msg_obj, field_name, value)
+        return list(telemetry.MESSAGE_FIELDS)
+
+    async def _persist_cancelled_generation(self, assistant_msg_obj, stream_context):
+        # Save partial content on cancellation, with its timings: slow generations are often the cancelled ones
+        stream_context['ended'] = True
+        assistant_msg_obj.message = stream_context['accumulated_content']
+        update_fields = ['message', *self._apply_telemetry(assistant_msg_obj, stream_context)]
+        await database_sync_to_async(assistant_msg_obj.save)(update_fields=update_fields)
+        await self.send_to_client({
+            'type': 'stream_cancelled',
+            'assistant_message_id': assistant_msg_obj.id,
+        })
+
+    async def _on_stream_task_cancelled(self, assistant_msg_obj, stream_context):
+        """
+        Called when the generation task is cancelled mid-stream. By then the upstream response has
+        been closed (the provider streams are read inside `async with`), so billing stops and
+        the connection is released. The partial content is saved before the cancellation
+        finishes propagating.
+        """
+        if stream_context.get('ended'):
+            return
+        try:
+            # Shielded so a second cancellation (e.g. disconnect right after cancel) cannot lose the partial content
+            await asyncio.shield(self._persist_cancelled_generation(assistant_msg_obj, stream_context))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Could not save partial content of cancelled message {assistant_msg_obj.id}: {type(e).__name__} {e}")
+
+    async def _handle_stream_failure(self, e, assistant_msg_obj, stream_context):
+        # This handles errors from stream_completion itself or during the _handle_stream_chunk if not caught there
+        print(f"Error during streamed generation: {type(e).__name__} {e}")
+        # Ensure message is updated with whatever content was accumulated before error, or an error message
+        if not assistant_msg_obj.message or "Error:" not in assistant_msg_obj.message:
+             assistant_msg_obj.message = stream_context.get('accumulated_content', "") + f"\nError during stream: {str(e)}"
+             await database_sync_to_async(assistant_msg_obj.save)(update_fields=['message'])
+        await self.send_error_to_client(f"Server error during generation stream: {str(e)}", assistant_msg_obj.id)
+
+    async def _stream_into_message(self, ai_model_instance, api_messages, assistant_msg_obj, temperature, max_tokens, conversation_state=None):
+        """Streams one completion into assistant_msg_obj. Expects the relay to be open."""
+        stream_context = self._new_stream_context(api_messages, ai_model_instance)
         try:
             async def on_chunk_wrapper(chunk_data):
                 # This wrapper calls the instance method _handle_stream_chunk
-                return await self._handle_stream_chunk(chunk_data, assistant_msg_obj, stream_context)
+                keep_going = await self._handle_stream_chunk(chunk_data, assistant_msg_obj, stream_context)
+                if not keep_going:
+                    stream_context['ended'] = True
+                return keep_going
 
             await stream_completion(
                 model=ai_model_instance,
                 messages=api_messages,
                 on_chunk_callback=on_chunk_wrapper,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                conversation_state=conversation_state,
             )
+        except asyncio.CancelledError:
+            await self._on_stream_task_cancelled(assistant_msg_obj, stream_context)
+            raise
         except Exception as e:
-            # This handles errors from stream_completion itself or during the _handle_stream_chunk if not caught there
-            print(f"Error during _perform_streamed_generation: {type(e).__name__} {e}")
-            # Ensure message is updated with whatever content was accumulated before error, or an error message
-            if not assistant_msg_obj.message or "Error:" not in assistant_msg_obj.message:
-                 assistant_msg_obj.message = stream_context.get('accumulated_content', "") + f"\nError during stream: {str(e)}"
-                 await database_sync_to_async(assistant_msg_obj.save)(update_fields=['message'])
-            await self.send_error_to_client(f"Server error during generation stream: {str(e)}", assistant_msg_obj.id)
+            await self._handle_stream_failure(e, assistant_msg_obj, stream_context)
+
+    async def _stream_native_samples(self, ai_model_instance, api_messages, assistant_msg_objs, temperature, max_tokens):
+        """
+        Streams len(assistant_msg_objs) samples in a single request (see api_client.supports_native_sampling).
+        Chunks tagged with a "sample" index go to that sample's message. Untagged text belongs
+        to one sample only, so it goes to the first; other untagged chunks (routing metadata,
+        queue position, errors) concern all of them. A sample the stream never ended gets an error.
+        """
+        stream_contexts = [self._new_stream_context(api_messages, ai_model_instance) for _ in assistant_msg_objs]
+        try:
+            async def on_chunk_wrapper(chunk_data):
+                sample = chunk_data.get("sample")
+                if sample is None and chunk_data.get("type") in ("delta", "stop"):
+                    sample = 0
+                indices = range(len(assistant_msg_objs)) if sample is None else [sample]
+                for index in indices:
+                    if 0 <= index < len(assistant_msg_objs) and not stream_contexts[index].get('ended'):
+                        keep_going = await self._handle_stream_chunk(chunk_data, assistant_msg_objs[index], stream_contexts[index])
+                        if not keep_going:
+                            stream_contexts[index]['ended'] = True
+
+            await stream_completion(
+                model=ai_model_instance,
+                messages=api_messages,
+                on_chunk_callback=on_chunk_wrapper,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=len(assistant_msg_objs),
+            )
+            for assistant_msg_obj, stream_context in zip(assistant_msg_objs, stream_contexts):
+                if not stream_context.get('ended'):
+                    stream_context['ended'] = True
+                    await self._handle_stream_chunk({"type": "error", "message": "The provider returned no result for this sample."}, assistant_msg_obj, stream_context)
+        except asyncio.CancelledError:
+            for assistant_msg_obj, stream_context in zip(assistant_msg_objs, stream_contexts):
+                await self._on_stream_task_cancelled(assistant_msg_obj, stream_context)
+            raise
+        except Exception as e:
+            for assistant_msg_obj, stream_context in zip(assistant_msg_objs, stream_contexts):
+                if not stream_context.get('ended'):
+                    await self._handle_stream_failure(e, assistant_msg_obj, stream_context)
+
+    async def _perform_streamed_generation(self, ai_model_instance, api_messages, assistant_msg_obj, temperature, max_tokens, conversation_state=None):
+        await self.send_to_client({'type': 'lock_sidebar'})
+        try:
+            await self._stream_into_message(ai_model_instance, api_messages, assistant_msg_obj, temperature, max_tokens, conversation_state)
+        finally:
+            await self.send_to_client({'type': 'unlock_sidebar'})
+
+    async def _perform_fan_out_generation(self, generations, temperature):
+        """
+        Streams several models' answers at once.
+        Args:
+            generations: (ai_model_instance, api_messages, assistant_msg_obj, conversation_state) tuples.
+            temperature: Shared temperature; each model uses its own default max tokens.
+        """
+        await self.send_to_client({'type': 'lock_sidebar'})
+        try:
+            await asyncio.gather(*(
+                self._stream_into_message(ai_model_instance, api_messages, assistant_msg_obj, temperature, ai_model_instance.default_max_tokens, conversation_state)
+                for ai_model_instance, api_messages, assistant_msg_obj, conversation_state in generations
+            ))
+        finally:
+            await self.send_to_client({'type': 'unlock_sidebar'})
+
+    async def _perform_sampled_generation(self, ai_model_instance, api_messages, assistant_msg_objs, temperature, max_tokens, conversation_state=None):
+        """
+        Generates one sample per message in assistant_msg_objs (siblings under one parent), all at once:
+        in one request where the provider samples natively, otherwise as concurrent requests.
+        """
+        await self.send_to_client({'type': 'lock_sidebar'})
+        try:
+            if len(assistant_msg_objs) > 1 and supports_native_sampling(ai_model_instance):
+                await self._stream_native_samples(ai_model_instance, api_messages, assistant_msg_objs, temperature, max_tokens)
+            else:
+                await asyncio.gather(*(
+                    self._stream_into_message(ai_model_instance, api_messages, assistant_msg_obj, temperature, max_tokens, conversation_state)
+                    for assistant_msg_obj in assistant_msg_objs
+                ))
         finally:
             await self.send_to_client({'type': 'unlock_sidebar'})
 
@@ -222,18 +423,55 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         await self.accept()
+        health.ensure_started() # No-op once running; Daphne never sends lifespan startup
+        self._start_prewarm()
         print(f"WebSocket connected for chat {self.chat_id}, user {self.user.id}, group {self.room_group_name}")
 
+    @database_sync_to_async
+    def _chat_model_endpoint(self):
+        chat = Chat.objects.select_related('ai_model_used__endpoint').filter(id=self.chat_id, user=self.user).first()
+        return chat.ai_model_used.endpoint if chat and chat.ai_model_used else None
+
+    def _start_prewarm(self):
+        """(Re)starts keeping the chat model's endpoint connection warm, warming it right away."""
+        if not prewarm.enabled():
+            return
+        self._stop_prewarm()
+        self.prewarm_task = asyncio.create_task(prewarm.keep_warm(self._chat_model_endpoint))
+
+    def _stop_prewarm(self):
+        if self.prewarm_task and not self.prewarm_task.done():
+            self.prewarm_task.cancel()
+        self.prewarm_task = None
+
+    async def chat_model_changed(self, event):
+        """Group message sent by set_chat_model_api: warm the new model's endpoint now."""
+        self._start_prewarm()
+
+    def _cancel_stream_task(self):
+        """
+        Stops the chat's running generation right away, whichever socket started it: cancelling
+        the task closes the upstream HTTP stream (no waiting for the provider's next chunk, no
+        further billing) and the stream handlers save the partial content on the way out.
+        """
+        generation = generation_registry.get_running(self.user.id, self.chat_id)
+        if generation is not None:
+            generation.cancel()
+
     async def disconnect(self, close_code):
-        if self.current_stream_task:
-            self.cancel_stream_flag.set() # Signal cancellation
-            try:
-                await asyncio.wait_for(self.current_stream_task, timeout=5.0) # Give it a moment to clean up
-            except asyncio.TimeoutError:
+        self._stop_prewarm()
+        generation = self.attached_generation
+        await self._detach_generation()
+        # Generations keep running for a reconnecting client, unless detaching is turned off
+        # and no other socket is watching
+        if (generation is not None and generation.is_running() and not generation.subscribers
+                and not getattr(settings, 'NEURONEKO_GENERATION_DETACHED', True)):
+            generation.cancel()
+            # Only the partial-content save is left to wait for, not the provider
+            done, _ = await asyncio.wait({generation.task}, timeout=getattr(settings, 'NEURONEKO_CANCEL_CLEANUP_TIMEOUT', 5.0))
+            if not done:
                 print(f"Stream task for chat {self.chat_id} did not finish cleanly on disconnect.")
-            except Exception as e:
-                print(f"Exception during stream task cleanup on disconnect: {e}")
-            self.current_stream_task = None
+        self.current_stream_task = None
 
         if self.room_group_name:
             await self.channel_layer.group_discard(
@@ -247,21 +485,41 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
             data = json.loads(text_data)
             message_type = data.get('type')
 
-            if message_type in ['start_generation', 'generate_reply_to_message', 'generate_into_empty_message']:
+            if message_type in ['start_generation', 'generate_reply_to_message', 'generate_into_empty_message', 'generate_samples', 'start_fan_out_generation']:
                 if self._is_generation_active():
                     await self.send_error_to_client("A generation is already in progress.")
                     return
-                self.cancel_stream_flag.clear() # Reset flag for new stream
-                
+                await self._detach_generation() # From a previous, finished generation
+
                 if message_type == 'start_generation':
-                    self.current_stream_task = asyncio.create_task(self.handle_start_generation(data))
+                    handler = self.handle_start_generation
                 elif message_type == 'generate_reply_to_message':
-                    self.current_stream_task = asyncio.create_task(self.handle_generate_reply_to_message(data))
+                    handler = self.handle_generate_reply_to_message
                 elif message_type == 'generate_into_empty_message':
-                    self.current_stream_task = asyncio.create_task(self.handle_generate_into_empty_message(data))
+                    handler = self.handle_generate_into_empty_message
+                elif message_type == 'generate_samples':
+                    handler = self.handle_generate_samples
+                else:
+                    handler = self.handle_start_fan_out_generation
+
+                # The registry owns the task, so it survives this socket (see generation_registry.py)
+                generation = generation_registry.create(self.user.id, self.chat_id)
+                if generation is None:
+                    await self.send_error_to_client("A generation is already in progress.")
+                    return
+                self.cancel_stream_flag = generation.cancel_flag
+                self.current_stream_task = generation.start(handler(data))
+                await self._attach_generation(generation) # Before the task runs, so no frame is missed
+            elif message_type == 'reattach_generation':
+                # A reconnecting client resumes the chat's generation from the last offset it saw
+                generation = generation_registry.get(self.user.id, self.chat_id)
+                if generation is not None and generation is not self.attached_generation:
+                    offset = data.get('offset')
+                    await self._detach_generation()
+                    await self._attach_generation(generation, after_offset=offset if isinstance(offset, int) else None, resume=True)
             elif message_type == 'cancel_generation':
                 if self._is_generation_active():
-                    self.cancel_stream_flag.set()
+                    self._cancel_stream_task()
                     await self.send_info_to_client("Cancellation request received.")
                 else:
                     await self.send_info_to_client("No active generation to cancel.")
@@ -352,14 +610,15 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                 'parent_id': user_msg_obj.id
             })
 
-            api_messages = await self.get_formatted_message_history(chat, user_msg_obj)
+            api_messages, conversation_state = await self.get_generation_history(chat, user_msg_obj, ai_model_instance)
             
             await self._perform_streamed_generation(
                 ai_model_instance=ai_model_instance,
                 api_messages=api_messages,
                 assistant_msg_obj=assistant_msg_obj,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                conversation_state=conversation_state
             )
 
         except AIModel.DoesNotExist:
@@ -411,14 +670,15 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                 'parent_id': parent_message.id
             })
 
-            api_messages = await self.get_formatted_message_history(chat, parent_message)
+            api_messages, conversation_state = await self.get_generation_history(chat, parent_message, ai_model_instance)
 
             await self._perform_streamed_generation(
                 ai_model_instance=ai_model_instance,
                 api_messages=api_messages,
                 assistant_msg_obj=assistant_msg_obj,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                conversation_state=conversation_state
             )
 
         except Message.DoesNotExist:
@@ -465,14 +725,15 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
             
             # The target_message itself is the assistant_msg_obj to be filled
             # History should be up to the parent of the target_message
-            api_messages = await self.get_formatted_message_history(chat, target_message.parent)
+            api_messages, conversation_state = await self.get_generation_history(chat, target_message.parent, ai_model_instance)
 
             await self._perform_streamed_generation(
                 ai_model_instance=ai_model_instance,
                 api_messages=api_messages,
                 assistant_msg_obj=target_message, # Pass the message to be filled
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                conversation_state=conversation_state
             )
 
         except Message.DoesNotExist:
@@ -491,6 +752,208 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
             if self.current_stream_task is asyncio.current_task():
                  self.current_stream_task = None
 
+    async def handle_generate_samples(self, data):
+        """
+        Generates several alternative replies at once, each into its own sibling message.
+        Either `parent_message_id` (all samples are new children of it) or `target_message_id`
+        (an empty message that becomes the first sample, e.g. one just made with add_sibling)
+        selects where they go. `count` is capped at NEURONEKO_MAX_SAMPLES.
+        """
+        try:
+            parent_message_id = data.get('parent_message_id')
+            target_message_id = data.get('target_message_id')
+            model_id = data.get('model_id')
+            try:
+                count = int(data.get('count') or 2)
+            except (TypeError, ValueError):
+                count = 0
+            max_samples = getattr(settings, 'NEURONEKO_MAX_SAMPLES', 4)
+
+            if not (parent_message_id or target_message_id) or not model_id:
+                await self.send_error_to_client("Missing parent (or target) message ID or model ID.")
+                return
+            if not 1 <= count <= max_samples:
+                await self.send_error_to_client(f"The number of samples must be between 1 and {max_samples}.")
+                return
+
+            chat = await database_sync_to_async(Chat.objects.select_related('user', 'ai_model_used__endpoint', 'root_message').get)(id=self.chat_id, user=self.user)
+            ai_model_instance = await database_sync_to_async(AIModel.objects.select_related('endpoint').get)(id=model_id, endpoint__user=self.user)
+            user_settings = await database_sync_to_async(UserSettings.objects.get)(user=self.user)
+
+            temperature = chat.ai_temperature if chat.ai_temperature is not None else user_settings.default_temp
+            max_tokens = ai_model_instance.default_max_tokens
+
+            assistant_msg_objs = []
+            if target_message_id:
+                target_message = await database_sync_to_async(Message.objects.select_related('parent').get)(id=target_message_id, chat=chat)
+                if not target_message.parent:
+                    await self.send_error_to_client("Target message for generation cannot be a root message.")
+                    return
+                parent_message = target_message.parent
+                assistant_msg_objs.append(target_message)
+            else:
+                parent_message = await database_sync_to_async(Message.objects.get)(id=parent_message_id, chat=chat)
+
+            while len(assistant_msg_objs) < count:
+                assistant_msg_objs.append(await database_sync_to_async(Message.objects.create)(
+                    chat=chat,
+                    message="",
+                    role='assistant',
+                    parent=parent_message
+                ))
+            # The first sample is shown while streaming; the others are reachable with sibling navigation
+            await database_sync_to_async(self.set_as_active_child)(parent_message, assistant_msg_objs[0])
+
+            if not target_message_id:
+                await self.send_to_client({
+                    'type': 'assistant_message_placeholder_created',
+                    'message_id': assistant_msg_objs[0].id,
+                    'role': 'assistant',
+                    'parent_id': parent_message.id
+                })
+            await self.send_to_client({
+                'type': 'sample_placeholders_created',
+                'assistant_message_ids': [msg.id for msg in assistant_msg_objs],
+                'parent_id': parent_message.id
+            })
+
+            api_messages, conversation_state = await self.get_generation_history(chat, parent_message, ai_model_instance)
+
+            await self._perform_sampled_generation(
+                ai_model_instance=ai_model_instance,
+                api_messages=api_messages,
+                assistant_msg_objs=assistant_msg_objs,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                conversation_state=conversation_state
+            )
+
+        except Message.DoesNotExist:
+            await self.send_error_to_client("Parent or target message not found.")
+        except AIModel.DoesNotExist:
+            await self.send_error_to_client("Selected AI Model not found or not accessible.")
+        except Chat.DoesNotExist:
+            await self.send_error_to_client("Chat session not found.")
+        except UserSettings.DoesNotExist:
+            await self.send_error_to_client("User settings not found.")
+        except Exception as e:
+            print(f"Error in handle_generate_samples: {type(e).__name__} {e}")
+            await self.send_error_to_client(f"Server error during generation setup: {str(e)}")
+            await self.send_to_client({'type': 'unlock_sidebar'})
+        finally:
+            if self.current_stream_task is asyncio.current_task():
+                 self.current_stream_task = None
+
+    async def handle_start_fan_out_generation(self, data):
+        """
+        Sends one user turn to several models at once; each answer streams into its own sibling
+        assistant message, recording its own model, usage, cost and latency.
+        Either `user_message_content` (appended to the active path, like start_generation) or
+        `parent_message_id` (an existing message to answer) gives the turn. `model_ids` lists
+        the models, at most NEURONEKO_MAX_FAN_OUT_MODELS of them.
+        """
+        try:
+            user_message_content = data.get('user_message_content')
+            parent_message_id = data.get('parent_message_id')
+            model_ids = list(dict.fromkeys(data.get('model_ids') or [])) # Unique, in the requested order
+            max_models = getattr(settings, 'NEURONEKO_MAX_FAN_OUT_MODELS', 4)
+
+            if not (user_message_content or parent_message_id) or not model_ids:
+                await self.send_error_to_client("Missing user message content (or parent message ID) or model IDs.")
+                return
+            if len(model_ids) > max_models:
+                await self.send_error_to_client(f"At most {max_models} models can answer at once.")
+                return
+
+            chat = await database_sync_to_async(Chat.objects.select_related('user', 'ai_model_used__endpoint', 'root_message').get)(id=self.chat_id, user=self.user)
+            ai_models_by_id = await database_sync_to_async(
+                lambda: {ai_model.id: ai_model for ai_model in AIModel.objects.select_related('endpoint').filter(id__in=model_ids, endpoint__user=self.user)}
+            )()
+            ai_model_instances = [ai_models_by_id.get(int(model_id)) for model_id in model_ids]
+            if None in ai_model_instances:
+                raise AIModel.DoesNotExist()
+            user_settings = await database_sync_to_async(UserSettings.objects.get)(user=self.user)
+
+            temperature = chat.ai_temperature if chat.ai_temperature is not None else user_settings.default_temp
+
+            if parent_message_id:
+                parent_message = await database_sync_to_async(Message.objects.get)(id=parent_message_id, chat=chat)
+            else:
+                last_active_message = await self.get_last_active_message(chat)
+                if not last_active_message:
+                    await self.send_error_to_client("Cannot determine parent message for user input.")
+                    return
+                parent_message = await database_sync_to_async(Message.objects.create)(
+                    chat=chat,
+                    message=user_message_content,
+                    role='user',
+                    parent=last_active_message
+                )
+                await database_sync_to_async(self.set_as_active_child)(last_active_message, parent_message)
+                await self.send_to_client({
+                    'type': 'user_message_created',
+                    'message_id': parent_message.id,
+                    'content': parent_message.message,
+                    'role': parent_message.role,
+                    'parent_id': last_active_message.id
+                })
+
+            assistant_msg_objs = []
+            for ai_model_instance in ai_model_instances:
+                assistant_msg_objs.append(await database_sync_to_async(Message.objects.create)(
+                    chat=chat,
+                    message="",
+                    role='assistant',
+                    parent=parent_message,
+                    ai_model=ai_model_instance
+                ))
+            # The first model's answer is shown while streaming; the others are its siblings
+            await database_sync_to_async(self.set_as_active_child)(parent_message, assistant_msg_objs[0])
+
+            # Sent first so the client can clear the branch being replaced before the placeholder renders
+            await self.send_to_client({
+                'type': 'fan_out_placeholders_created',
+                'parent_id': parent_message.id,
+                'assistant_messages': [
+                    {'message_id': msg.id, 'model_id': ai_model_instance.id, 'model_name': ai_model_instance.name}
+                    for msg, ai_model_instance in zip(assistant_msg_objs, ai_model_instances)
+                ],
+            })
+            await self.send_to_client({
+                'type': 'assistant_message_placeholder_created',
+                'message_id': assistant_msg_objs[0].id,
+                'role': 'assistant',
+                'parent_id': parent_message.id
+            })
+
+            model_histories = await self.get_fan_out_histories(chat, parent_message, ai_model_instances)
+
+            await self._perform_fan_out_generation(
+                [
+                    (ai_model_instance, api_messages, assistant_msg_obj, conversation_state)
+                    for ai_model_instance, assistant_msg_obj, (api_messages, conversation_state) in zip(ai_model_instances, assistant_msg_objs, model_histories)
+                ],
+                temperature=temperature
+            )
+
+        except (TypeError, ValueError):
+            await self.send_error_to_client("Model IDs must be integers.")
+        except Message.DoesNotExist:
+            await self.send_error_to_client("Parent message not found.")
+        except AIModel.DoesNotExist:
+            await self.send_error_to_client("One of the selected AI Models was not found or is not accessible.")
+        except Chat.DoesNotExist:
+            await self.send_error_to_client("Chat session not found.")
+        except UserSettings.DoesNotExist:
+            await self.send_error_to_client("User settings not found.")
+        except Exception as e:
+            print(f"Error in handle_start_fan_out_generation: {type(e).__name__} {e}")
+            await self.send_error_to_client(f"Server error during generation setup: {str(e)}")
+            await self.send_to_client({'type': 'unlock_sidebar'})
+        finally:
+            if self.current_stream_task is asyncio.current_task():
+                 self.current_stream_task = None
+
     @database_sync_to_async
     def get_last_active_message(self, chat_obj: Chat) -> Message | None:
         current_message = chat_obj.root_message
@@ -506,9 +969,54 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
         parent_msg_obj.save(update_fields=['active_child'])
 
     @database_sync_to_async
-    def get_formatted_message_history(self, chat_obj: Chat, last_message_in_history: Message):
+    def get_formatted_message_history(self, chat_obj: Chat, last_message_in_history: Message, ai_model: AIModel = None):
+        history, _ = self._format_message_history(chat_obj, last_message_in_history, ai_model)
+        return history
+
+    @database_sync_to_async
+    def get_generation_history(self, chat_obj: Chat, last_message_in_history: Message, ai_model: AIModel):
+        """
+        The formatted history for a generation, plus the conversation state to chain from
+        when the model uses OpenAI's stored responses (None otherwise).
+        """
+        history, path_messages = self._format_message_history(chat_obj, last_message_in_history, ai_model)
+        return history, self._conversation_state(path_messages, ai_model)
+
+    @database_sync_to_async
+    def get_fan_out_histories(self, chat_obj: Chat, last_message_in_history: Message, ai_models):
+        """
+        get_generation_history for several models, walking and formatting the path once.
+        Returns:
+            A list of (history, conversation_state), one per model, in order.
+        """
+        shared_history, path_messages = self._format_message_history(chat_obj, last_message_in_history)
+        results = []
+        for ai_model in ai_models:
+            history = copy.deepcopy(shared_history) # Per-model changes (cache breakpoints) must not leak
+            self._apply_model_specific_history(history, path_messages, ai_model)
+            results.append((history, self._conversation_state(path_messages, ai_model)))
+        return results
+
+    def _conversation_state(self, path_messages, ai_model: AIModel):
+        conversation_state = None
+        if ai_model.endpoint.provider == 'openai' and openai_chaining_enabled(ai_model.endpoint):
+            # The newest assistant message on this path that has a stored response
+            for index in range(len(path_messages) - 1, -1, -1):
+                msg_in_path = path_messages[index]
+                if msg_in_path.role == 'assistant' and msg_in_path.provider_response_id:
+                    conversation_state = {
+                        "previous_response_id": msg_in_path.provider_response_id,
+                        "history_index": index,
+                        "context_hash": msg_in_path.provider_response_context_hash,
+                    }
+                    break
+        return conversation_state
+
+    def _format_message_history(self, chat_obj: Chat, last_message_in_history: Message, ai_model: AIModel = None):
+        # Returns (history, path_messages)
         # Traverse from root_message up to last_message_in_history along the active path
         # and format for the API, applying cache_control if needed.
+        # With an Anthropic ai_model, breakpoints are also placed automatically (see prompt_cache.py).
         history = []
         
         # Get the ID of the message that should have the cache_control tag from the Chat model
@@ -518,7 +1026,7 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
         path_messages = []
         current_msg_in_path = chat_obj.root_message
         if not current_msg_in_path: # Handle chats with no root message (should ideally not happen)
-            return []
+            return [], []
 
         while current_msg_in_path:
             path_messages.append(current_msg_in_path)
@@ -544,7 +1052,7 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
             except StopIteration:
                 # last_message_in_history was not found in the active path from root_message.
                 print(f"Error: last_message_in_history (ID: {last_message_in_history.id}) not found in the active path for chat (ID: {chat_obj.id}).")
-                return [] # Return empty list or raise an error, as history cannot be correctly constructed.
+                return [], [] # Return empty lists or raise an error, as history cannot be correctly constructed.
 
         for msg_in_path in path_messages:
             content_text = msg_in_path.message
@@ -560,6 +1068,9 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                 "role": msg_in_path.role,
                 "content": [content_block] # Content must be an array of blocks
             })
+
+        if ai_model is not None:
+            self._apply_model_specific_history(history, path_messages, ai_model)
         
         # System prompt considerations:
         # The api_client.py's stream_completion (and _get_static_completion_anthropic_internal)
@@ -568,16 +1079,32 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
         # If a system message from the DB (e.g., root_message.role == 'system') is formatted by this loop,
         # its 'content' will be `[{"type": "text", "text": "...", "cache_control": ...}]` if it's the cache point.
         # The api_client will then correctly pass this structured content to the 'system' API parameter.
-        return history
+        return history, path_messages
 
 
+    def _apply_model_specific_history(self, history, path_messages, ai_model: AIModel):
+        # Automatic Anthropic cache breakpoints depend on the model (minimum cacheable length)
+        if ai_model.endpoint.provider == 'anthropic' and prompt_cache.enabled():
+            primed_at = cache_prewarm.primed_at(path_messages[0].chat_id) if path_messages else None
+            prompt_cache.apply_breakpoints(history, [msg.created_at for msg in path_messages], ai_model.model_id, primed_at=primed_at)
+
     async def send_to_client(self, data_dict):
+        generation = generation_registry.current()
+        if generation is not None:
+            # Sent from a generation: buffered for replay and relayed to every attached socket
+            generation.publish(data_dict)
+        else:
+            await self._send_frame(data_dict)
+
+    async def _send_frame(self, data_dict):
         await self.send(text_data=json.dumps(data_dict))
 
-    async def send_error_to_client(self, error_message, assistant_message_id=None):
+    async def send_error_to_client(self, error_message, assistant_message_id=None, details=None):
         payload = {'type': 'stream_error', 'error': error_message}
         if assistant_message_id:
             payload['assistant_message_id'] = assistant_message_id
+        if details:
+            payload.update(details)
         await self.send_to_client(payload)
 
     async def send_info_to_client(self, info_message):
@@ -657,6 +1184,10 @@ class StreamingChatConsumer(AsyncWebsocketConsumer):
                 'currency': "USD" # As per user confirmation
             })
 
+            # Opt-in: write the saved prefix to the prompt cache so the send reads it (see cache_prewarm.py)
+            if history_messages and not self._is_generation_active():
+                cache_prewarm.maybe_prime(chat.id, ai_model_instance, history_messages)
+
         except AIModel.DoesNotExist:
             await self.send_error_to_client("Selected AI Model not found for cost estimation.")
         except Chat.DoesNotExist:
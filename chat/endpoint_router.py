@@ -0,0 +1,139 @@
+# chat/endpoint_router.py
+"""
+Latency-aware routing across equivalent endpoints.
+
+A user may configure the same provider model_id under several AIEndpoints (separate
+keys or regions). stream_completion asks this module to order those equivalent
+AIModels: endpoints with a lower recent time-to-first-token and fewer recent errors
+come first, with a little random spread so near-equal endpoints share the load.
+Endpoints whose background health probe (health.py) failed or reported throttling
+are tried only after the healthy ones.
+Stats are process-local and updated after every streaming attempt.
+"""
+import math
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import health, resilience
+from .models import AIModel
+
+TTFT_EWMA_ALPHA = 0.3  # weight of the newest TTFT sample
+ERROR_HALF_LIFE = 60.0  # seconds for the error rate to decay by half
+ERROR_PENALTY = 4.0  # an endpoint failing every request scores 5x its TTFT
+UNHEALTHY_PENALTY = 1e3  # failing or throttled health probe: behind every healthy endpoint
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.ttft_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.error_updated_at = time.monotonic()
+        self.samples = 0
+
+    def decayed_error_rate(self, now: float) -> float:
+        return self.error_rate * math.pow(0.5, (now - self.error_updated_at) / ERROR_HALF_LIFE)
+
+    def record(self, ttft: Optional[float], error: bool):
+        now = time.monotonic()
+        # Decay, then blend in the new outcome
+        self.error_rate = self.decayed_error_rate(now) * (1 - TTFT_EWMA_ALPHA) + (TTFT_EWMA_ALPHA if error else 0.0)
+        self.error_updated_at = now
+        if ttft is not None:
+            self.ttft_ewma = ttft if self.ttft_ewma is None else (1 - TTFT_EWMA_ALPHA) * self.ttft_ewma + TTFT_EWMA_ALPHA * ttft
+        self.samples += 1
+
+
+_stats: Dict[Any, _EndpointStats] = {}
+_stats_lock = threading.Lock()
+
+
+def record_result(endpoint, ttft: Optional[float] = None, error: bool = False):
+    """
+    Records the outcome of a streaming attempt.
+    Args:
+        endpoint: The AIEndpoint that served (or failed) the attempt.
+        ttft: Seconds from request to first token, if a token arrived.
+        error: Whether the attempt failed.
+    """
+    with _stats_lock:
+        _stats.setdefault(endpoint.id, _EndpointStats()).record(ttft, error)
+
+
+def _score(endpoint, known_ttfts: List[float], now: float) -> float:
+    stats = _stats.get(endpoint.id)
+    if stats is None or stats.ttft_ewma is None:
+        # Unmeasured endpoints are scored like the best known one so they get explored.
+        ttft = min(known_ttfts) if known_ttfts else 1.0
+    else:
+        ttft = stats.ttft_ewma
+    error_rate = stats.decayed_error_rate(now) if stats else 0.0
+    score = ttft * (1 + ERROR_PENALTY * error_rate)
+    probe = health.get_health(endpoint.id)
+    if probe is not None and not probe["healthy"]:
+        score += UNHEALTHY_PENALTY
+    if resilience.get_breaker(endpoint).state == resilience.CircuitBreaker.OPEN:
+        score += 1e6  # Only tried after every healthy endpoint
+    return score
+
+
+def rank(models: list) -> list:
+    """Orders equivalent AIModels from most to least preferred endpoint."""
+    if len(models) <= 1:
+        return list(models)
+    spread = _setting('NEURONEKO_ROUTING_SPREAD', 0.25)
+    now = time.monotonic()
+    with _stats_lock:
+        known_ttfts = [
+            _stats[m.endpoint.id].ttft_ewma for m in models
+            if m.endpoint.id in _stats and _stats[m.endpoint.id].ttft_ewma is not None
+        ]
+        scored = [(_score(m.endpoint, known_ttfts, now) * random.uniform(1.0, 1.0 + spread), m) for m in models]
+    scored.sort(key=lambda pair: pair[0])
+    return [m for _, m in scored]
+
+
+@database_sync_to_async
+def find_equivalent_models(model) -> list:
+    """
+    Returns the AIModels that can serve the same request as `model`: same provider
+    model_id and provider, on endpoints owned by the same user that have an API key.
+    `model` itself is always first in the returned list.
+    """
+    if not _setting('NEURONEKO_ENDPOINT_ROUTING', True) or not getattr(model.endpoint, 'user_id', None):
+        return [model]
+    equivalents = (
+        AIModel.objects.select_related('endpoint')
+        .filter(
+            model_id=model.model_id,
+            endpoint__provider=model.endpoint.provider,
+            endpoint__user_id=model.endpoint.user_id,
+        )
+        .exclude(id=model.id)
+        .exclude(endpoint__apikey__isnull=True)
+        .exclude(endpoint__apikey="")
+    )
+    return [model] + list(equivalents)
+
+
+def get_stats(endpoint_ids=None) -> Dict[Any, Dict[str, Any]]:
+    """Snapshot of routing stats (TTFT EWMA, decayed error rate), keyed by endpoint id."""
+    now = time.monotonic()
+    with _stats_lock:
+        ids = set(endpoint_ids) if endpoint_ids is not None else set(_stats)
+        return {
+            endpoint_id: {
+                "ttft_ewma": _stats[endpoint_id].ttft_ewma if endpoint_id in _stats else None,
+                "error_rate": _stats[endpoint_id].decayed_error_rate(now) if endpoint_id in _stats else 0.0,
+                "samples": _stats[endpoint_id].samples if endpoint_id in _stats else 0,
+            }
+            for endpoint_id in ids
+        }
@@ -0,0 +1,238 @@
+# chat/fake_provider.py
+"""
+A local synthetic provider ('fake') for load and latency testing without keys or network.
+
+Responses are lorem-style words (one word per token) streamed on a schedule given by
+time to first token, tokens per second and output length, with multiplicative jitter.
+Faults can be injected: 429s before the first token, stalls mid-stream and
+mid-stream disconnects. With the option "native_sampling", a request for n samples
+gets them interleaved in one stream, tagged like an OpenAI n > 1 response. Errors are reported like real provider errors, so retries,
+failover, rate limiting and circuit breaking all apply as usual.
+
+Configuration is merged, later entries winning, from:
+    DEFAULT_OPTIONS
+    settings.NEURONEKO_FAKE_PROVIDER_DEFAULTS
+    MODEL_PRESETS[model_id]
+    AIEndpoint.options
+With a 'seed' option, the output text and every random draw depend only on the seed
+and the prompt, so benchmark runs can be reproduced.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+DEFAULT_OPTIONS = {
+    "ttft_ms": 300,           # Time to first token
+    "tokens_per_second": 50,
+    "output_tokens": 200,     # Capped by max_tokens
+    "jitter": 0.2,            # Delays vary by up to +/- this fraction
+    "error_rate": 0.0,        # Probability of a 429 before the first token
+    "retry_after": 1.0,       # retry-after (seconds) sent with injected 429s
+    "stall_rate": 0.0,        # Probability of a stall somewhere in the stream
+    "stall_seconds": 30.0,
+    "disconnect_rate": 0.0,   # Probability the stream is cut off part way
+    "native_sampling": False, # Answer n > 1 requests with n samples in one stream
+    "seed": None,
+}
+
+# Model ids offered by the model importer; any other id uses the plain defaults
+MODEL_PRESETS = {
+    "fake-fast": {"ttft_ms": 50, "tokens_per_second": 500},
+    "fake-standard": {},
+    "fake-slow": {"ttft_ms": 2000, "tokens_per_second": 10, "output_tokens": 100},
+    "fake-flaky": {"error_rate": 0.3, "stall_rate": 0.1, "stall_seconds": 10.0, "disconnect_rate": 0.1},
+}
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+    "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+
+
+def get_options(endpoint, model_id: Optional[str] = None) -> Dict[str, Any]:
+    """The effective options for a fake endpoint and model."""
+    options = dict(DEFAULT_OPTIONS)
+    options.update(getattr(settings, 'NEURONEKO_FAKE_PROVIDER_DEFAULTS', {}))
+    options.update(MODEL_PRESETS.get(model_id, {}))
+    options.update(getattr(endpoint, "options", None) or {})
+    return options
+
+
+def count_tokens(messages: List[Dict[str, Any]], system: Optional[str] = None) -> int:
+    """The fake tokenizer: four characters per token."""
+    num_chars = sum(len(str(message.get("content", ""))) for message in messages) + len(system or "")
+    return max(1, num_chars // 4)
+
+
+def _rng(options: Dict[str, Any], messages: List[Dict[str, Any]]) -> random.Random:
+    if options.get("seed") is None:
+        return random.Random()
+    return random.Random(f"{options['seed']}:{json.dumps(messages, sort_keys=True, default=str)}")
+
+
+def _jittered(seconds: float, options: Dict[str, Any], rng: random.Random) -> float:
+    jitter = options.get("jitter") or 0.0
+    return max(0.0, seconds * (1.0 + rng.uniform(-jitter, jitter)))
+
+
+def _throttled_error(options: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "error",
+        "message": "API Error (status 429): fake provider injected rate limit",
+        "status_code": 429,
+        "retryable": True,
+        "retry_after": options.get("retry_after"),
+    }
+
+
+def _plan(options: Dict[str, Any], max_tokens: Optional[int], rng: random.Random) -> Dict[str, Any]:
+    """Draws the length, text and injected faults of one response."""
+    output_tokens = max(1, int(options.get("output_tokens") or 1))
+    if max_tokens:
+        output_tokens = min(output_tokens, max_tokens)
+    words = [rng.choice(WORDS) for _ in range(output_tokens)]
+    return {
+        "words": words,
+        "stop_reason": "max_tokens" if max_tokens and max_tokens < (options.get("output_tokens") or 0) else "end_turn",
+        "throttled": rng.random() < (options.get("error_rate") or 0.0),
+        "stall_at": rng.randrange(output_tokens) if rng.random() < (options.get("stall_rate") or 0.0) else None,
+        "disconnect_at": rng.randrange(output_tokens) if rng.random() < (options.get("disconnect_rate") or 0.0) else None,
+    }
+
+
+async def stream_completion(
+    endpoint,
+    ai_model_id: str,
+    messages: List[Dict[str, Any]],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+    max_tokens: Optional[int] = None,
+    system: Optional[str] = None,
+    n: Optional[int] = None,
+):
+    """Streams a synthetic response as standardized chunks."""
+    options = get_options(endpoint, ai_model_id)
+    rng = _rng(options, messages)
+    plan = _plan(options, max_tokens, rng)
+
+    await asyncio.sleep(_jittered(options["ttft_ms"] / 1000.0, options, rng))
+    if plan["throttled"]:
+        await on_chunk_callback(_throttled_error(options))
+        return
+    if options.get("native_sampling") and (n or 1) > 1:
+        await _stream_samples(options, rng, [plan] + [_plan(options, max_tokens, rng) for _ in range(n - 1)], count_tokens(messages, system), on_chunk_callback)
+        return
+    await on_chunk_callback({"type": "metadata", "data": {"id": f"fake_{uuid.uuid4().hex[:24]}", "input_tokens": count_tokens(messages, system)}})
+
+    # Tokens are scheduled against the clock; everything already due goes out in one delta,
+    # like a real provider batching tokens when it runs ahead of the reader.
+    interval = 1.0 / max(float(options["tokens_per_second"]), 0.001)
+    next_due = time.monotonic()
+    sent = 0
+    words = plan["words"]
+    while sent < len(words):
+        if plan["disconnect_at"] is not None and sent >= plan["disconnect_at"]:
+            await on_chunk_callback({"type": "error", "message": "Connection Error: fake provider closed the stream", "status_code": None, "retryable": True, "retry_after": None})
+            return
+        if plan["stall_at"] is not None and sent >= plan["stall_at"]:
+            plan["stall_at"] = None
+            await asyncio.sleep(float(options["stall_seconds"]))
+            next_due = time.monotonic()
+        now = time.monotonic()
+        due = sent + 1
+        while due < len(words) and next_due + interval * (due - sent) <= now:
+            due += 1
+        for stop_at in (plan["disconnect_at"], plan["stall_at"]):
+            if stop_at is not None and sent < stop_at < due:
+                due = stop_at # Fault points fall between deltas
+        text = " ".join(words[sent:due])
+        await on_chunk_callback({"type": "delta", "text_delta": text if sent == 0 else " " + text})
+        for _ in range(due - sent):
+            next_due += _jittered(interval, options, rng)
+        sent = due
+        delay = next_due - time.monotonic()
+        if delay > 0 and sent < len(words):
+            await asyncio.sleep(delay)
+
+    await on_chunk_callback({"type": "stop", "stop_reason": plan["stop_reason"], "usage": {"output_tokens": len(words)}})
+
+
+async def _stream_samples(options: Dict[str, Any], rng: random.Random, plans: List[Dict[str, Any]], input_tokens: int, on_chunk_callback):
+    """
+    Streams one sample per plan, a word of each in turn. Deltas and stops carry the sample's
+    index; the prompt is billed once, to sample 0. Only the 429 fault applies.
+    """
+    await on_chunk_callback({"type": "metadata", "data": {"id": f"fake_{uuid.uuid4().hex[:24]}"}})
+    interval = 1.0 / max(float(options["tokens_per_second"]), 0.001)
+    for position in range(max(len(plan["words"]) for plan in plans)):
+        for index, plan in enumerate(plans):
+            if position < len(plan["words"]):
+                word = plan["words"][position]
+                await on_chunk_callback({"type": "delta", "text_delta": word if position == 0 else " " + word, "sample": index})
+        await asyncio.sleep(_jittered(interval, options, rng))
+    for index, plan in enumerate(plans):
+        usage = {"input_tokens": input_tokens if index == 0 else 0, "output_tokens": len(plan["words"])}
+        await on_chunk_callback({"type": "stop", "stop_reason": plan["stop_reason"], "usage": usage, "sample": index})
+
+
+async def get_static_completion(
+    endpoint,
+    ai_model_id: str,
+    messages: List[Dict[str, Any]],
+    max_tokens: Optional[int] = None,
+    system: Optional[str] = None,
+) -> Dict[str, Any]:
+    """A synthetic non-streaming response, returned after the full generation time."""
+    options = get_options(endpoint, ai_model_id)
+    rng = _rng(options, messages)
+    plan = _plan(options, max_tokens, rng)
+    await asyncio.sleep(_jittered(options["ttft_ms"] / 1000.0, options, rng))
+    if plan["throttled"]:
+        error = _throttled_error(options)
+        error["type"] = "RateLimitError"
+        return {"id": None, "content": None, "role": "error", "model_used": ai_model_id, "stop_reason": "error", "usage": None, "error": error}
+    await asyncio.sleep(_jittered(len(plan["words"]) / max(float(options["tokens_per_second"]), 0.001), options, rng))
+    return {
+        "id": f"fake_{uuid.uuid4().hex[:24]}",
+        "content": " ".join(plan["words"]),
+        "role": "assistant",
+        "model_used": ai_model_id,
+        "stop_reason": plan["stop_reason"],
+        "usage": {"input_tokens": count_tokens(messages, system), "output_tokens": len(plan["words"])},
+        "error": None,
+    }
+
+
+def list_models() -> Dict[str, Any]:
+    return {"status": "success", "models": [{"id": model_id, "name": model_id.replace("-", " ").title()} for model_id in MODEL_PRESETS]}
+
+
+def test_endpoint(endpoint) -> Dict[str, Any]:
+    options = get_options(endpoint)
+    return {
+        "status": "success",
+        "message": "Fake provider is local; no network call was made.",
+        "details": {key: value for key, value in options.items() if value is not None},
+    }
+
+
+async def probe(endpoint) -> Dict[str, Any]:
+    """Health probe for the background prober: waits one TTFT and honours error_rate."""
+    options = get_options(endpoint)
+    rng = random.Random()
+    started_at = time.monotonic()
+    await asyncio.sleep(_jittered(options["ttft_ms"] / 1000.0, options, rng))
+    throttled = rng.random() < (options.get("error_rate") or 0.0)
+    return {
+        "ok": not throttled,
+        "latency": time.monotonic() - started_at,
+        "status_code": 429 if throttled else 200,
+        "throttled": throttled,
+        "requests_remaining": None,
+        "tokens_remaining": None,
+        "message": "Injected rate limit" if throttled else None,
+    }
@@ -30,19 +30,34 @@ class UserSettingsForm(forms.ModelForm):
             'chat_font_size': 'Select your preferred text size for chat messages.',
         }
 
+# Providers that work without an API key (local test providers, self-hosted servers)
+KEY_OPTIONAL_PROVIDERS = ('fake', 'replay', 'openai_compatible')
+
 class AIEndpointForm(forms.ModelForm):
     class Meta:
         model = AIEndpoint
-        fields = ['name', 'provider', 'apikey'] # Removed 'url', added 'provider'
+        fields = ['name', 'provider', 'base_url', 'tokenizer', 'apikey', 'requests_per_minute', 'tokens_per_minute', 'max_concurrency', 'options'] # Removed 'url', added 'provider'
         widgets = {
             'name': forms.TextInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
             'provider': forms.Select(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'base_url': forms.TextInput(attrs={'placeholder': 'http://localhost:8000/v1', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'tokenizer': forms.TextInput(attrs={'placeholder': 'Default', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
             'apikey': forms.PasswordInput(render_value=False, attrs={'placeholder': 'Enter API Key', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'requests_per_minute': forms.NumberInput(attrs={'placeholder': 'No limit', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'tokens_per_minute': forms.NumberInput(attrs={'placeholder': 'No limit', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'max_concurrency': forms.NumberInput(attrs={'placeholder': 'Default', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'options': forms.Textarea(attrs={'rows': 3, 'placeholder': '{}', 'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white font-mono focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
         }
         help_texts = {
             'name': "A friendly name for this API configuration (e.g., 'My Personal OpenAI').",
             'provider': "Select the AI provider for this endpoint.",
-            'apikey': "Your API key for this provider. Will be stored securely.",
+            'base_url': "OpenAI-compatible servers only: the server's base URL, including /v1.",
+            'tokenizer': "OpenAI-compatible servers only: 'server' (ask the server's /tokenize), 'hf:<repo>' (e.g. hf:Qwen/Qwen2.5-7B-Instruct), 'tiktoken:<encoding>' or 'chars'. Leave blank for the default.",
+            'apikey': "Your API key for this provider. Will be stored securely. Optional for OpenAI-compatible servers started without one.",
+            'requests_per_minute': "Optional. Requests beyond this rate wait in a queue instead of hitting provider 429s.",
+            'tokens_per_minute': "Optional. Input-token budget per minute, matching your provider tier.",
+            'max_concurrency': "Optional. Upper bound on simultaneous requests; lowered automatically while the provider returns 429s.",
+            'options': "Optional JSON. For the Fake provider: ttft_ms, tokens_per_second, output_tokens, jitter, error_rate, retry_after, stall_rate, stall_seconds, disconnect_rate, seed. For Replay: cassette_dir, speed.",
         }
 
     def __init__(self, *args, **kwargs):
@@ -53,6 +68,26 @@ class AIEndpointForm(forms.ModelForm):
              self.fields['apikey'].required = False # Not required if already set and editing
 
 
+    def clean_base_url(self):
+        base_url = (self.cleaned_data.get('base_url') or '').strip().rstrip('/')
+        if base_url and not base_url.startswith(('http://', 'https://')):
+            raise forms.ValidationError("The base URL must start with http:// or https://.")
+        return base_url or None
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('provider') == 'openai_compatible' and not cleaned_data.get('base_url'):
+            self.add_error('base_url', "OpenAI-compatible endpoints need the server's base URL.")
+        return cleaned_data
+
+    def clean_options(self):
+        options = self.cleaned_data.get('options')
+        if options in (None, ''):
+            return {}
+        if not isinstance(options, dict):
+            raise forms.ValidationError("Options must be a JSON object.")
+        return options
+
     def save(self, commit=True):
         instance = super().save(commit=False)
         if self.user:
@@ -66,6 +101,9 @@ class AIEndpointForm(forms.ModelForm):
         elif new_apikey:
             # If a new apikey is provided (either creating or explicitly changing)
             instance.apikey = new_apikey
+        if instance.provider in KEY_OPTIONAL_PROVIDERS and not instance.apikey:
+            # Local providers and servers may need no key; a placeholder keeps it past the "API key is missing" checks
+            instance.apikey = 'fake' if instance.provider in ('fake', 'replay') else 'none'
             
         if commit:
             instance.save()
@@ -79,7 +117,8 @@ class AIModelForm(forms.ModelForm):
             'default_temperature', 'default_max_tokens', 
             'input_cost_per_million_tokens', 'output_cost_per_million_tokens', 
             'cache_creation_cost_per_million_tokens', 'cache_read_cost_per_million_tokens',
-            'currency'
+            'currency',
+            'connect_timeout', 'first_token_timeout', 'idle_timeout', 'total_timeout'
         ]
         widgets = {
             'name': forms.TextInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
@@ -92,6 +131,10 @@ class AIModelForm(forms.ModelForm):
             'cache_creation_cost_per_million_tokens': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
             'cache_read_cost_per_million_tokens': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
             'currency': forms.TextInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm'}),
+            'connect_timeout': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm', 'min': '0', 'step': 'any'}),
+            'first_token_timeout': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm', 'min': '0', 'step': 'any'}),
+            'idle_timeout': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm', 'min': '0', 'step': 'any'}),
+            'total_timeout': forms.NumberInput(attrs={'class': 'mt-1 block w-full bg-gray-700 border border-gray-600 rounded-md shadow-sm py-2 px-3 text-white focus:outline-none focus:ring-blue-500 focus:border-blue-500 sm:text-sm', 'min': '0', 'step': 'any'}),
         }
         help_texts = {
             'name': "A friendly display name for this model (e.g., 'GPT-4 Turbo').",
@@ -104,6 +147,10 @@ class AIModelForm(forms.ModelForm):
             'cache_creation_cost_per_million_tokens': "Cost for 1 million cache creation tokens. Leave blank if not applicable.",
             'cache_read_cost_per_million_tokens': "Cost for 1 million cache read tokens. Leave blank if not applicable.",
             'currency': "Currency code for the cost (e.g., USD, EUR).",
+            'connect_timeout': "Seconds allowed to connect to the provider. Leave blank for the default, 0 to disable.",
+            'first_token_timeout': "Seconds allowed until the first token arrives. Leave blank for the default, 0 to disable.",
+            'idle_timeout': "Longest pause allowed between streamed chunks, in seconds. Leave blank for the default (none), 0 to disable.",
+            'total_timeout': "Seconds allowed for a whole generation attempt. Leave blank for the default (none), 0 to disable.",
         }
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,210 @@
+# chat/generation_registry.py
+"""
+Per-process registry of running generations, detached from the websockets that started them.
+
+A generation (one streamed reply, a set of samples or a fan-out) runs as a task owned by
+this registry, keyed by (user id, chat id), so a page reload or a dropped mobile
+connection does not kill it. Every frame the generation sends gets an offset and goes
+into a bounded ring buffer of NEURONEKO_GENERATION_BUFFER_FRAMES frames. It is then
+relayed to each attached websocket, each through its own StreamRelay, so a slow socket
+never holds the generation back.
+
+Offsets come from one process-wide counter, so they grow across generations. A client
+reattaching with the last offset it saw gets the buffered frames after it, then the live
+ones. Frames may be missing: evicted from the buffer, from an older generation, from
+before a restart, or because the client gave no offset (a reloaded page). In that case it
+gets a snapshot instead: the text streamed so far into each assistant message.
+
+A finished generation stays in the registry for NEURONEKO_GENERATION_RETENTION seconds,
+so a client that reconnects just after the end can still replay it.
+"""
+import asyncio
+import contextvars
+import itertools
+import time
+from collections import deque
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .stream_relay import StreamRelay
+
+# Frames that end the stream of one assistant message
+MESSAGE_END_FRAME_TYPES = ('stream_end', 'stream_cancelled', 'stream_error')
+
+_offsets = itertools.count()
+_generations: Dict[Tuple[Any, Any], "Generation"] = {}
+_background_tasks: set = set() # Keeps relay flushes referenced until they finish
+# The generation whose task (or a task it spawned) is running, for routing its frames
+_current: contextvars.ContextVar = contextvars.ContextVar('neuroneko_generation', default=None)
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+class Generation:
+    def __init__(self, key: Tuple[Any, Any]):
+        self.key = key
+        self.frames: deque = deque(maxlen=_setting('NEURONEKO_GENERATION_BUFFER_FRAMES', 2048))
+        self.last_offset = None
+        self.streamed_text: Dict[Any, str] = {} # assistant message id -> text streamed so far
+        self.ended_messages: set = set()
+        self.subscribers: List[StreamRelay] = []
+        self.cancel_flag = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, coroutine: Awaitable) -> asyncio.Task:
+        async def run():
+            _current.set(self) # Only affects this task's context (and the tasks it spawns)
+            return await coroutine
+
+        self.task = asyncio.get_running_loop().create_task(run())
+        self.task.add_done_callback(self._on_done)
+        return self.task
+
+    def cancel(self):
+        """Stops the generation; its stream handlers save the partial content on the way out."""
+        self.cancel_flag.set() # Also seen by a chunk already being handled
+        if self.is_running():
+            self.task.cancel()
+
+    def publish(self, frame: Dict[str, Any]):
+        """Buffers a frame and relays it to every attached socket. Never waits on client I/O."""
+        offset = next(_offsets)
+        frame = {**frame, 'offset': offset}
+        self.last_offset = offset
+        self.frames.append(frame)
+
+        message_id = frame.get('assistant_message_id')
+        if frame.get('type') == 'stream_chunk':
+            self.streamed_text[message_id] = self.streamed_text.get(message_id, "") + frame.get('text_delta', "")
+        elif frame.get('type') in MESSAGE_END_FRAME_TYPES and message_id is not None:
+            self.ended_messages.add(message_id)
+        for relay in self.subscribers:
+            relay.put(frame)
+
+    def snapshot_frames(self) -> List[Dict[str, Any]]:
+        """Frames that bring a client without usable offsets up to date."""
+        frames = [
+            {
+                'type': 'stream_snapshot',
+                'assistant_message_id': message_id,
+                'content': text,
+                'ended': message_id in self.ended_messages,
+                'offset': self.last_offset,
+            }
+            for message_id, text in self.streamed_text.items()
+        ]
+        # The UI state the live frames expect
+        frames.append({'type': 'lock_sidebar' if self.is_running() else 'unlock_sidebar', 'offset': self.last_offset})
+        return frames
+
+    def attach(self, send, on_overflow=None) -> StreamRelay:
+        """
+        Attaches the websocket that starts the generation, before its first frame.
+        Args:
+            send: Coroutine that writes one frame to the socket.
+            on_overflow: Coroutine that closes the socket if it falls too far behind (see stream_relay.py).
+        Returns:
+            The socket's relay, to be passed to detach().
+        """
+        relay = StreamRelay(send, on_overflow=on_overflow)
+        self.subscribers.append(relay)
+        return relay
+
+    def reattach(self, send, after_offset: Optional[int] = None, on_overflow=None) -> StreamRelay:
+        """
+        Attaches a (re)connecting websocket. Replays what it missed since `after_offset`,
+        or sends a snapshot when that is not possible, then relays live frames.
+        Args:
+            send: Coroutine that writes one frame to the socket.
+            after_offset: The last offset the client saw, or None.
+            on_overflow: Coroutine that closes the socket if it falls too far behind (see stream_relay.py).
+        Returns:
+            The socket's relay, to be passed to detach().
+        """
+        relay = StreamRelay(send, on_overflow=on_overflow)
+        oldest = self.frames[0]['offset'] if self.frames else None
+        missed = [frame for frame in self.frames if after_offset is not None and frame['offset'] > after_offset]
+        replayable = (
+            after_offset is not None and self.last_offset is not None
+            and oldest - 1 <= after_offset <= self.last_offset
+            # Interleaved samples barely merge; a replay that would overflow the relay gets the snapshot
+            and len(missed) < relay.max_pending // 2
+        )
+        relay.put({'type': 'generation_reattached', 'running': self.is_running(), 'replayed': replayable})
+        if replayable:
+            for frame in missed:
+                relay.put(frame)
+        elif self.last_offset is not None and (after_offset is not None or self.is_running()):
+            # A freshly loaded page already has a finished generation's result from the database
+            for frame in self.snapshot_frames():
+                relay.put(frame)
+        # Replay and subscription happen without yielding, so no live frame is lost or repeated
+        self.subscribers.append(relay)
+        return relay
+
+    async def detach(self, relay: StreamRelay):
+        if relay in self.subscribers:
+            self.subscribers.remove(relay)
+        await relay.close(timeout=1.0)
+
+    def _on_done(self, task: asyncio.Task):
+        self.finished_at = time.monotonic()
+        loop = task.get_loop()
+        # Attached sockets get the last frames flushed; their relays stop afterwards
+        subscribers, self.subscribers = self.subscribers, []
+        for relay in subscribers:
+            flush = loop.create_task(relay.close())
+            _background_tasks.add(flush)
+            flush.add_done_callback(_background_tasks.discard)
+        loop.call_later(_setting('NEURONEKO_GENERATION_RETENTION', 60.0), _forget, self)
+
+
+def _forget(generation: Generation):
+    if _generations.get(generation.key) is generation:
+        del _generations[generation.key]
+
+
+def get(user_id, chat_id) -> Optional[Generation]:
+    """The chat's running or recently finished generation, if any."""
+    return _generations.get((user_id, chat_id))
+
+
+def get_running(user_id, chat_id) -> Optional[Generation]:
+    generation = get(user_id, chat_id)
+    return generation if generation is not None and generation.is_running() else None
+
+
+def create(user_id, chat_id) -> Optional[Generation]:
+    """
+    Registers a new generation for the chat; start it with Generation.start().
+    Returns:
+        None if the chat already has a running generation.
+    """
+    if get_running(user_id, chat_id) is not None:
+        return None
+    generation = Generation((user_id, chat_id))
+    _generations[generation.key] = generation
+    return generation
+
+
+def current() -> Optional[Generation]:
+    """The generation the calling task belongs to, if any."""
+    return _current.get()
+
+
+def get_stats() -> Dict[str, Any]:
+    generations = list(_generations.values())
+    return {
+        "running": sum(1 for generation in generations if generation.is_running()),
+        "retained": sum(1 for generation in generations if not generation.is_running()),
+        "subscribers": sum(len(generation.subscribers) for generation in generations),
+        "buffered_frames": sum(len(generation.frames) for generation in generations),
+    }
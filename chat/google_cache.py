@@ -0,0 +1,204 @@
+# chat/google_cache.py
+"""
+Provider-side context caching for Google (Gemini) chat histories.
+
+Gemini reads a cached prefix only through an explicit CachedContent handle, so this
+module keeps a registry of handles and lets the Google adapter send just the uncached
+suffix of the conversation.
+
+Handles are grouped per chat lineage: endpoint, model, system prompt and first message.
+Within a lineage, each handle is identified by the hash of the exact prefix it holds,
+so each branch of a chat has its own handles. An edited or switched branch simply stops
+matching. A lineage keeps at most NEURONEKO_GOOGLE_CACHE_MAX_PER_CHAT handles. The
+least recently used is deleted at the provider when a new one is created. Handles
+expire after NEURONEKO_GOOGLE_CACHE_TTL seconds unless they are used, in which case
+their TTL is extended.
+
+Caches are created in the background from the stable prefix: everything except the
+newest message. The request that triggers creation is sent uncached and pays no extra
+latency. The next turn finds the handle. When the uncached suffix grows past
+NEURONEKO_GOOGLE_CACHE_REBUILD_TOKENS, a longer prefix is cached.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from google.genai import types
+
+from . import provider_clients
+
+# Keeps references to background tasks so they are not garbage collected mid-flight
+_background_tasks: set = set()
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def enabled() -> bool:
+    return _setting('NEURONEKO_GOOGLE_CACHE_ENABLED', True)
+
+
+def _ttl() -> float:
+    return float(_setting('NEURONEKO_GOOGLE_CACHE_TTL', 600))
+
+
+def estimate_tokens(items: List[Dict[str, str]], system: Optional[str] = None) -> int:
+    return (sum(len(item["text"]) for item in items) + len(system or "")) // 4
+
+
+def to_content(item: Dict[str, str]) -> types.Content:
+    return types.Content(role=item["role"], parts=[types.Part.from_text(text=item["text"])])
+
+
+def _prefix_hashes(model_id: str, system: Optional[str], items: List[Dict[str, str]]) -> List[str]:
+    """hashes[i] identifies the prompt prefix made of the system prompt and items[:i]."""
+    running = hashlib.sha256(json.dumps([model_id, system or ""]).encode("utf-8"))
+    hashes = [running.hexdigest()]
+    for item in items:
+        running.update(json.dumps([item["role"], item["text"]]).encode("utf-8"))
+        hashes.append(running.copy().hexdigest())
+    return hashes
+
+
+class CacheHandle:
+    def __init__(self, name: str, prefix_len: int, prefix_hash: str, tokens: int, expires_at: float):
+        self.name = name
+        self.prefix_len = prefix_len
+        self.prefix_hash = prefix_hash
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.last_used = time.monotonic()
+        self.refreshing = False
+
+
+class _Registry:
+    def __init__(self):
+        self.lineages: Dict[Tuple, List[CacheHandle]] = {}
+        self.pending: set = set() # (lineage, prefix_hash) being created
+
+    def alive(self, lineage: Tuple) -> List[CacheHandle]:
+        now = time.monotonic()
+        # A small margin so a handle does not expire between lookup and use
+        handles = [h for h in self.lineages.get(lineage, []) if h.expires_at - 5.0 > now]
+        if handles:
+            self.lineages[lineage] = handles
+        else:
+            self.lineages.pop(lineage, None)
+        return handles
+
+
+_registry = _Registry()
+
+
+def _lineage(endpoint, model_id: str, system: Optional[str], items: List[Dict[str, str]]) -> Tuple:
+    first = json.dumps([system or "", items[0]["role"], items[0]["text"]] if items else [system or ""])
+    return (endpoint.id, model_id, hashlib.sha256(first.encode("utf-8")).hexdigest())
+
+
+def lookup(endpoint, model_id: str, system: Optional[str], items: List[Dict[str, str]]) -> Optional[CacheHandle]:
+    """
+    The live handle holding the longest prefix of this prompt, leaving at least the newest
+    message uncached. Returns None if there is none.
+    """
+    if not items:
+        return None
+    hashes = _prefix_hashes(model_id, system, items)
+    best = None
+    for handle in _registry.alive(_lineage(endpoint, model_id, system, items)):
+        if handle.prefix_len < len(items) and hashes[handle.prefix_len] == handle.prefix_hash:
+            if best is None or handle.prefix_len > best.prefix_len:
+                best = handle
+    if best is not None:
+        best.last_used = time.monotonic()
+    return best
+
+
+def invalidate(endpoint, model_id: str, system: Optional[str], items: List[Dict[str, str]], handle: CacheHandle):
+    """Forgets a handle the provider rejected (e.g. deleted or expired early)."""
+    lineage = _lineage(endpoint, model_id, system, items)
+    _registry.lineages[lineage] = [h for h in _registry.lineages.get(lineage, []) if h is not handle]
+
+
+def _spawn(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def schedule_refresh(endpoint, model_id: str, system: Optional[str], items: List[Dict[str, str]], current: Optional[CacheHandle]):
+    """
+    Starts background work so the next turn has a good cache: extends the TTL of the handle
+    in use, or creates a handle for this prompt's stable prefix when none exists or the
+    uncached suffix has grown too long.
+    """
+    stable = items[:-1]
+    if not stable or estimate_tokens(stable, system) < _setting('NEURONEKO_GOOGLE_CACHE_MIN_TOKENS', 4096):
+        return
+    if current is not None:
+        suffix_tokens = estimate_tokens(stable[current.prefix_len:])
+        if suffix_tokens < _setting('NEURONEKO_GOOGLE_CACHE_REBUILD_TOKENS', 8192):
+            if current.expires_at - time.monotonic() < _ttl() / 2 and not current.refreshing:
+                current.refreshing = True
+                _spawn(_extend(endpoint, current))
+            return
+    lineage = _lineage(endpoint, model_id, system, items)
+    prefix_hash = _prefix_hashes(model_id, system, stable)[-1]
+    if (lineage, prefix_hash) in _registry.pending:
+        return
+    _registry.pending.add((lineage, prefix_hash))
+    _spawn(_create(endpoint, model_id, system, stable, lineage, prefix_hash))
+
+
+async def _create(endpoint, model_id: str, system: Optional[str], stable: List[Dict[str, str]], lineage: Tuple, prefix_hash: str):
+    try:
+        client = provider_clients.get_google_client(endpoint)
+        cached = await client.aio.caches.create(
+            model=model_id,
+            config=types.CreateCachedContentConfig(
+                contents=[to_content(item) for item in stable],
+                system_instruction=system or None,
+                ttl=f"{int(_ttl())}s",
+                display_name=f"neuroneko-{prefix_hash[:12]}",
+            ),
+        )
+        tokens = getattr(cached.usage_metadata, "total_token_count", None) or estimate_tokens(stable, system)
+        handle = CacheHandle(cached.name, len(stable), prefix_hash, tokens, time.monotonic() + _ttl())
+        handles = _registry.alive(lineage) + [handle]
+        handles.sort(key=lambda h: h.last_used, reverse=True)
+        keep = max(1, _setting('NEURONEKO_GOOGLE_CACHE_MAX_PER_CHAT', 2))
+        _registry.lineages[lineage] = handles[:keep]
+        for evicted in handles[keep:]:
+            await _delete(endpoint, evicted)
+        print(f"Created Google context cache {cached.name} ({tokens} tokens, {len(stable)} messages)")
+    except Exception as e:
+        # Too short for the model's minimum, unsupported model, quota...: the request path is unaffected
+        print(f"Could not create Google context cache: {type(e).__name__} {e}")
+    finally:
+        _registry.pending.discard((lineage, prefix_hash))
+
+
+async def _extend(endpoint, handle: CacheHandle):
+    try:
+        client = provider_clients.get_google_client(endpoint)
+        await client.aio.caches.update(name=handle.name, config=types.UpdateCachedContentConfig(ttl=f"{int(_ttl())}s"))
+        handle.expires_at = time.monotonic() + _ttl()
+    except Exception as e:
+        print(f"Could not extend Google context cache {handle.name}: {type(e).__name__} {e}")
+    finally:
+        handle.refreshing = False
+
+
+async def _delete(endpoint, handle: CacheHandle):
+    try:
+        await provider_clients.get_google_client(endpoint).aio.caches.delete(name=handle.name)
+    except Exception as e:
+        print(f"Could not delete Google context cache {handle.name}: {type(e).__name__} {e}")
+
+
+def get_stats() -> Dict[str, Any]:
+    handles = [h for lineage in list(_registry.lineages) for h in _registry.alive(lineage)]
+    return {"lineages": len(_registry.lineages), "handles": len(handles), "cached_tokens": sum(h.tokens for h in handles)}
@@ -0,0 +1,153 @@
+# chat/health.py
+"""
+Background health prober for AIEndpoints.
+
+A single asyncio task probes every endpoint that has an API key, concurrently, every
+NEURONEKO_HEALTH_PROBE_INTERVAL seconds using a cheap call (see api_client.probe_endpoint),
+and keeps a rolling window of latencies and failures per endpoint. The API config page,
+the provider status API and the endpoint router read this cached state instead of making
+live calls, so a throttled or broken key shows up before users hit it.
+
+The prober is started on ASGI lifespan startup, or lazily when the first websocket
+connects (Daphne does not send lifespan events).
+"""
+import asyncio
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import api_client # Module import: api_client -> endpoint_router -> health is circular
+from .models import AIEndpoint
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+class _EndpointHealth:
+    def __init__(self, window: int):
+        self.samples: deque = deque(maxlen=window) # (checked_at, ok, latency)
+        self.last_result: Optional[Dict[str, Any]] = None
+        self.last_checked: Optional[float] = None
+
+    def record(self, result: Dict[str, Any]):
+        self.last_checked = time.time()
+        self.last_result = result
+        self.samples.append((self.last_checked, result["ok"], result["latency"]))
+
+    def snapshot(self) -> Dict[str, Any]:
+        ok_latencies = [latency for _, ok, latency in self.samples if ok and latency is not None]
+        last = self.last_result or {}
+        error_rate = sum(1 for _, ok, _ in self.samples if not ok) / len(self.samples) if self.samples else None
+        return {
+            "healthy": bool(last.get("ok")) and not last.get("throttled"),
+            "throttled": bool(last.get("throttled")),
+            "last_checked": self.last_checked,
+            "last_error": last.get("message"),
+            "status_code": last.get("status_code"),
+            "requests_remaining": last.get("requests_remaining"),
+            "tokens_remaining": last.get("tokens_remaining"),
+            "latency_last": last.get("latency"),
+            "latency_median": statistics.median(ok_latencies) if ok_latencies else None,
+            "error_rate": error_rate,
+            "samples": len(self.samples),
+            "history": [round(latency, 3) if ok and latency is not None else None for _, ok, latency in self.samples],
+        }
+
+
+_health: Dict[Any, _EndpointHealth] = {}
+_health_lock = threading.Lock()
+_prober_task: Optional[asyncio.Task] = None
+
+
+def record_probe(endpoint_id, result: Dict[str, Any]):
+    with _health_lock:
+        health = _health.get(endpoint_id)
+        if health is None:
+            health = _EndpointHealth(_setting('NEURONEKO_HEALTH_HISTORY_SIZE', 30))
+            _health[endpoint_id] = health
+        health.record(result)
+
+
+def get_health(endpoint_id) -> Optional[Dict[str, Any]]:
+    """Cached health of one endpoint, or None if it has not been probed yet."""
+    with _health_lock:
+        health = _health.get(endpoint_id)
+        return health.snapshot() if health else None
+
+
+def get_stats(endpoint_ids=None) -> Dict[Any, Optional[Dict[str, Any]]]:
+    """Cached health keyed by endpoint id (None for endpoints not probed yet)."""
+    with _health_lock:
+        ids = set(endpoint_ids) if endpoint_ids is not None else set(_health)
+        return {endpoint_id: _health[endpoint_id].snapshot() if endpoint_id in _health else None for endpoint_id in ids}
+
+
+def forget(endpoint_id):
+    """Drops the history of a deleted endpoint."""
+    with _health_lock:
+        _health.pop(endpoint_id, None)
+
+
+@database_sync_to_async
+def _probe_targets():
+    endpoints = AIEndpoint.objects.exclude(apikey__isnull=True).exclude(apikey="")
+    known_ids = set(endpoints.values_list('id', flat=True))
+    with _health_lock:
+        for endpoint_id in [endpoint_id for endpoint_id in _health if endpoint_id not in known_ids]:
+            del _health[endpoint_id]
+    return list(endpoints)
+
+
+async def _probe_one(endpoint):
+    timeout = _setting('NEURONEKO_HEALTH_PROBE_TIMEOUT', 10.0)
+    try:
+        result = await asyncio.wait_for(api_client.probe_endpoint(endpoint), timeout=timeout)
+    except asyncio.TimeoutError:
+        result = {"ok": False, "latency": timeout, "status_code": None, "throttled": False, "message": f"Probe timed out after {timeout:.0f}s"}
+    record_probe(endpoint.id, result)
+
+
+async def probe_all():
+    """Probes every endpoint with an API key once, concurrently."""
+    endpoints = await _probe_targets()
+    await asyncio.gather(*(_probe_one(endpoint) for endpoint in endpoints), return_exceptions=True)
+
+
+async def _run_prober():
+    while True:
+        try:
+            await probe_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Endpoint health probe failed: {type(e).__name__} {e}")
+        await asyncio.sleep(_setting('NEURONEKO_HEALTH_PROBE_INTERVAL', 60.0))
+
+
+def ensure_started():
+    """Starts the background prober on the running event loop, if enabled and not running."""
+    global _prober_task
+    if not _setting('NEURONEKO_HEALTH_PROBE_ENABLED', True):
+        return
+    loop = asyncio.get_running_loop()
+    if _prober_task is not None and not _prober_task.done() and _prober_task.get_loop() is loop:
+        return
+    _prober_task = loop.create_task(_run_prober())
+
+
+async def stop():
+    """Cancels the background prober. Called on ASGI lifespan shutdown."""
+    global _prober_task
+    task, _prober_task = _prober_task, None
+    if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,24 @@
+# chat/lifespan.py
+"""
+ASGI lifespan handler. Servers that implement the lifespan protocol (e.g. Uvicorn,
+Hypercorn) call into this on startup and shutdown; Daphne does not, in which case
+provider_clients falls back to an atexit hook and the health prober is started by the
+first websocket connection.
+"""
+from . import health, provider_clients
+
+
+async def lifespan_app(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            health.ensure_started()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await health.stop()
+            try:
+                await provider_clients.aclose_all()
+            except Exception as e:
+                print(f"Error closing provider clients on shutdown: {e}")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
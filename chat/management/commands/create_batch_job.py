@@ -0,0 +1,49 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import batch
+from chat.models import AIModel, Chat, Folder, UserSettings
+
+
+class Command(BaseCommand):
+    help = "Creates a pending batch job: regenerate chat titles, or send one prompt to every chat in a folder."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['titles', 'folder_prompt'])
+        parser.add_argument('--user', required=True, help="Username owning the chats.")
+        parser.add_argument('--model', type=int, help="AIModel id (defaults to the user's default model).")
+        parser.add_argument('--chats', type=int, nargs='*', help="Chat ids for 'titles' (defaults to all of the user's chats).")
+        parser.add_argument('--folder', type=int, help="Folder id for 'folder_prompt'.")
+        parser.add_argument('--prompt', help="Prompt text for 'folder_prompt'.")
+        parser.add_argument('--system', help="Optional system prompt for 'folder_prompt'.")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['user']).first()
+        if user is None:
+            raise CommandError(f"No such user: {options['user']}")
+
+        if options['model']:
+            ai_model = AIModel.objects.filter(id=options['model'], endpoint__user=user).select_related('endpoint').first()
+        else:
+            user_settings = UserSettings.objects.filter(user=user).select_related('default_model__endpoint').first()
+            ai_model = user_settings.default_model if user_settings else None
+        if ai_model is None:
+            raise CommandError("No model given and the user has no default model.")
+
+        try:
+            if options['kind'] == 'titles':
+                chats = Chat.objects.filter(user=user).select_related('root_message')
+                if options['chats']:
+                    chats = chats.filter(id__in=options['chats'])
+                job = batch.create_title_job(user, ai_model, chats)
+            else:
+                if not options['folder'] or not options['prompt']:
+                    raise CommandError("'folder_prompt' needs --folder and --prompt.")
+                folder = Folder.objects.filter(id=options['folder'], user=user).first()
+                if folder is None:
+                    raise CommandError(f"No such folder: {options['folder']}")
+                job = batch.create_folder_prompt_job(user, ai_model, folder, options['prompt'], options['system'])
+        except batch.BatchError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f"Created batch job {job.id} with {len(job.items)} request(s) on {ai_model.name}. Run 'manage.py run_batch_jobs' to submit it."))
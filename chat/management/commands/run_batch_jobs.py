@@ -0,0 +1,24 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import batch
+
+
+class Command(BaseCommand):
+    help = "Submits pending batch jobs and polls submitted ones, writing finished results back to chats."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wait', action='store_true', help="Keep polling until no job is left in progress.")
+        parser.add_argument('--interval', type=float, default=None, help="Seconds between polls with --wait.")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or getattr(settings, 'NEURONEKO_BATCH_POLL_INTERVAL', 60)
+        while True:
+            remaining = batch.run_once()
+            if not remaining or not options['wait']:
+                break
+            self.stdout.write(f"{remaining} batch job(s) still processing; polling again in {interval:.0f}s.")
+            time.sleep(interval)
+        self.stdout.write(self.style.SUCCESS(f"Done. {remaining} batch job(s) still processing."))
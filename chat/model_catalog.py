@@ -0,0 +1,65 @@
+# chat/model_catalog.py
+"""
+TTL-cached catalog of the models each AIEndpoint offers.
+
+Listing models is a paginated network call per endpoint, so results are kept for
+NEURONEKO_MODEL_CATALOG_TTL seconds (keyed by endpoint id and API key, so changing the
+key refetches). get_catalog() fetches all of a user's endpoints concurrently.
+Only successful listings are cached; errors are retried on the next request.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Iterable
+
+from django.conf import settings
+
+from .api_client import get_models_from_provider
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+_cache: Dict[tuple, tuple] = {} # (endpoint id, api key) -> (fetched_at, result)
+_cache_lock = threading.Lock()
+
+
+async def get_models(endpoint, refresh: bool = False) -> Dict[str, Any]:
+    """
+    Returns the model listing for an endpoint ('status', 'models', ...), from cache when fresh.
+    The result carries 'fetched_at' (epoch seconds) so the UI can show its age.
+    Args:
+        endpoint: The AIEndpoint model instance.
+        refresh: Bypass the cache and refetch.
+    """
+    key = (endpoint.id, endpoint.apikey or "", getattr(endpoint, "base_url", None) or "")
+    if not refresh:
+        with _cache_lock:
+            cached = _cache.get(key)
+        if cached and time.time() - cached[0] < _setting('NEURONEKO_MODEL_CATALOG_TTL', 600):
+            return cached[1]
+
+    result = await get_models_from_provider(endpoint)
+    result = {**result, "fetched_at": time.time()}
+    if result.get("status") == "success":
+        with _cache_lock:
+            # Drop listings cached under the endpoint's previous API key or base URL
+            for stale_key in [k for k in _cache if k[0] == endpoint.id]:
+                del _cache[stale_key]
+            _cache[key] = (result["fetched_at"], result)
+    return result
+
+
+async def get_catalog(endpoints: Iterable, refresh: bool = False) -> Dict[Any, Dict[str, Any]]:
+    """Fetches the listings of several endpoints concurrently. Returns {endpoint id: result}."""
+    endpoints = list(endpoints)
+    results = await asyncio.gather(*(get_models(endpoint, refresh=refresh) for endpoint in endpoints))
+    return {endpoint.id: result for endpoint, result in zip(endpoints, results)}
+
+
+def invalidate(endpoint_id=None):
+    """Forgets cached listings for one endpoint, or all of them."""
+    with _cache_lock:
+        for key in [k for k in _cache if endpoint_id is None or k[0] == endpoint_id]:
+            del _cache[key]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User # Import User
 from django.db.models.signals import post_save
@@ -41,6 +42,9 @@ class AIEndpoint(models.Model):
         ('anthropic', 'Anthropic'),
         ('openai', 'OpenAI'),
         ('google', 'Google'),
+        ('openai_compatible', 'OpenAI-compatible server (vLLM, llama.cpp, ...)'),
+        ('fake', 'Fake (local synthetic, for testing)'),
+        ('replay', 'Replay (recorded cassettes, for testing)'),
         # ('custom', 'Custom API'), # For generic HTTP endpoints - can be added later
     ]
     provider = models.CharField(
@@ -49,6 +53,19 @@ class AIEndpoint(models.Model):
         default='anthropic',
         help_text="The AI provider for this endpoint."
     )
+    # Where an OpenAI-compatible server lives, e.g. http://vllm:8000/v1. Not a URLField: internal
+    # hostnames without a dot (docker services, bare hosts) must be accepted.
+    base_url = models.CharField(max_length=500, null=True, blank=True, help_text="Base URL of an OpenAI-compatible server, including /v1 (e.g. http://localhost:8000/v1).")
+    # How tokens are counted for context-window estimates on OpenAI-compatible servers (see utils.count_tokens)
+    tokenizer = models.CharField(max_length=255, null=True, blank=True, help_text="Token counting: 'server' (the server's /tokenize), 'hf:<repo>', 'tiktoken:<encoding>' or 'chars'. Blank uses NEURONEKO_OPENAI_COMPATIBLE_TOKENIZER.")
+    # Client-side rate limits, shared by every request to this endpoint (see rate_limiter.py).
+    # Blank means the NEURONEKO_RATE_LIMIT_* setting applies.
+    requests_per_minute = models.PositiveIntegerField(null=True, blank=True, help_text="Maximum requests per minute for this endpoint (blank for no limit).")
+    tokens_per_minute = models.PositiveIntegerField(null=True, blank=True, help_text="Maximum input tokens per minute for this endpoint (blank for no limit).")
+    max_concurrency = models.PositiveIntegerField(null=True, blank=True, help_text="Maximum concurrent requests; lowered automatically while the provider returns 429s.")
+    # Provider-specific settings; the fake provider reads its timing and fault injection from here (see fake_provider.py),
+    # the replay provider its cassette_dir and speed (see cassettes.py)
+    options = models.JSONField(default=dict, blank=True, help_text="Provider-specific options as a JSON object.")
 
     def __str__(self):
         return f"{self.name} ({self.user.username if self.user else 'System Default'}) - {self.get_provider_display()}"
@@ -66,6 +83,11 @@ class AIModel(models.Model):
     cache_creation_cost_per_million_tokens = models.DecimalField(max_digits=10, decimal_places=4, null=True, blank=True, help_text="Cost for 1 million cache creation tokens (e.g., 0.20 for $0.20/1M tokens)")
     cache_read_cost_per_million_tokens = models.DecimalField(max_digits=10, decimal_places=4, null=True, blank=True, help_text="Cost for 1 million cache read tokens (e.g., 0.10 for $0.10/1M tokens)")
     currency = models.CharField(max_length=3, default="USD", help_text="Currency of the cost (e.g., USD, EUR)")
+    # Timeout budgets in seconds (see chat/timeouts.py). Blank uses the NEURONEKO_TIMEOUT_* default; 0 disables.
+    connect_timeout = models.FloatField(null=True, blank=True, help_text="Seconds allowed to connect to the provider")
+    first_token_timeout = models.FloatField(null=True, blank=True, help_text="Seconds allowed until the first token arrives")
+    idle_timeout = models.FloatField(null=True, blank=True, help_text="Longest allowed pause between streamed chunks, in seconds")
+    total_timeout = models.FloatField(null=True, blank=True, help_text="Seconds allowed for a whole generation attempt")
 
     def __str__(self):
         return f"{self.name} ({self.endpoint.name if self.endpoint else 'No Endpoint'})"
@@ -127,6 +149,21 @@ class Message(models.Model):
     output_tokens = models.IntegerField(null=True, blank=True, help_text="Tokens in the output from the model for this message generation.")
     cache_creation_input_tokens = models.IntegerField(null=True, blank=True, help_text="Input tokens used for cache creation (Anthropic specific).")
     cache_read_input_tokens = models.IntegerField(null=True, blank=True, help_text="Input tokens read from cache (Anthropic specific).")
+    # The model that generated this message; siblings can come from different models (multi-model fan-out)
+    ai_model = models.ForeignKey(AIModel, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', help_text="The AI model that generated this message (blank: the chat's model).")
+    # OpenAI Responses API chaining (see api_client.py): the stored response that produced this message,
+    # and a hash of the conversation it covers, to detect edits that break the chain
+    provider_response_id = models.CharField(max_length=255, null=True, blank=True, help_text="Provider-side stored response id (OpenAI Responses API).")
+    provider_response_context_hash = models.CharField(max_length=64, null=True, blank=True, help_text="Hash of the conversation covered by provider_response_id.")
+    # Latency telemetry of the streamed generation that produced this message (see telemetry.py)
+    endpoint_used = models.ForeignKey(AIEndpoint, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', help_text="The endpoint that served this generation.")
+    queue_wait_ms = models.IntegerField(null=True, blank=True, help_text="Time spent waiting for the endpoint's rate limiter.")
+    time_to_first_token_ms = models.IntegerField(null=True, blank=True, help_text="Time from request to first token, including queue wait.")
+    inter_token_p50_ms = models.IntegerField(null=True, blank=True, help_text="Median gap between streamed chunks.")
+    inter_token_p95_ms = models.IntegerField(null=True, blank=True, help_text="95th percentile gap between streamed chunks.")
+    inter_token_p99_ms = models.IntegerField(null=True, blank=True, help_text="99th percentile gap between streamed chunks.")
+    total_duration_ms = models.IntegerField(null=True, blank=True, help_text="Total duration of the generation.")
+    output_tokens_per_second = models.FloatField(null=True, blank=True, help_text="Output tokens per second after the first token.")
 
     def save(self, *args, **kwargs):
         if self.active_child and self.active_child.parent != self:
@@ -137,6 +174,24 @@ class Message(models.Model):
     def __str__(self):
         return f"{self.role}: {self.message[:50]}... (Chat: {self.chat.title})"
 
+    def get_telemetry(self):
+        """
+        Returns the latency telemetry recorded for this message's generation,
+        or None if it was not produced by a streamed generation.
+        """
+        if self.total_duration_ms is None:
+            return None
+        return {
+            'endpoint_used_id': self.endpoint_used_id,
+            'queue_wait_ms': self.queue_wait_ms,
+            'time_to_first_token_ms': self.time_to_first_token_ms,
+            'inter_token_p50_ms': self.inter_token_p50_ms,
+            'inter_token_p95_ms': self.inter_token_p95_ms,
+            'inter_token_p99_ms': self.inter_token_p99_ms,
+            'total_duration_ms': self.total_duration_ms,
+            'output_tokens_per_second': self.output_tokens_per_second,
+        }
+
     def get_cost_details(self):
         """
         Calculates the cost of this message based on its token counts and the AI model's rates.
@@ -148,7 +203,7 @@ class Message(models.Model):
                 self.cache_read_input_tokens is not None):
             return None
 
-        ai_model = self.chat.ai_model_used
+        ai_model = self.ai_model or self.chat.ai_model_used # Older messages did not record their model
         if not ai_model:
             return None # Cannot calculate cost without model rates
 
@@ -162,7 +217,8 @@ class Message(models.Model):
             'cache_creation_cost': 0.0,
             'cache_read_cost': 0.0,
             'total_cost': 0.0,
-            'currency': ai_model.currency or "USD"
+            'currency': ai_model.currency or "USD",
+            'model_name': ai_model.name,
         }
 
         cost_calculated = False
@@ -226,6 +282,65 @@ class Idea(models.Model):
         verbose_name = "Saved Idea"
         verbose_name_plural = "Saved Ideas"
 
+class BatchJob(models.Model):
+    """
+    A bulk offline job run through a provider batch API (see batch.py).
+    Each item in `items` is one request: {"custom_id", "chat_id", ...}.
+    """
+    KIND_CHOICES = [
+        ('chat_titles', 'Regenerate chat titles'),
+        ('folder_prompt', 'Run a prompt across a folder'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'), # Created, not yet submitted
+        ('submitted', 'Submitted'), # Provider is processing it
+        ('applying', 'Applying'), # Results being written back by one poller
+        ('completed', 'Completed'), # Results written back
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='batch_jobs', help_text="The user who owns this job")
+    ai_model = models.ForeignKey(AIModel, on_delete=models.SET_NULL, null=True, blank=True, help_text="The model the batch runs on")
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    prompt_text = models.TextField(blank=True, default='', help_text="Prompt sent to every chat (folder_prompt jobs)")
+    items = models.JSONField(default=list, help_text="One entry per request, keyed by custom_id")
+    provider_batch_id = models.CharField(max_length=255, null=True, blank=True, help_text="Batch id returned by the provider")
+    provider_input_file_id = models.CharField(max_length=255, null=True, blank=True, help_text="Uploaded input file (OpenAI)")
+    succeeded_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    input_tokens = models.IntegerField(default=0)
+    output_tokens = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.get_kind_display()} ({len(self.items)} requests) - {self.status}"
+
+    def get_cost_details(self):
+        """
+        Estimated cost of the job's recorded usage at the model's rates, with the
+        batch discount (NEURONEKO_BATCH_PRICE_FACTOR) applied.
+        """
+        if not self.ai_model or self.ai_model.input_cost_per_million_tokens is None or self.ai_model.output_cost_per_million_tokens is None:
+            return None
+        factor = getattr(settings, 'NEURONEKO_BATCH_PRICE_FACTOR', 0.5)
+        input_cost = (self.input_tokens / 1_000_000.0) * float(self.ai_model.input_cost_per_million_tokens) * factor
+        output_cost = (self.output_tokens / 1_000_000.0) * float(self.ai_model.output_cost_per_million_tokens) * factor
+        return {
+            'input_cost': input_cost,
+            'output_cost': output_cost,
+            'total_cost': input_cost + output_cost,
+            'price_factor': factor,
+            'currency': self.ai_model.currency or "USD",
+        }
+
+    class Meta:
+        ordering = ['-created_at']
+
+
 @receiver(post_save, sender=User)
 def create_user_settings(sender, instance, created, **kwargs):
     """
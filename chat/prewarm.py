@@ -0,0 +1,86 @@
+# chat/prewarm.py
+"""
+Pre-opens pooled provider connections for the model a chat is about to use.
+
+When a chat websocket connects, and when the chat's model is switched, the consumer warms
+that model's endpoint. A cheap authenticated request (api_client.probe_endpoint) goes
+through the pooled clients of provider_clients.py, so DNS, TCP and TLS are paid before
+the first message rather than during its time-to-first-token. While the socket stays open
+the endpoint is touched again every NEURONEKO_PREWARM_INTERVAL seconds. That keeps it
+below the pool's keepalive expiry, so the connection is not dropped as idle.
+
+Endpoints probed recently (by another socket, or by the health prober in health.py) are
+not probed again. Warm-up results are recorded as health probes.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from django.conf import settings
+
+from . import api_client, health
+
+# Providers without a remote connection to warm
+LOCAL_PROVIDERS = ('fake', 'replay')
+
+_last_warmed: Dict[Any, float] = {} # endpoint id -> time.time() of the last warm-up started
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def enabled() -> bool:
+    return _setting('NEURONEKO_PREWARM_CONNECTIONS', True)
+
+
+def _interval() -> float:
+    return float(_setting('NEURONEKO_PREWARM_INTERVAL', 60.0))
+
+
+def _recently_touched(endpoint) -> bool:
+    cutoff = time.time() - _interval()
+    probed = (health.get_health(endpoint.id) or {}).get("last_checked")
+    return _last_warmed.get(endpoint.id, 0) > cutoff or (probed is not None and probed > cutoff)
+
+
+async def warm(endpoint) -> bool:
+    """
+    Opens (or refreshes) a pooled connection to the endpoint unless it was touched recently.
+    Returns:
+        True if a warm-up request was made and succeeded.
+    """
+    if endpoint is None or endpoint.provider in LOCAL_PROVIDERS or not endpoint.apikey:
+        return False
+    if _recently_touched(endpoint):
+        return False
+    _last_warmed[endpoint.id] = time.time() # Claimed before awaiting, so concurrent sockets do not all probe
+    timeout = _setting('NEURONEKO_HEALTH_PROBE_TIMEOUT', 10.0)
+    try:
+        result = await asyncio.wait_for(api_client.probe_endpoint(endpoint), timeout=timeout)
+    except asyncio.TimeoutError:
+        result = {"ok": False, "latency": timeout, "status_code": None, "throttled": False, "message": f"Warm-up timed out after {timeout:.0f}s"}
+    health.record_probe(endpoint.id, result)
+    if not result["ok"]:
+        print(f"Could not pre-open a connection to endpoint {endpoint.id}: {result.get('message')}")
+    return result["ok"]
+
+
+async def keep_warm(load_endpoint: Callable[[], Awaitable[Optional[Any]]]):
+    """
+    Warms the endpoint returned by `load_endpoint` now and then every interval, until cancelled.
+    The endpoint is reloaded each round, so a model switch is picked up.
+    """
+    while True:
+        try:
+            await warm(await load_endpoint())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Connection warm-up failed: {type(e).__name__} {e}")
+        await asyncio.sleep(_interval())
+
+
+def forget(endpoint_id):
+    """Drops the warm-up bookkeeping of a deleted endpoint."""
+    _last_warmed.pop(endpoint_id, None)
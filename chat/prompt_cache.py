@@ -0,0 +1,179 @@
+# chat/prompt_cache.py
+"""
+Automatic placement of Anthropic prompt-cache breakpoints (cache_control blocks).
+
+Anthropic allows up to MAX_BREAKPOINTS breakpoints per request. A breakpoint writes
+the prompt prefix ending at its block to the cache. A later request reads that entry
+when one of its own breakpoints sits at or shortly after the same prefix (the API
+looks back about LOOKBACK_BLOCKS blocks). For a chat's active path, in priority order:
+
+1. Last message. Caches the whole prompt, so the next turn reads everything but the
+   new exchange.
+2. System prompt. Stable for the whole chat and shared by the user's other chats.
+3. Previous user message. Where the previous turn wrote; reads it explicitly.
+4. Anchor. A stride-aligned older message that moves only every ANCHOR_STRIDE messages.
+   After a branch switch or regeneration deep in a long chat, the recent prefix has
+   changed and lies beyond the lookback window. The anchor is still a cache hit.
+
+A manually pinned Chat.cache_until_message already in the history keeps its
+breakpoint and counts towards the maximum. Prefixes shorter than the model's minimum
+cacheable length are not marked, since they would not be cached anyway.
+
+The cache TTL matters because every write costs more than a plain input token, and
+the write only pays off if it is read before it expires. When the gap between the
+chat's last two requests exceeded the TTL, the rolling breakpoints (1 and 3) are
+skipped. The stable ones (2 and 4) stay, and use NEURONEKO_PROMPT_CACHE_STABLE_TTL
+(e.g. "1h") when set. A chat whose prefix was primed while the user was typing (see
+cache_prewarm.py) counts as warm, so the send places the breakpoint that reads it.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+MAX_BREAKPOINTS = 4
+LOOKBACK_BLOCKS = 20
+ANCHOR_STRIDE = 16
+DEFAULT_TTL_SECONDS = 300 # The default 'ephemeral' TTL
+TTL_SECONDS = {"5m": 300, "1h": 3600}
+MIN_CACHEABLE_TOKENS = 1024
+MIN_CACHEABLE_TOKENS_HAIKU = 2048
+
+
+def enabled() -> bool:
+    return getattr(settings, 'NEURONEKO_PROMPT_CACHE_AUTO', True)
+
+
+def _min_cacheable_tokens(model_id: str) -> int:
+    return MIN_CACHEABLE_TOKENS_HAIKU if "haiku" in (model_id or "").lower() else MIN_CACHEABLE_TOKENS
+
+
+def _estimate_tokens(message: Dict[str, Any]) -> int:
+    content = message.get("content")
+    if isinstance(content, list):
+        return sum(len(block.get("text", "")) for block in content if isinstance(block, dict)) // 4
+    return len(content or "") // 4
+
+
+def _has_breakpoint(message: Dict[str, Any]) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(isinstance(block, dict) and "cache_control" in block for block in content)
+
+
+def _mark(message: Dict[str, Any], ttl: Optional[str]):
+    content = message.get("content")
+    if not isinstance(content, list):
+        content = [{"type": "text", "text": content or ""}]
+        message["content"] = content
+    cache_control = {"type": "ephemeral"}
+    if ttl:
+        cache_control["ttl"] = ttl
+    content[-1]["cache_control"] = cache_control
+
+
+def _is_warm(timestamps: List[Optional[datetime]], now: datetime, primed_at: Optional[datetime] = None) -> bool:
+    """
+    Whether the chat's turns come often enough for rolling breakpoints to be read
+    before they expire: the gap since the previous request (approximated by the
+    second-to-last message on the path, or the last priming request) is within the default TTL.
+    """
+    if primed_at is not None and (now - primed_at).total_seconds() <= DEFAULT_TTL_SECONDS:
+        return True
+    if len(timestamps) < 3 or timestamps[-2] is None:
+        return True # New chats: the next turn usually follows quickly
+    return (now - timestamps[-2]).total_seconds() <= DEFAULT_TTL_SECONDS
+
+
+def plan_breakpoints(history: List[Dict[str, Any]], timestamps: List[Optional[datetime]], model_id: str, now: Optional[datetime] = None, primed_at: Optional[datetime] = None) -> Dict[int, Optional[str]]:
+    """
+    Chooses where to put breakpoints.
+    Args:
+        history: Formatted messages (role/content blocks), oldest first.
+        timestamps: created_at of each message in `history` (None if unknown).
+        model_id: The model's id, for its minimum cacheable length.
+        primed_at: When the chat's prefix was last primed (see cache_prewarm.py), if ever.
+    Returns:
+        A dict of message index -> TTL ("1h", or None for the default) for the new breakpoints.
+    """
+    count = len(history)
+    if count == 0:
+        return {}
+    now = now or timezone.now()
+    stable_ttl = getattr(settings, 'NEURONEKO_PROMPT_CACHE_STABLE_TTL', None)
+    if stable_ttl not in TTL_SECONDS:
+        stable_ttl = None
+
+    prefix_tokens = []
+    total = 0
+    for message in history:
+        total += _estimate_tokens(message)
+        prefix_tokens.append(total)
+    minimum = _min_cacheable_tokens(model_id)
+    existing = {index for index, message in enumerate(history) if _has_breakpoint(message)}
+    warm = _is_warm(timestamps, now, primed_at)
+
+    user_indices = [index for index, message in enumerate(history) if message.get("role") == "user"]
+    previous_user = user_indices[-2] if len(user_indices) >= 2 else None
+    anchor = None
+    if count - 1 > LOOKBACK_BLOCKS:
+        # Latest stride boundary outside the lookback window of the last message
+        anchor = ((count - 1 - LOOKBACK_BLOCKS) // ANCHOR_STRIDE) * ANCHOR_STRIDE - 1
+        if anchor < 1:
+            anchor = None
+
+    candidates = []
+    if warm:
+        candidates.append((count - 1, None))
+    if history[0].get("role") == "system":
+        candidates.append((0, stable_ttl))
+    if warm and previous_user is not None:
+        candidates.append((previous_user, None))
+    if anchor is not None:
+        candidates.append((anchor, stable_ttl))
+
+    plan: Dict[int, Optional[str]] = {}
+    budget = MAX_BREAKPOINTS - len(existing)
+    for index, ttl in candidates:
+        if budget <= 0:
+            break
+        if index in existing or index in plan or prefix_tokens[index] < minimum:
+            continue
+        plan[index] = ttl
+        budget -= 1
+
+    # Longer-TTL breakpoints must come before shorter ones; downgrade any that would not
+    short_positions = [index for index in existing] + [index for index, ttl in plan.items() if ttl is None]
+    for index, ttl in plan.items():
+        if ttl and any(short < index for short in short_positions):
+            plan[index] = None
+    return plan
+
+
+def apply_breakpoints(history: List[Dict[str, Any]], timestamps: List[Optional[datetime]], model_id: str, primed_at: Optional[datetime] = None) -> List[int]:
+    """
+    Adds automatic breakpoints to `history` in place.
+    Returns:
+        The indices of the messages that received one.
+    """
+    plan = plan_breakpoints(history, timestamps, model_id, primed_at=primed_at)
+    for index, ttl in plan.items():
+        _mark(history[index], ttl)
+    return sorted(plan)
+
+
+def mark_for_priming(history: List[Dict[str, Any]], model_id: str) -> bool:
+    """
+    Puts a breakpoint on the last message of `history` in place, so a request made with it
+    writes the whole prefix to the cache (see cache_prewarm.py).
+    Returns:
+        False if the prefix is too short to be cached or no breakpoint is left.
+    """
+    if not history or sum(_estimate_tokens(message) for message in history) < _min_cacheable_tokens(model_id):
+        return False
+    if _has_breakpoint(history[-1]):
+        return True
+    if sum(1 for message in history if _has_breakpoint(message)) >= MAX_BREAKPOINTS:
+        return False
+    _mark(history[-1], None)
+    return True
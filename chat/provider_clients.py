@@ -0,0 +1,254 @@
+# chat/provider_clients.py
+"""
+Process-wide registry of warm, reusable provider clients.
+
+Every AIEndpoint gets one set of HTTP and SDK clients, keyed by the endpoint id, its API
+key and its base URL. Building an SDK client (and the TLS handshake of its first request)
+is paid once per endpoint instead of once per message. Changing an endpoint's API key or
+base URL simply produces a new key in the registry; the stale clients are closed.
+
+SDK-level retries are disabled; retries and circuit breaking are handled in resilience.py.
+
+Async clients are bound to the event loop that created them. If a caller shows up
+from a different loop (e.g. async_to_sync under a WSGI server), a fresh set of async
+clients is built for that loop.
+
+The connect timeout can be tightened per request through the `connect_timeout` context
+variable (set by timeouts.py from the model's budget); a request hook applies it.
+"""
+import asyncio
+import atexit
+import contextvars
+import importlib.util
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import anthropic
+import httpx
+from anthropic import AsyncAnthropic
+from django.conf import settings
+from google import genai
+from google.genai import types
+from openai import OpenAI, AsyncOpenAI
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def _http2_enabled() -> bool:
+    # HTTP/2 needs the optional 'h2' package; silently fall back to HTTP/1.1 without it.
+    if not _setting('NEURONEKO_PROVIDER_HTTP2', False):
+        return False
+    return importlib.util.find_spec('h2') is not None
+
+
+# Connect timeout (seconds) for requests sent from the current context; None keeps the client default
+connect_timeout: contextvars.ContextVar = contextvars.ContextVar('neuroneko_connect_timeout', default=None)
+
+
+def _apply_connect_timeout(request: httpx.Request):
+    seconds = connect_timeout.get()
+    if seconds is not None:
+        # The SDKs set a per-request timeout; only its connect part is overridden
+        timeout = dict(request.extensions.get("timeout") or {})
+        timeout["connect"] = seconds
+        request.extensions["timeout"] = timeout
+
+
+async def _apply_connect_timeout_async(request: httpx.Request):
+    _apply_connect_timeout(request)
+
+
+def _client_kwargs(is_async: bool = False) -> Dict[str, Any]:
+    """Shared httpx client configuration (connection limits, keepalive, timeouts)."""
+    return {
+        "event_hooks": {"request": [_apply_connect_timeout_async if is_async else _apply_connect_timeout]},
+        "verify": _setting('NEURONEKO_PROVIDER_SSL_VERIFY', True),
+        "http2": _http2_enabled(),
+        "limits": httpx.Limits(
+            max_connections=_setting('NEURONEKO_PROVIDER_MAX_CONNECTIONS', 100),
+            max_keepalive_connections=_setting('NEURONEKO_PROVIDER_MAX_KEEPALIVE_CONNECTIONS', 20),
+            keepalive_expiry=_setting('NEURONEKO_PROVIDER_KEEPALIVE_EXPIRY', 120.0),
+        ),
+        "timeout": httpx.Timeout(
+            _setting('NEURONEKO_PROVIDER_READ_TIMEOUT', 600.0),
+            connect=_setting('NEURONEKO_PROVIDER_CONNECT_TIMEOUT', 10.0),
+        ),
+    }
+
+
+class _EndpointClients:
+    """
+    The warm clients belonging to a single (endpoint id, api key, base url) triple.
+    Sync clients are shared by all threads; async clients belong to one event loop.
+    """
+    def __init__(self, provider: str, api_key: str, base_url: Optional[str] = None):
+        self.provider = provider
+        self.api_key = api_key
+        self.base_url = base_url # None means the SDK's default (the provider's public API)
+        self._lock = threading.RLock()
+        self._sync_clients: Dict[str, Any] = {}
+        self._async_clients: Dict[str, Any] = {}
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def sync_client(self, name: str, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            client = self._sync_clients.get(name)
+            if client is None:
+                client = factory()
+                self._sync_clients[name] = client
+            return client
+
+    def async_client(self, name: str, factory: Callable[[], Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._async_loop is not loop:
+                # Connections of the previous loop cannot be reused (or awaited) here; drop them.
+                self._async_clients = {}
+                self._async_loop = loop
+            client = self._async_clients.get(name)
+            if client is None:
+                client = factory()
+                self._async_clients[name] = client
+            return client
+
+    def close_sync(self):
+        with self._lock:
+            http_client = self._sync_clients.pop('http', None)
+            self._sync_clients = {}
+        if http_client is not None:
+            try:
+                http_client.close()
+            except Exception as e:
+                print(f"Error closing pooled HTTP client: {e}")
+
+    async def aclose(self):
+        with self._lock:
+            same_loop = self._async_loop is asyncio.get_running_loop()
+            http_client = self._async_clients.pop('http', None)
+            self._async_clients = {}
+            self._async_loop = None
+        if http_client is not None and same_loop:
+            try:
+                await http_client.aclose()
+            except Exception as e:
+                print(f"Error closing pooled async HTTP client: {e}")
+        self.close_sync()
+
+
+_registry: Dict[Tuple[Optional[int], str, str], _EndpointClients] = {}
+_registry_lock = threading.Lock()
+
+
+def endpoint_base_url(endpoint) -> Optional[str]:
+    """The endpoint's custom base URL without a trailing slash, or None for the provider default."""
+    base_url = (getattr(endpoint, "base_url", None) or "").strip().rstrip("/")
+    return base_url or None
+
+
+def _entry_for(endpoint) -> _EndpointClients:
+    key = (endpoint.id, endpoint.apikey or "", endpoint_base_url(endpoint) or "")
+    with _registry_lock:
+        entry = _registry.get(key)
+        if entry is not None:
+            return entry
+        # Any other entry for the same endpoint id was built for an old API key or URL.
+        stale_entries = [_registry.pop(k) for k in list(_registry) if k[0] == endpoint.id]
+        entry = _EndpointClients(provider=endpoint.provider, api_key=endpoint.apikey or "", base_url=endpoint_base_url(endpoint))
+        _registry[key] = entry
+    for stale_entry in stale_entries:
+        stale_entry.close_sync()
+    return entry
+
+
+def get_http_client(endpoint) -> httpx.Client:
+    """Returns the pooled synchronous httpx client for an AIEndpoint."""
+    return _entry_for(endpoint).sync_client('http', lambda: httpx.Client(**_client_kwargs()))
+
+
+def get_async_http_client(endpoint) -> httpx.AsyncClient:
+    """Returns the pooled httpx.AsyncClient for an AIEndpoint (bound to the running loop)."""
+    return _entry_for(endpoint).async_client('http', lambda: httpx.AsyncClient(**_client_kwargs(is_async=True)))
+
+
+def get_anthropic_client(endpoint) -> anthropic.Anthropic:
+    entry = _entry_for(endpoint)
+    return entry.sync_client(
+        'anthropic',
+        lambda: anthropic.Anthropic(api_key=entry.api_key, http_client=get_http_client(endpoint), max_retries=0)
+    )
+
+
+def get_async_anthropic_client(endpoint) -> AsyncAnthropic:
+    entry = _entry_for(endpoint)
+    return entry.async_client(
+        'anthropic',
+        lambda: AsyncAnthropic(api_key=entry.api_key, http_client=get_async_http_client(endpoint), max_retries=0)
+    )
+
+
+def get_openai_client(endpoint) -> OpenAI:
+    entry = _entry_for(endpoint)
+    return entry.sync_client(
+        'openai',
+        lambda: OpenAI(api_key=entry.api_key, base_url=entry.base_url, http_client=get_http_client(endpoint), max_retries=0)
+    )
+
+
+def get_async_openai_client(endpoint) -> AsyncOpenAI:
+    entry = _entry_for(endpoint)
+    return entry.async_client(
+        'openai',
+        lambda: AsyncOpenAI(api_key=entry.api_key, base_url=entry.base_url, http_client=get_async_http_client(endpoint), max_retries=0)
+    )
+
+
+def get_google_client(endpoint) -> genai.Client:
+    """
+    Returns a pooled genai.Client. Inside an event loop, its `.aio` surface uses the
+    pooled async httpx client; from sync code only the sync surface is wired up.
+    """
+    entry = _entry_for(endpoint)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return entry.sync_client(
+            'google',
+            lambda: genai.Client(
+                api_key=entry.api_key,
+                http_options=types.HttpOptions(httpx_client=get_http_client(endpoint)),
+            )
+        )
+    return entry.async_client(
+        'google',
+        lambda: genai.Client(
+            api_key=entry.api_key,
+            http_options=types.HttpOptions(
+                httpx_client=get_http_client(endpoint),
+                httpx_async_client=get_async_http_client(endpoint),
+            ),
+        )
+    )
+
+
+async def aclose_all():
+    """Closes every pooled client. Called on ASGI lifespan shutdown."""
+    with _registry_lock:
+        entries = list(_registry.values())
+        _registry.clear()
+    for entry in entries:
+        await entry.aclose()
+
+
+def close_all():
+    """Closes the pooled sync clients. Async clients die with their event loop."""
+    with _registry_lock:
+        entries = list(_registry.values())
+        _registry.clear()
+    for entry in entries:
+        entry.close_sync()
+
+
+# Servers without ASGI lifespan support (e.g. Daphne) never send a shutdown event.
+atexit.register(close_all)
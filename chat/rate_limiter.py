@@ -0,0 +1,257 @@
+# chat/rate_limiter.py
+"""
+Process-wide request limiter per AIEndpoint.
+
+Each endpoint gets a requests-per-minute bucket, an input-tokens-per-minute bucket
+(debited with the input-token estimate up front and corrected with the real input
+usage afterwards; output tokens are not counted)
+and an AIMD concurrency window: the window halves when the provider answers 429 and
+grows back by roughly one slot per window's worth of successful requests.
+
+Requests that cannot start immediately wait in FIFO order; the optional `on_queued`
+callback is told their queue position so the UI can show it instead of an error.
+Limits come from the AIEndpoint fields, falling back to the NEURONEKO_RATE_LIMIT_*
+settings; a limit of None means unlimited.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+AIMD_DECREASE_FACTOR = 0.5
+MIN_CONCURRENCY = 1.0
+MAX_WAIT_SLICE = 1.0  # waiters re-check the limits at least this often
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def estimate_input_tokens(messages: List[Dict[str, Any]], system_prompt: Any = None) -> int:
+    """
+    Cheap local estimate of a request's input tokens (~4 characters per token).
+    Provider token-counting endpoints are a network round trip, too slow for admission control.
+    """
+    total_chars = 0
+    for message in messages:
+        content = message.get("content")
+        total_chars += len(content) if isinstance(content, str) else len(json.dumps(content, default=str))
+    if system_prompt:
+        total_chars += len(system_prompt) if isinstance(system_prompt, str) else len(json.dumps(system_prompt, default=str))
+    return max(1, total_chars // 4)
+
+
+class _TokenBucket:
+    """A bucket holding up to `per_minute` units, refilled continuously."""
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 if available now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity) # Oversized requests only need a full bucket
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float, now: float):
+        """Corrects an earlier debit; may drive the level negative to pay back under-estimates."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+class Permit:
+    """Returned by acquire(); hand it back to release() when the request is done."""
+    def __init__(self, limiter: "_EndpointLimiter", estimated_tokens: int, queue_wait: float):
+        self.limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self.queue_wait = queue_wait # Seconds spent waiting for admission
+        self.released = False
+
+
+class _Waiter:
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class _EndpointLimiter:
+    def __init__(self, requests_per_minute: Optional[int], tokens_per_minute: Optional[int], max_concurrency: Optional[int]):
+        self.request_bucket = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = float(max_concurrency) if max_concurrency else None
+        self.concurrency_limit = self.max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0.0 # Set from retry-after on 429s
+        self.waiters: deque = deque()
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+
+    def configure(self, requests_per_minute: Optional[int], tokens_per_minute: Optional[int], max_concurrency: Optional[int]):
+        """Applies edited endpoint limits without losing in-flight state."""
+        with self._lock:
+            if (self.request_bucket.capacity if self.request_bucket else None) != (float(requests_per_minute) if requests_per_minute else None):
+                self.request_bucket = _TokenBucket(requests_per_minute) if requests_per_minute else None
+            if (self.token_bucket.capacity if self.token_bucket else None) != (float(tokens_per_minute) if tokens_per_minute else None):
+                self.token_bucket = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+            new_max = float(max_concurrency) if max_concurrency else None
+            if new_max != self.max_concurrency:
+                self.max_concurrency = new_max
+                self.concurrency_limit = new_max
+        self._wake_head()
+
+    def _admission_delay(self, tokens: int, now: float) -> Optional[float]:
+        """None if a slot is needed (wait for a release), else seconds to wait (0 = go)."""
+        if self.concurrency_limit is not None and self.in_flight >= int(self.concurrency_limit):
+            return None
+        delay = max(0.0, self.paused_until - now)
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.wait_time(1, now))
+        if self.token_bucket:
+            delay = max(delay, self.token_bucket.wait_time(tokens, now))
+        return delay
+
+    def _wake_head(self):
+        with self._lock:
+            head = self.waiters[0] if self.waiters else None
+        if head is not None:
+            head.wake()
+
+    async def acquire(self, tokens: int, on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> Permit:
+        waiter = _Waiter(tokens)
+        started_at = time.monotonic()
+        reported_position = None
+        with self._lock:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                now = time.monotonic()
+                with self._lock:
+                    position = self.waiters.index(waiter) + 1
+                    delay = self._admission_delay(tokens, now) if position == 1 else None
+                    if delay == 0.0:
+                        self.waiters.popleft()
+                        self.in_flight += 1
+                        if self.request_bucket:
+                            self.request_bucket.consume(1, now)
+                        if self.token_bucket:
+                            self.token_bucket.consume(tokens, now)
+                        break
+                    waiter.event.clear()
+                if on_queued is not None and position != reported_position:
+                    reported_position = position
+                    await on_queued(position)
+                timeout = MAX_WAIT_SLICE if delay is None else min(delay, MAX_WAIT_SLICE)
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            self._wake_head()
+            raise
+        self._wake_head() # The next waiter may fit as well
+        return Permit(self, tokens, queue_wait=time.monotonic() - started_at)
+
+    def release(self, permit: Permit, throttled: bool = False, retry_after: Optional[float] = None, actual_tokens: Optional[int] = None):
+        if permit.released:
+            return
+        permit.released = True
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if throttled:
+                self.throttled_count += 1
+                if self.concurrency_limit is not None:
+                    self.concurrency_limit = max(MIN_CONCURRENCY, self.concurrency_limit * AIMD_DECREASE_FACTOR)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif self.concurrency_limit is not None and self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+            if self.token_bucket and actual_tokens is not None:
+                self.token_bucket.adjust(actual_tokens - permit.estimated_tokens, now)
+        self._wake_head()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self.waiters),
+                "concurrency_limit": self.concurrency_limit,
+                "throttled": self.throttled_count,
+            }
+
+
+_limiters: Dict[Any, _EndpointLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _limits_for(endpoint):
+    return (
+        getattr(endpoint, 'requests_per_minute', None) or _setting('NEURONEKO_RATE_LIMIT_RPM', None),
+        getattr(endpoint, 'tokens_per_minute', None) or _setting('NEURONEKO_RATE_LIMIT_TPM', None),
+        getattr(endpoint, 'max_concurrency', None) or _setting('NEURONEKO_RATE_LIMIT_MAX_CONCURRENCY', 8),
+    )
+
+
+def get_limiter(endpoint) -> _EndpointLimiter:
+    limits = _limits_for(endpoint)
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint.id)
+        if limiter is None:
+            limiter = _EndpointLimiter(*limits)
+            _limiters[endpoint.id] = limiter
+            return limiter
+    limiter.configure(*limits)
+    return limiter
+
+
+async def acquire(endpoint, tokens: int, on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> Permit:
+    """
+    Waits until the endpoint's limits admit a request of `tokens` estimated input tokens.
+    Args:
+        endpoint: The AIEndpoint the request will be sent to.
+        tokens: Estimated input tokens, debited from the tokens-per-minute bucket.
+        on_queued: Optional coroutine called with the 1-based queue position whenever it changes.
+    Returns:
+        A Permit to pass to release().
+    """
+    return await get_limiter(endpoint).acquire(tokens, on_queued)
+
+
+def release(permit: Permit, throttled: bool = False, retry_after: Optional[float] = None, actual_tokens: Optional[int] = None):
+    """
+    Returns a permit. `throttled` (the provider answered 429) shrinks the concurrency
+    window and pauses the endpoint for `retry_after` seconds; otherwise the window grows.
+    `actual_tokens` (real input tokens), when known, replaces the estimate in the tokens-per-minute bucket.
+    """
+    permit.limiter.release(permit, throttled=throttled, retry_after=retry_after, actual_tokens=actual_tokens)
+
+
+def get_stats(endpoint_ids=None) -> Dict[Any, Dict[str, Any]]:
+    """Snapshot of limiter state (in flight, queued, concurrency window), keyed by endpoint id."""
+    with _limiters_lock:
+        ids = set(endpoint_ids) if endpoint_ids is not None else set(_limiters)
+        limiters = {endpoint_id: _limiters.get(endpoint_id) for endpoint_id in ids}
+    empty = {"in_flight": 0, "queued": 0, "concurrency_limit": None, "throttled": 0}
+    return {endpoint_id: limiters[endpoint_id].stats() if limiters[endpoint_id] else dict(empty) for endpoint_id in ids}
@@ -0,0 +1,256 @@
+# chat/resilience.py
+"""
+Retry policy and per-endpoint circuit breakers for provider calls.
+
+Transient failures (429, 5xx, overloaded, connection errors) are retried with jittered
+exponential backoff, honouring the provider's retry-after header. A circuit breaker per
+AIEndpoint opens after repeated upstream failures and fails requests fast until a
+cool-down has passed, after which a single trial request is let through (half-open).
+Retry counts and breaker state are exposed through get_stats() for monitoring.
+"""
+import email.utils
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import anthropic
+import httpx
+import openai
+from django.conf import settings
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Anthropic reports some failures as an in-stream `error` event on an HTTP 200 response.
+ANTHROPIC_STREAM_ERROR_STATUS = {"overloaded_error": 529, "api_error": 500, "rate_limit_error": 429}
+# OpenAI(-compatible) streams do the same with an `error` object carrying a type and/or code.
+OPENAI_STREAM_ERROR_STATUS = {"server_error": 500, "rate_limit_exceeded": 429, "rate_limit_error": 429, "overloaded_error": 503}
+
+
+def _setting(name: str, default: Any) -> Any:
+    return getattr(settings, name, default)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Returns the server-requested delay in seconds from retry-after(-ms) headers, if any."""
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        # HTTP-date form
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def response_error_details(status_code: int, headers=None) -> Dict[str, Any]:
+    """Error classification for an HTTP error response."""
+    return {
+        "status_code": status_code,
+        "retryable": status_code in RETRYABLE_STATUS_CODES,
+        "retry_after": parse_retry_after(headers),
+    }
+
+
+def stream_error_event_details(error_type: Optional[str]) -> Dict[str, Any]:
+    """Error classification for an Anthropic in-stream `error` event."""
+    status_code = ANTHROPIC_STREAM_ERROR_STATUS.get(error_type)
+    return {"status_code": status_code, "retryable": status_code is not None, "retry_after": None}
+
+
+def openai_stream_error_details(error: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Error classification for the `error` object of an OpenAI in-stream error chunk."""
+    error = error if isinstance(error, dict) else {}
+    status_code = OPENAI_STREAM_ERROR_STATUS.get(error.get("code")) or OPENAI_STREAM_ERROR_STATUS.get(error.get("type"))
+    return {"status_code": status_code, "retryable": status_code is not None, "retry_after": None}
+
+
+def error_details(e: Exception) -> Dict[str, Any]:
+    """
+    Classifies a provider exception. Returns a dict with 'status_code', 'retryable'
+    and 'retry_after' that is merged into error chunks / static error payloads.
+    """
+    if isinstance(e, (anthropic.APIConnectionError, openai.APIConnectionError, httpx.TransportError)):
+        # Includes the SDK timeout errors, which subclass APIConnectionError
+        details = {"status_code": None, "retryable": True, "retry_after": None}
+        if isinstance(e, httpx.ConnectTimeout) or isinstance(e.__cause__, httpx.ConnectTimeout):
+            details["timeout"] = "connect"
+        return details
+    if isinstance(e, (anthropic.APIStatusError, openai.APIStatusError)):
+        body = getattr(e, "body", None)
+        if e.status_code == 200 and isinstance(body, dict):
+            # SDK-raised in-stream error events
+            return stream_error_event_details((body.get("error") or {}).get("type"))
+        response = getattr(e, "response", None)
+        return response_error_details(e.status_code, response.headers if response is not None else None)
+    if isinstance(e, openai.APIError):
+        # The SDK raises a bare APIError for an in-stream error chunk
+        return openai_stream_error_details(e.body if isinstance(e.body, dict) else {"type": e.type, "code": e.code})
+    # google-genai errors carry the HTTP status in `.code`
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        response = getattr(e, "response", None)
+        return response_error_details(code, getattr(response, "headers", None))
+    return {"status_code": None, "retryable": False, "retry_after": None}
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+    """
+    Delay before retry number `attempt` (0-based): full-jitter exponential backoff, or the
+    server's retry-after when given. Returns None if the server asks us to wait longer
+    than NEURONEKO_RETRY_MAX_RETRY_AFTER, in which case the caller should give up.
+    """
+    if retry_after is not None:
+        if retry_after > _setting('NEURONEKO_RETRY_MAX_RETRY_AFTER', 30.0):
+            return None
+        return retry_after
+    cap = min(_setting('NEURONEKO_RETRY_MAX_DELAY', 8.0), _setting('NEURONEKO_RETRY_BASE_DELAY', 0.5) * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def max_retries() -> int:
+    return _setting('NEURONEKO_RETRY_MAX_RETRIES', 2)
+
+
+def counts_against_breaker(details: Dict[str, Any]) -> bool:
+    # 429s mean "slow down", not "down"; they are left to the retry policy.
+    return bool(details.get("retryable")) and details.get("status_code") != 429
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive upstream failures.
+    Open -> half-open once `recovery_timeout` seconds have passed; one trial request is
+    allowed, and its outcome closes or re-opens the breaker.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def holds_trial(self) -> bool:
+        """Whether the request just let through by allow_request() is the half-open trial."""
+        with self._lock:
+            return self.state == self.HALF_OPEN and self._trial_in_flight
+
+    def abandon_trial(self):
+        """
+        Releases the half-open trial when it ended without an outcome (cancelled, or raised
+        before a result), so the next request can be the trial instead of being rejected forever.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a trial request through."""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+
+_breakers: Dict[Any, CircuitBreaker] = {}
+_counters: Dict[Any, Dict[str, int]] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(endpoint) -> CircuitBreaker:
+    with _registry_lock:
+        breaker = _breakers.get(endpoint.id)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold=_setting('NEURONEKO_CIRCUIT_FAILURE_THRESHOLD', 5),
+                recovery_timeout=_setting('NEURONEKO_CIRCUIT_RECOVERY_TIMEOUT', 30.0),
+            )
+            _breakers[endpoint.id] = breaker
+        return breaker
+
+
+def record(endpoint, counter: str, amount: int = 1):
+    """Increments a monitoring counter ('requests', 'retries', 'failures', 'short_circuited')."""
+    with _registry_lock:
+        counters = _counters.setdefault(endpoint.id, {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0})
+        counters[counter] += amount
+
+
+def circuit_open_error(endpoint) -> Dict[str, Any]:
+    """Error details for a request rejected because the endpoint's circuit is open."""
+    retry_in = get_breaker(endpoint).retry_in()
+    return {
+        "message": f"Provider for endpoint '{endpoint.name}' is failing; requests are paused for {retry_in:.0f}s.",
+        "status_code": None,
+        "retryable": True,
+        "retry_after": retry_in,
+        "circuit_open": True,
+    }
+
+
+def get_stats(endpoint_ids=None) -> Dict[Any, Dict[str, Any]]:
+    """
+    Snapshot of retry counters and breaker state, keyed by endpoint id.
+    Args:
+        endpoint_ids: Optional iterable restricting the snapshot to these endpoints.
+    """
+    with _registry_lock:
+        ids = set(endpoint_ids) if endpoint_ids is not None else set(_breakers) | set(_counters)
+        breakers = {endpoint_id: _breakers.get(endpoint_id) for endpoint_id in ids}
+        counters = {endpoint_id: dict(_counters.get(endpoint_id, {})) for endpoint_id in ids}
+    stats = {}
+    for endpoint_id in ids:
+        breaker = breakers[endpoint_id]
+        stats[endpoint_id] = {
+            "circuit_state": breaker.state if breaker else CircuitBreaker.CLOSED,
+            "consecutive_failures": breaker.consecutive_failures if breaker else 0,
+            "retry_in": breaker.retry_in() if breaker else 0.0,
+            **{"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0, **counters[endpoint_id]},
+        }
+    return stats
@@ -0,0 +1,120 @@
+# chat/stream_relay.py
+"""
+Decouples reading a provider stream from writing to the websocket.
+
+The consumer puts outgoing frames into a StreamRelay without awaiting client I/O; a
+writer task sends them in order. When the writer falls behind, consecutive
+'stream_chunk' frames for the same message are merged into one frame, so a slow
+browser costs fewer, larger frames instead of stalling the upstream HTTP read.
+Several streams may share one relay (multi-sample generation). Their frames interleave,
+so a delta merges into the newest pending frame of its own message, not just the tail.
+Frames that carry an offset (generation_registry.py) only merge into the tail: the
+client resumes from the last offset it saw, so offsets must reach it in order.
+Only 'stream_chunk' frames are ever merged; every other frame is sent as it came.
+
+The pending buffer is bounded by NEURONEKO_STREAM_RELAY_MAX_PENDING frames. Since
+deltas merge, only frames that cannot be merged can fill it. Dropping one of those
+(a stream_end, an error) would leave the client in a wrong state, so on overflow the
+relay stops writing and calls `on_overflow` instead, which closes the socket; the client
+reconnects and catches up from the generation's buffer (see generation_registry.py).
+"""
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from django.conf import settings
+
+MERGEABLE_FRAME_TYPE = 'stream_chunk'
+
+
+class StreamRelay:
+    def __init__(
+        self,
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+        max_pending: int = None,
+        on_overflow: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        """
+        Args:
+            send: Coroutine that writes one frame to the client.
+            max_pending: Upper bound on buffered frames (defaults to the setting).
+            on_overflow: Coroutine called once if the buffer fills up, e.g. to close the socket.
+        """
+        self._send = send
+        self.max_pending = max_pending or getattr(settings, 'NEURONEKO_STREAM_RELAY_MAX_PENDING', 256)
+        self._on_overflow = on_overflow
+        self._pending: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._broken = False
+        self.overflowed = False
+        self.merged_frames = 0
+        self.dropped_frames = 0
+        self._writer = asyncio.get_running_loop().create_task(self._run_writer())
+
+    def put(self, frame: Dict[str, Any]):
+        """Queues a frame for the client. Never waits on client I/O."""
+        if self._broken or self._closing:
+            return
+        if frame.get('type') == MERGEABLE_FRAME_TYPE:
+            # Newest pending frame for the same message; without offsets, frames of other messages may come after it
+            message_id = frame.get('assistant_message_id')
+            oldest_position = max(len(self._pending) - 1, 0) if 'offset' in frame else 0
+            for position in range(len(self._pending) - 1, oldest_position - 1, -1):
+                pending = self._pending[position]
+                if pending.get('assistant_message_id') != message_id:
+                    continue
+                if pending.get('type') == MERGEABLE_FRAME_TYPE:
+                    # The writer is behind: fold this delta into the frame still waiting to be sent
+                    merged = {**pending, 'text_delta': pending.get('text_delta', '') + frame.get('text_delta', '')}
+                    if 'offset' in frame:
+                        merged['offset'] = frame['offset'] # The merged (tail) frame covers up to the newer delta
+                    self._pending[position] = merged
+                    self.merged_frames += 1
+                    return
+                break
+        if len(self._pending) >= self.max_pending:
+            # The client is too far behind to catch up frame by frame; have it reconnect instead
+            print(f"Stream relay overflowed ({len(self._pending)} frames pending); closing the client connection.")
+            self.dropped_frames += len(self._pending) + 1
+            self._pending.clear()
+            self._broken = True
+            self.overflowed = True
+            self._wakeup.set()
+            return
+        self._pending.append(frame)
+        self._wakeup.set()
+
+    async def _run_writer(self):
+        while True:
+            while self._pending:
+                frame = self._pending.popleft()
+                try:
+                    await self._send(frame)
+                except Exception as e:
+                    # The client is gone; keep the reader running (it saves partial content) but stop writing
+                    print(f"Stream relay stopped writing: {type(e).__name__} {e}")
+                    self._broken = True
+                    self._pending.clear()
+                    return
+            if self.overflowed:
+                if self._on_overflow is not None:
+                    try:
+                        await self._on_overflow()
+                    except Exception as e:
+                        print(f"Stream relay could not handle its overflow: {type(e).__name__} {e}")
+                return
+            if self._closing:
+                return
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def close(self, timeout: float = 10.0):
+        """Flushes pending frames (up to `timeout` seconds) and stops the writer."""
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._writer), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"Stream relay could not flush {len(self._pending)} frame(s) in {timeout:.0f}s; dropping them.")
+            self._writer.cancel()
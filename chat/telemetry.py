@@ -0,0 +1,90 @@
+# chat/telemetry.py
+"""
+Latency telemetry for a single streamed generation.
+
+GenerationTimer is fed every chunk the consumer handles and produces the figures
+stored on Message: queue wait (reported by the rate limiter), time to first token,
+inter-token gap percentiles, total duration and output tokens per second.
+Gaps are measured between text deltas as they reach the server, so with providers
+that batch several tokens per event they are inter-chunk gaps.
+"""
+import math
+import time
+from typing import Any, Dict, List, Optional
+
+# Message fields written from GenerationTimer.summary(), in save() order
+MESSAGE_FIELDS = [
+    'endpoint_used_id',
+    'queue_wait_ms',
+    'time_to_first_token_ms',
+    'inter_token_p50_ms',
+    'inter_token_p95_ms',
+    'inter_token_p99_ms',
+    'total_duration_ms',
+    'output_tokens_per_second',
+]
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _ms(seconds: Optional[float]) -> Optional[int]:
+    return round(seconds * 1000) if seconds is not None else None
+
+
+class GenerationTimer:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.gaps: List[float] = []
+        self.queue_wait = 0.0
+        self.endpoint_id = None
+
+    def on_metadata(self, data: Dict[str, Any]):
+        """Picks up routing details from api_client metadata chunks."""
+        if data.get("queue_wait_ms") is not None:
+            self.queue_wait += data["queue_wait_ms"] / 1000.0 # Summed over failover attempts
+        if data.get("endpoint_id") is not None:
+            self.endpoint_id = data["endpoint_id"]
+
+    def on_delta(self):
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.gaps.append(now - self.last_token_at)
+        self.last_token_at = now
+
+    def finish(self):
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    def summary(self, output_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Returns the telemetry dict, keyed like the Message fields.
+        Time to first token is measured from the start of the request, so it includes queue wait.
+        """
+        self.finish()
+        gaps = sorted(self.gaps)
+        tokens_per_second = None
+        if output_tokens and self.first_token_at is not None:
+            generation_time = self.finished_at - self.first_token_at
+            if generation_time > 0:
+                tokens_per_second = round(output_tokens / generation_time, 2)
+        return {
+            'endpoint_used_id': self.endpoint_id,
+            'queue_wait_ms': _ms(self.queue_wait),
+            'time_to_first_token_ms': _ms(self.first_token_at - self.started_at) if self.first_token_at is not None else None,
+            'inter_token_p50_ms': _ms(_percentile(gaps, 50)),
+            'inter_token_p95_ms': _ms(_percentile(gaps, 95)),
+            'inter_token_p99_ms': _ms(_percentile(gaps, 99)),
+            'total_duration_ms': _ms(self.finished_at - self.started_at),
+            'output_tokens_per_second': tokens_per_second,
+        }
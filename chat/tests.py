@@ -1,3 +1,983 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+from wsgiref.simple_server import WSGIRequestHandler, make_server
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import httpx
+import openai
+
+from . import api_client, batch, cassettes, completion_cache, endpoint_router, fake_provider, generation_registry, google_cache, prompt_cache, provider_clients, rate_limiter, resilience, telemetry, timeouts
+from .batch_standin import REPLY_PREFIX, StandinBatchServer
+from .consumers import StreamingChatConsumer
+from .stream_relay import StreamRelay
+from .models import AIEndpoint, AIModel, BatchJob, Chat, Folder, Message
+
+
+class CircuitBreakerTrialTests(TestCase):
+    def setUp(self):
+        resilience._breakers.clear()
+        self.endpoint = AIEndpoint.objects.create(name="Fake", provider='fake', apikey='fake', options={"ttft_ms": 10000, "jitter": 0})
+        self.model = AIModel.objects.create(name="Fake", model_id='fake-standard', endpoint=self.endpoint)
+
+    def open_breaker_until_half_open(self):
+        breaker = resilience.get_breaker(self.endpoint)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.recovery_timeout
+        return breaker
+
+    def test_cancelled_half_open_trial_is_released(self):
+        breaker = self.open_breaker_until_half_open()
+
+        async def cancel_trial():
+            async def on_chunk(chunk):
+                pass
+
+            task = asyncio.ensure_future(api_client._stream_completion_with_retries(
+                self.model, [{"role": "user", "content": "Hi"}], on_chunk, temperature=1.0, max_tokens=10
+            ))
+            await asyncio.sleep(0.1) # The trial is waiting for its first token
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_trial())
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+    def test_abandon_trial_only_affects_half_open(self):
+        breaker = self.open_breaker_until_half_open()
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.holds_trial())
+        breaker.record_failure()
+        breaker.abandon_trial()
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+
+class RawStreamErrorTests(SimpleTestCase):
+    def stream_raw_openai(self, sse_body):
+        def handler(request):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse_body)
+
+        async def run():
+            chunks = []
+
+            async def on_chunk(chunk):
+                chunks.append(chunk)
+
+            http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            endpoint = SimpleNamespace(apikey="key")
+            with mock.patch.object(api_client.provider_clients, "get_async_openai_client", return_value=SimpleNamespace(base_url="https://example.test/v1")), \
+                    mock.patch.object(api_client.provider_clients, "get_async_http_client", return_value=http_client):
+                await api_client._stream_completion_openai_raw_internal("gpt", endpoint, [{"role": "user", "content": "Hi"}], on_chunk)
+            await http_client.aclose()
+            return chunks
+
+        return asyncio.run(run())
+
+    def test_in_stream_server_error_is_retryable(self):
+        chunks = self.stream_raw_openai(b'data: {"error": {"message": "The server had an error", "type": "server_error"}}\n\n')
+        self.assertEqual(chunks[-1]["type"], "error")
+        self.assertEqual(chunks[-1]["status_code"], 500)
+        self.assertTrue(chunks[-1]["retryable"])
+        self.assertIsNone(chunks[-1]["retry_after"])
+
+    def test_in_stream_request_error_is_not_retryable(self):
+        chunks = self.stream_raw_openai(b'data: {"error": {"message": "Bad input", "type": "invalid_request_error"}}\n\n')
+        self.assertEqual(chunks[-1]["type"], "error")
+        self.assertIsNone(chunks[-1]["status_code"])
+        self.assertFalse(chunks[-1]["retryable"])
+
+    def test_sdk_in_stream_error_uses_the_same_classification(self):
+        request = httpx.Request("POST", "https://example.test/v1/chat/completions")
+        error = openai.APIError("Rate limited", request, body={"message": "Rate limited", "code": "rate_limit_exceeded"})
+        self.assertEqual(resilience.error_details(error), {"status_code": 429, "retryable": True, "retry_after": None})
+
+
+class ResponseChainingTests(SimpleTestCase):
+    history = [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello!"},
+        {"role": "user", "content": "How are you?"},
+    ]
+
+    def chain_state(self, messages=None):
+        # The state stored after the assistant reply at index 2
+        return {"previous_response_id": "resp_1", "history_index": 2, "context_hash": api_client.conversation_state_hash((messages or self.history)[:3])}
+
+    def test_matching_hash_sends_only_the_suffix(self):
+        previous_response_id, to_send = api_client._resolve_previous_response(self.history, self.chain_state())
+        self.assertEqual(previous_response_id, "resp_1")
+        self.assertEqual(to_send, self.history[3:])
+
+    def test_hash_ignores_block_formatting(self):
+        formatted = [dict(msg) for msg in self.history]
+        formatted[1] = {"role": "user", "content": [{"type": "text", "text": "Hi", "cache_control": {"type": "ephemeral"}}]}
+        self.assertEqual(api_client.conversation_state_hash(formatted[:3]), api_client.conversation_state_hash(self.history[:3]))
+
+    def test_edited_history_falls_back_to_full_history(self):
+        edited = [dict(msg) for msg in self.history]
+        edited[1] = {"role": "user", "content": "Hi there"}
+        previous_response_id, to_send = api_client._resolve_previous_response(edited, self.chain_state())
+        self.assertIsNone(previous_response_id)
+        self.assertEqual(to_send, edited)
+
+    def test_stale_index_falls_back_to_full_history(self):
+        # A regenerated reply: the stored index now points at the last message
+        previous_response_id, to_send = api_client._resolve_previous_response(self.history[:3], self.chain_state())
+        self.assertIsNone(previous_response_id)
+        self.assertEqual(to_send, self.history[:3])
+
+    def stream_with_unusable_previous_response(self, status_code, deliver_first):
+        calls = []
+
+        async def attempt(ai_model_id, endpoint, system_text, messages, previous_response_id, on_chunk_callback, temperature, max_tokens, state, kwargs):
+            calls.append((previous_response_id, messages))
+            if previous_response_id is not None:
+                if deliver_first:
+                    state["delivered"] = True
+                    await on_chunk_callback({"type": "delta", "content": "Partial"})
+                response = httpx.Response(status_code, request=httpx.Request("POST", "https://example.test/v1/responses"))
+                raise openai.APIStatusError("Previous response not found", response=response, body=None)
+            await on_chunk_callback({"type": "delta", "content": "Full"})
+
+        async def run():
+            chunks = []
+
+            async def on_chunk(chunk):
+                chunks.append(chunk)
+
+            with mock.patch.object(api_client, "_stream_openai_responses_attempt", attempt):
+                await api_client._stream_completion_openai_responses_internal("gpt", None, self.history, on_chunk, conversation_state=self.chain_state())
+            return chunks
+
+        return calls, asyncio.run(run())
+
+    def test_unusable_previous_response_retries_with_full_history(self):
+        for status_code in (400, 404):
+            calls, chunks = self.stream_with_unusable_previous_response(status_code, deliver_first=False)
+            self.assertEqual(calls, [("resp_1", self.history[3:]), (None, self.history)])
+            self.assertEqual(chunks, [{"type": "delta", "content": "Full"}])
+
+    def test_no_full_history_retry_after_delivery(self):
+        calls, chunks = self.stream_with_unusable_previous_response(404, deliver_first=True)
+        self.assertEqual(calls, [("resp_1", self.history[3:])])
+        self.assertEqual(chunks[0], {"type": "delta", "content": "Partial"})
+        self.assertEqual(chunks[-1]["type"], "error")
+        self.assertEqual(chunks[-1]["status_code"], 404)
+
+    def test_other_statuses_are_not_retried_with_full_history(self):
+        calls, chunks = self.stream_with_unusable_previous_response(500, deliver_first=False)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(chunks[-1]["retryable"])
+
+
+class StreamTimeoutTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("timeouts")
+        self.endpoint = AIEndpoint.objects.create(user=self.user, name="Fake", provider='fake', apikey='fake')
+        self.model = AIModel.objects.create(name="Fake", model_id='fake-standard', endpoint=self.endpoint)
+        self.chat = Chat.objects.create(user=self.user, title="Timeouts", ai_model_used=self.model)
+        self.assistant_msg = Message.objects.create(chat=self.chat, role='assistant', message="")
+        self.consumer = StreamingChatConsumer()
+        self.sent = []
+
+        async def send_to_client(payload):
+            self.sent.append(payload)
+
+        self.consumer.send_to_client = send_to_client
+
+    def handle(self, *chunks):
+        stream_context = self.consumer._new_stream_context([], self.model)
+
+        async def run():
+            for chunk in chunks:
+                await self.consumer._handle_stream_chunk(chunk, self.assistant_msg, stream_context)
+
+        asyncio.run(run())
+        self.assistant_msg.refresh_from_db()
+
+    def test_timeout_after_delivery_keeps_the_text(self):
+        self.handle(
+            {"type": "delta", "text_delta": "Once upon"},
+            {"type": "error", **timeouts.timeout_error('idle', 30.0)},
+        )
+        self.assertEqual(self.assistant_msg.message, "Once upon")
+        self.assertIsNotNone(self.assistant_msg.time_to_first_token_ms)
+        self.assertIsNotNone(self.assistant_msg.total_duration_ms)
+        error = self.sent[-1]
+        self.assertEqual(error['type'], 'stream_error')
+        self.assertEqual(error['error_code'], 'timeout_idle')
+        self.assertTrue(error['content_kept'])
+
+    def test_cancel_keeps_text_and_timings(self):
+        async def cancel_after_first_chunk(chunk):
+            self.consumer.cancel_stream_flag.set()
+
+        self.consumer.send_to_client = cancel_after_first_chunk # The user cancels once the first text is shown
+        self.handle({"type": "delta", "text_delta": "Once"}, {"type": "delta", "text_delta": " upon"})
+        self.assertEqual(self.assistant_msg.message, "Once")
+        self.assertIsNotNone(self.assistant_msg.time_to_first_token_ms)
+        self.assertIsNotNone(self.assistant_msg.total_duration_ms)
+
+    def test_timeout_before_delivery_reports_the_error(self):
+        self.handle({"type": "error", **timeouts.timeout_error('first_token', 120.0)})
+        self.assertTrue(self.assistant_msg.message.startswith("Error: "))
+        self.assertEqual(self.sent[-1]['error_code'], 'timeout_first_token')
+        self.assertNotIn('content_kept', self.sent[-1])
+
+    def test_idle_and_total_budgets_are_opt_in(self):
+        self.assertEqual(timeouts.budgets(self.model)['idle'], None)
+        self.assertEqual(timeouts.budgets(self.model)['total'], None)
+        self.model.idle_timeout = 45
+        self.assertEqual(timeouts.budgets(self.model)['idle'], 45.0)
+
+
+class ProviderClientTests(SimpleTestCase):
+    def test_certificates_are_verified_by_default(self):
+        self.assertIs(provider_clients._client_kwargs()["verify"], True)
+        self.assertIs(provider_clients._client_kwargs(is_async=True)["verify"], True)
+
+    @override_settings(NEURONEKO_PROVIDER_SSL_VERIFY=False)
+    def test_verification_can_be_turned_off(self):
+        self.assertIs(provider_clients._client_kwargs()["verify"], False)
+
+
+class StreamRelayTests(SimpleTestCase):
+    def run_relay(self, frames, max_pending=4):
+        """Puts `frames` while the client is stalled, then lets it read. Returns (sent frames, overflow calls, relay)."""
+        sent, overflowed = [], []
+        release = asyncio.Event()
+
+        async def send(frame):
+            await release.wait()
+            sent.append(frame)
+
+        async def on_overflow():
+            overflowed.append(True)
+
+        async def run():
+            relay = StreamRelay(send, max_pending=max_pending, on_overflow=on_overflow)
+            relay.put({'type': 'lock_sidebar'}) # Taken by the writer, which then waits on the client
+            await asyncio.sleep(0)
+            for frame in frames:
+                relay.put(frame)
+            release.set()
+            await relay.close(timeout=1.0)
+            return relay
+
+        relay = asyncio.run(run())
+        return sent, overflowed, relay
+
+    def test_only_stream_chunks_merge(self):
+        sent, overflowed, _ = self.run_relay([
+            {'type': 'stream_chunk', 'assistant_message_id': 1, 'text_delta': "a"},
+            {'type': 'stream_chunk', 'assistant_message_id': 1, 'text_delta': "b"},
+            {'type': 'stream_end', 'assistant_message_id': 1, 'full_content': "ab"},
+            {'type': 'stream_end', 'assistant_message_id': 1, 'full_content': "ab"},
+        ])
+        self.assertEqual([frame['type'] for frame in sent], ['lock_sidebar', 'stream_chunk', 'stream_end', 'stream_end'])
+        self.assertEqual(sent[1]['text_delta'], "ab")
+        self.assertFalse(overflowed)
+
+    def test_overflow_closes_instead_of_dropping_control_frames(self):
+        sent, overflowed, relay = self.run_relay(
+            [{'type': 'info', 'message': str(index)} for index in range(5)] + [{'type': 'stream_end', 'assistant_message_id': 1}]
+        )
+        self.assertTrue(overflowed)
+        self.assertTrue(relay.overflowed)
+        # Nothing after the first frame was delivered out of order or with gaps
+        self.assertEqual(sent, [{'type': 'lock_sidebar'}])
+
+
+class GenerationReplayTests(SimpleTestCase):
+    def test_interleaved_chunks_keep_offsets_in_order_and_replay_without_duplicates(self):
+        words = {1: ["a", "b", "c", "d"], 2: ["x", "y", "z"]}
+
+        async def run():
+            generation = generation_registry.Generation(('user', 'chat'))
+            first_socket, release = [], asyncio.Event()
+
+            async def stalled_send(frame):
+                await release.wait()
+                first_socket.append(frame)
+
+            relay = generation.attach(stalled_send)
+            generation.publish({'type': 'lock_sidebar'})
+            await asyncio.sleep(0) # The writer now waits on the stalled client
+            for index in range(4):
+                for message_id, message_words in words.items():
+                    if index < len(message_words): # Message 1 streams last
+                        generation.publish({'type': 'stream_chunk', 'assistant_message_id': message_id, 'text_delta': message_words[index]})
+            release.set()
+            await generation.detach(relay)
+
+            # The client saw everything up to its third frame, then reconnected
+            seen = first_socket[:3]
+            second_socket = []
+
+            async def send(frame):
+                second_socket.append(frame)
+
+            relay = generation.reattach(send, seen[-1]['offset'])
+            await generation.detach(relay)
+            return first_socket, seen, second_socket
+
+        first_socket, seen, second_socket = asyncio.run(run())
+        offsets = [frame['offset'] for frame in first_socket]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertTrue(second_socket[0]['replayed'])
+        for message_id, message_words in words.items():
+            received = "".join(
+                frame['text_delta'] for frame in seen + second_socket[1:]
+                if frame.get('type') == 'stream_chunk' and frame['assistant_message_id'] == message_id
+            )
+            self.assertEqual(received, "".join(message_words))
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class BatchJobTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = make_server('127.0.0.1', 0, StandinBatchServer(), handler_class=QuietRequestHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{cls.server.server_port}"
+        cls.settings_override = override_settings(NEURONEKO_BATCH_BASE_URLS={'anthropic': base_url, 'openai': f"{base_url}/v1"})
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user("batches")
+        self.folder = Folder.objects.create(user=self.user, name="Stories")
+        self.chats = [self.create_chat(f"Chat {index}", f"Tell me story {index}") for index in range(2)]
+
+    def create_chat(self, title, text):
+        chat = Chat.objects.create(user=self.user, title=title, folder=self.folder)
+        root = Message.objects.create(chat=chat, role='user', message=text)
+        chat.root_message = root
+        chat.save(update_fields=['root_message'])
+        return chat
+
+    def create_model(self, provider):
+        endpoint = AIEndpoint.objects.create(user=self.user, name=provider, provider=provider, apikey='test-key')
+        return AIModel.objects.create(name=provider, model_id=f"{provider}-model", endpoint=endpoint)
+
+    def run_job(self, job):
+        batch.submit(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'submitted')
+        stale_copy = BatchJob.objects.get(pk=job.pk) # A second poller that loaded the job at the same time
+        self.assertTrue(batch.poll(job))
+        self.assertTrue(batch.poll(stale_copy))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual((job.succeeded_count, job.failed_count), (2, 0))
+        return job
+
+    def test_anthropic_title_job(self):
+        job = self.run_job(batch.create_title_job(self.user, self.create_model('anthropic'), self.chats))
+        self.assertGreater(job.output_tokens, 0)
+        for chat in self.chats:
+            chat.refresh_from_db()
+            self.assertTrue(chat.title.startswith(REPLY_PREFIX.strip()))
+
+    def test_openai_folder_prompt_job_is_applied_once(self):
+        job = self.run_job(batch.create_folder_prompt_job(self.user, self.create_model('openai'), self.folder, "What happens next?"))
+        self.assertGreater(job.input_tokens, 0)
+        for chat in self.chats:
+            self.assertEqual(chat.messages.filter(role='user', message="What happens next?").count(), 1)
+            reply = chat.messages.get(role='assistant')
+            self.assertEqual(reply.message, REPLY_PREFIX + "What happens next?")
+            chat.root_message.refresh_from_db()
+            self.assertEqual(chat.root_message.active_child.active_child, reply)
+
+
+class CompletionCacheKeyTests(SimpleTestCase):
+    def key_for(self, endpoint_id, base_url):
+        endpoint = AIEndpoint(id=endpoint_id, name="Local", provider='openai_compatible', apikey='none', base_url=base_url)
+        model = AIModel(name="Local", model_id='local-model', endpoint=endpoint)
+        return completion_cache.make_key(model, [{"role": "user", "content": "Hi"}], 0.0, 30)
+
+    def test_key_depends_on_the_endpoint(self):
+        key = self.key_for(1, "http://localhost:8000/v1")
+        self.assertEqual(key, self.key_for(1, "http://localhost:8000/v1/"))
+        self.assertNotEqual(key, self.key_for(2, "http://localhost:8000/v1"))
+        self.assertNotEqual(key, self.key_for(1, "http://localhost:9000/v1"))
+
+
+class FakeProviderTests(SimpleTestCase):
+    messages = [{"role": "user", "content": "Tell me a story"}]
+
+    def stream(self, options, messages=None):
+        """Streams one fake response; returns (chunk, monotonic time) pairs."""
+        endpoint = SimpleNamespace(options={"ttft_ms": 0, "tokens_per_second": 10000, "output_tokens": 20, "jitter": 0, **options})
+
+        async def run():
+            received = []
+
+            async def on_chunk(chunk):
+                received.append((chunk, time.monotonic()))
+
+            await fake_provider.stream_completion(endpoint, "fake-standard", messages or self.messages, on_chunk)
+            return received
+
+        return asyncio.run(run())
+
+    def planned(self, options):
+        options = fake_provider.get_options(SimpleNamespace(options={"output_tokens": 20, **options}), "fake-standard")
+        return fake_provider._plan(options, None, fake_provider._rng(options, self.messages))
+
+    def text(self, received):
+        return "".join(chunk["text_delta"] for chunk, _ in received if chunk["type"] == "delta")
+
+    def test_same_seed_and_prompt_give_identical_output(self):
+        first = self.stream({"seed": 7, "jitter": 0.5})
+        second = self.stream({"seed": 7, "jitter": 0.5})
+        # How words are batched into deltas follows the wall clock; the words themselves do not
+        self.assertEqual(self.text(first), self.text(second))
+        self.assertEqual(first[-1][0], second[-1][0])
+        other_prompt = self.stream({"seed": 7, "jitter": 0.5}, [{"role": "user", "content": "Tell me a joke"}])
+        self.assertNotEqual(self.text(other_prompt), self.text(first))
+
+    def test_disconnect_fires_at_the_planned_offset(self):
+        options = {"seed": 2, "disconnect_rate": 1.0}
+        disconnect_at = self.planned(options)["disconnect_at"]
+        received = self.stream(options)
+        self.assertEqual(len(self.text(received).split()), disconnect_at)
+        self.assertEqual(received[-1][0]["type"], "error")
+        self.assertTrue(received[-1][0]["retryable"])
+
+    def test_stall_fires_at_the_planned_offset(self):
+        options = {"seed": 2, "stall_rate": 1.0, "stall_seconds": 0.2}
+        stall_at = self.planned(options)["stall_at"]
+        received = self.stream(options)
+        deltas = [(chunk, at) for chunk, at in received if chunk["type"] == "delta"]
+        words_before = 0
+        for (chunk, at), (_, next_at) in zip(deltas, deltas[1:]):
+            words_before += len(chunk["text_delta"].split())
+            if next_at - at >= 0.2:
+                break
+        self.assertEqual(words_before, stall_at)
+        self.assertEqual(len(self.text(received).split()), 20) # The stream resumes after the stall
+        self.assertEqual(received[-1][0]["type"], "stop")
+
+    def test_injected_rate_limit_comes_before_any_token(self):
+        received = self.stream({"error_rate": 1.0, "retry_after": 2.5})
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][0]["status_code"], 429)
+        self.assertEqual(received[0][0]["retry_after"], 2.5)
+
+
+class CassetteTests(SimpleTestCase):
+    messages = [{"role": "user", "content": "Tell me a story"}]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def record(self):
+        """Records a fake provider stream; returns (delivered chunks, cassette name)."""
+        endpoint = SimpleNamespace(options={"ttft_ms": 20, "tokens_per_second": 100, "output_tokens": 10, "jitter": 0})
+
+        async def run():
+            delivered = []
+
+            async def on_chunk(chunk):
+                delivered.append(chunk)
+
+            recorder = cassettes.Recorder('anthropic', "claude-test", self.messages)
+            await fake_provider.stream_completion(endpoint, "fake-standard", self.messages, recorder.wrap(on_chunk))
+            await recorder.save()
+            return delivered
+
+        with override_settings(NEURONEKO_CASSETTE_RECORD_DIR=self.directory):
+            delivered = asyncio.run(run())
+        return delivered, cassettes.list_cassettes(self.directory)[0]
+
+    def replay(self, model_id, speed):
+        endpoint = SimpleNamespace(options={"cassette_dir": self.directory, "speed": speed})
+
+        async def run():
+            replayed = []
+
+            async def on_chunk(chunk):
+                replayed.append(chunk)
+
+            started_at = time.monotonic()
+            await cassettes.replay_stream(endpoint, model_id, self.messages, on_chunk)
+            return replayed, time.monotonic() - started_at
+
+        return asyncio.run(run())
+
+    def test_replay_is_byte_for_byte(self):
+        delivered, name = self.record()
+        with gzip.open(os.path.join(self.directory, name + cassettes.CASSETTE_SUFFIX), "rt", encoding="utf-8") as f:
+            recorded_lines = f.read().splitlines()[1:]
+        for model_id in (name, cassettes.ANY_CASSETTE):
+            replayed, _ = self.replay(model_id, speed=0)
+            self.assertEqual(replayed, delivered)
+            self.assertEqual([json.dumps(chunk, separators=(",", ":")) for chunk in replayed], [json.dumps(entry[1], separators=(",", ":")) for entry in map(json.loads, recorded_lines)])
+
+    def test_replay_speed_scales_the_recorded_offsets(self):
+        _, name = self.record()
+        last_offset = cassettes.load(os.path.join(self.directory, name + cassettes.CASSETTE_SUFFIX))["chunks"][-1][0] / 1000.0
+        self.assertGreater(last_offset, 0.1)
+        _, unthrottled = self.replay(name, speed=0)
+        self.assertLess(unthrottled, last_offset / 4)
+        _, doubled = self.replay(name, speed=2)
+        self.assertGreaterEqual(doubled, last_offset / 2)
+        self.assertLess(doubled, last_offset)
+
+
+class SampleDemuxTests(SimpleTestCase):
+    def test_usage_is_split_by_share_of_text(self):
+        samples = api_client._SampleDemux()
+        samples.delta(0, "x" * 10)
+        samples.delta(1, "y" * 30)
+        samples.finish(1, "stop")
+        samples.finish(0, "length")
+        chunks = samples.stop_chunks({"input_tokens": 100, "output_tokens": 9})
+        self.assertEqual([chunk["sample"] for chunk in chunks], [0, 1])
+        self.assertEqual([chunk["stop_reason"] for chunk in chunks], ["length", "stop"])
+        self.assertEqual(chunks[0]["usage"], {"input_tokens": 100, "output_tokens": 2}) # The prompt is billed once
+        self.assertEqual(chunks[1]["usage"], {"input_tokens": 0, "output_tokens": 7}) # The last sample takes the remainder
+
+    def test_missing_usage(self):
+        samples = api_client._SampleDemux()
+        samples.finish(0, "stop")
+        samples.finish(1, "stop")
+        self.assertEqual([chunk["usage"] for chunk in samples.stop_chunks(None)], [None, None])
+        self.assertEqual(samples.stop_chunks({"input_tokens": 5, "output_tokens": None})[1]["usage"], {"input_tokens": 0, "output_tokens": None})
+
+
+class SampleGenerationTests(TransactionTestCase):
+    FAST = {"ttft_ms": 0, "tokens_per_second": 10000, "output_tokens": 5, "jitter": 0, "seed": 7}
+
+    def setUp(self):
+        resilience._breakers.clear()
+        self.user = User.objects.create_user("samples")
+        self.model = self.create_model("Sampling", {**self.FAST, "native_sampling": True})
+        self.chat = Chat.objects.create(user=self.user, title="Samples", ai_model_used=self.model)
+        self.parent = Message.objects.create(chat=self.chat, role='user', message="Tell me a story")
+        self.chat.root_message = self.parent
+        self.chat.save(update_fields=['root_message'])
+        self.consumer = StreamingChatConsumer()
+        self.consumer.user, self.consumer.chat_id = self.user, self.chat.id
+        self.sent = []
+
+        async def send_to_client(payload):
+            self.sent.append(payload)
+
+        self.consumer.send_to_client = send_to_client
+
+    def create_model(self, name, options):
+        endpoint = AIEndpoint.objects.create(user=self.user, name=name, provider='fake', apikey='fake', options=options)
+        return AIModel.objects.create(name=name, model_id='fake-standard', endpoint=endpoint)
+
+    def stream_samples(self, count=2):
+        messages = [Message.objects.create(chat=self.chat, role='assistant', message="", parent=self.parent) for _ in range(count)]
+        asyncio.run(self.consumer._stream_native_samples(self.model, [{"role": "user", "content": "Tell me a story"}], messages, 1.0, 10))
+        for message in messages:
+            message.refresh_from_db()
+        return messages
+
+    def test_tagged_chunks_go_to_their_sample(self):
+        first, second = self.stream_samples()
+        self.assertEqual(len(first.message.split()), 5)
+        self.assertEqual(len(second.message.split()), 5)
+        self.assertNotEqual(first.message, second.message)
+        self.assertGreater(first.input_tokens, 0)
+        self.assertEqual(second.input_tokens, 0)
+        self.assertEqual((first.output_tokens, second.output_tokens), (5, 5))
+
+    def test_untagged_text_is_not_copied_into_every_sample(self):
+        async def single_stream(on_chunk_callback, **kwargs):
+            await on_chunk_callback({"type": "metadata", "data": {"endpoint_id": self.model.endpoint.id}})
+            await on_chunk_callback({"type": "delta", "text_delta": "Only one"})
+            await on_chunk_callback({"type": "stop", "stop_reason": "end_turn", "usage": None})
+
+        with mock.patch('chat.consumers.stream_completion', single_stream):
+            first, second = self.stream_samples()
+        self.assertEqual(first.message, "Only one")
+        self.assertTrue(second.message.startswith("Error: "))
+
+    @override_settings(NEURONEKO_RETRY_MAX_RETRIES=0)
+    def test_failover_only_to_endpoints_that_sample_natively(self):
+        self.model.endpoint.options = {**self.FAST, "native_sampling": True, "error_rate": 1.0}
+        self.model.endpoint.save(update_fields=['options'])
+        self.create_model("Single sample", self.FAST) # Equivalent, but streams one sample
+        chunks = []
+
+        async def collect(chunk):
+            chunks.append(chunk)
+
+        asyncio.run(api_client.stream_completion(self.model, [{"role": "user", "content": "Hi"}], collect, max_tokens=10, n=2))
+        self.assertFalse([chunk for chunk in chunks if chunk["type"] == "delta"])
+        self.assertEqual(chunks[-1]["status_code"], 429)
+
+    def test_n_is_dropped_for_endpoints_without_native_sampling(self):
+        model = self.create_model("Single sample", self.FAST)
+        chunks = []
+
+        async def collect(chunk):
+            chunks.append(chunk)
+
+        asyncio.run(api_client._dispatch_stream_completion_to_provider(model, [{"role": "user", "content": "Hi"}], collect, 1.0, 10, n=2))
+        self.assertFalse([chunk for chunk in chunks if "sample" in chunk])
+        self.assertEqual(len([chunk for chunk in chunks if chunk["type"] == "stop"]), 1)
+
+    @override_settings(NEURONEKO_MAX_SAMPLES=3)
+    def test_sample_count_is_capped(self):
+        asyncio.run(self.consumer.handle_generate_samples({'parent_message_id': self.parent.id, 'model_id': self.model.id, 'count': 4}))
+        self.assertEqual(self.sent[-1]['type'], 'stream_error')
+        self.assertIn("between 1 and 3", self.sent[-1]['error'])
+        self.assertEqual(self.chat.messages.count(), 1)
+
+
+class StubCaches:
+    """Stands in for genai.Client().aio.caches."""
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+
+    async def create(self, model, config):
+        name = f"cachedContents/{len(self.created) + 1}"
+        self.created.append((name, len(config.contents)))
+        return SimpleNamespace(name=name, usage_metadata=None)
+
+    async def update(self, name, config):
+        self.updated.append(name)
+
+    async def delete(self, name):
+        self.deleted.append(name)
+
+
+@override_settings(NEURONEKO_GOOGLE_CACHE_MIN_TOKENS=1, NEURONEKO_GOOGLE_CACHE_REBUILD_TOKENS=1, NEURONEKO_GOOGLE_CACHE_MAX_PER_CHAT=2)
+class GoogleContextCacheTests(SimpleTestCase):
+    endpoint = SimpleNamespace(id=1)
+
+    def setUp(self):
+        self.caches = StubCaches()
+        client = SimpleNamespace(aio=SimpleNamespace(caches=self.caches))
+        patches = [
+            mock.patch.object(google_cache, "_registry", google_cache._Registry()),
+            mock.patch.object(google_cache.provider_clients, "get_google_client", return_value=client),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def conversation(self, *texts):
+        return [{"role": "user" if i % 2 == 0 else "model", "text": text} for i, text in enumerate(texts)]
+
+    def refresh(self, items, current=None):
+        async def run():
+            google_cache.schedule_refresh(self.endpoint, "gemini", "System", items, current)
+            await asyncio.gather(*google_cache._background_tasks)
+
+        asyncio.run(run())
+
+    def lookup(self, items):
+        return google_cache.lookup(self.endpoint, "gemini", "System", items)
+
+    def test_prefix_hash_matches_across_branches(self):
+        branch_a = self.conversation("Hello there", "Hi, how can I help?", "Tell me about cats", "Cats are great", "More please")
+        branch_b = branch_a[:2] + [{"role": "user", "text": "Tell me about dogs"}]
+        self.refresh(branch_a[:3])
+        shared = self.lookup(branch_b)
+        self.assertEqual((shared.name, shared.prefix_len), ("cachedContents/1", 2))
+
+        self.refresh(branch_a, current=self.lookup(branch_a))
+        self.assertEqual(self.caches.created[-1], ("cachedContents/2", 4))
+        self.assertEqual(self.lookup(branch_a).name, "cachedContents/2")
+        self.assertEqual(self.lookup(branch_b).name, "cachedContents/1") # The longer handle holds the other branch
+        edited = self.conversation("Hello there!", "Hi, how can I help?", "Tell me about cats")
+        self.assertIsNone(self.lookup(edited)) # A different first message is a different lineage
+
+    def test_least_recently_used_handle_is_evicted(self):
+        items = self.conversation("Hello there", "Hi, how can I help?", "Tell me about cats", "Cats are great", "More please")
+        self.refresh(items[:2]) # cachedContents/1 holds 1 message
+        self.refresh(items[:3], current=self.lookup(items[:3])) # cachedContents/2 holds 2
+        current = self.lookup(items)
+        other_branch = items[:1] + [{"role": "model", "text": "Something else"}, {"role": "user", "text": "Other question"}]
+        self.assertEqual(self.lookup(other_branch).name, "cachedContents/1") # Now the most recently used
+        self.refresh(items, current=current) # cachedContents/3 holds 4
+        self.assertEqual(self.caches.deleted, ["cachedContents/2"])
+        self.assertEqual(sorted(h.name for h in google_cache._registry.alive(google_cache._lineage(self.endpoint, "gemini", "System", items))), ["cachedContents/1", "cachedContents/3"])
+
+    @override_settings(NEURONEKO_GOOGLE_CACHE_REBUILD_TOKENS=10)
+    def test_rebuild_only_past_the_threshold(self):
+        items = self.conversation("Hello there", "Hi, how can I help?", "Tell me about cats")
+        self.refresh(items)
+        handle = self.lookup(items)
+        short_suffix = items + [{"role": "model", "text": "Cats purr."}, {"role": "user", "text": "And?"}]
+        self.refresh(short_suffix, current=self.lookup(short_suffix))
+        self.assertEqual(len(self.caches.created), 1) # 7 estimated tokens of uncached suffix: keep the handle
+        self.assertEqual(self.caches.updated, []) # Still fresh
+
+        handle.expires_at -= google_cache._ttl() * 0.6
+        self.refresh(short_suffix, current=self.lookup(short_suffix))
+        self.assertEqual(self.caches.updated, [handle.name]) # Past half its TTL: extended instead
+
+        long_suffix = items + [{"role": "model", "text": "Cats are small carnivorous mammals kept as pets."}, {"role": "user", "text": "And?"}]
+        self.refresh(long_suffix, current=self.lookup(long_suffix))
+        self.assertEqual(self.caches.created[-1], ("cachedContents/2", 4))
+
+
+class FanOutHistoryTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("fanout")
+        self.chat = Chat.objects.create(user=self.user, title="Fan-out")
+        parent = None
+        for index in range(5):
+            parent = Message.objects.create(chat=self.chat, role='user' if index % 2 == 0 else 'assistant', message=f"{index} " + "x" * 2400, parent=parent) # ~600 tokens each
+            if index == 0:
+                self.chat.root_message = parent
+                self.chat.save(update_fields=['root_message'])
+            else:
+                parent.parent.active_child = parent
+                parent.parent.save(update_fields=['active_child'])
+        self.last = parent
+
+    def create_model(self, provider, model_id):
+        endpoint = AIEndpoint.objects.create(user=self.user, name=model_id, provider=provider, apikey='key')
+        return AIModel.objects.create(name=model_id, model_id=model_id, endpoint=endpoint)
+
+    def breakpoints(self, history):
+        return [index for index, message in enumerate(history) if isinstance(message["content"], list) and "cache_control" in message["content"][-1]]
+
+    def test_formats_once_and_isolates_breakpoints(self):
+        models = [self.create_model('anthropic', 'claude-sonnet'), self.create_model('anthropic', 'claude-haiku'), self.create_model('openai', 'gpt')]
+        consumer = StreamingChatConsumer()
+        with mock.patch.object(consumer, "_format_message_history", wraps=consumer._format_message_history) as format_history:
+            histories = asyncio.run(consumer.get_fan_out_histories(self.chat, self.last, models))
+        self.assertEqual(format_history.call_count, 1)
+        sonnet, haiku, gpt = (history for history, _ in histories)
+        # Haiku's higher minimum cacheable length leaves the shorter prefix unmarked
+        self.assertEqual((self.breakpoints(sonnet), self.breakpoints(haiku), self.breakpoints(gpt)), ([2, 4], [4], []))
+        for index in range(len(gpt)):
+            self.assertIsNot(sonnet[index], haiku[index])
+
+
+class PromptCachePlanTests(SimpleTestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def history(self, count, pinned=()):
+        """A system prompt then alternating user/assistant turns of ~1000 tokens each."""
+        history = [{"role": "system", "content": "s" * 4800}]
+        for index in range(1, count):
+            history.append({"role": "user" if index % 2 else "assistant", "content": "x" * 4000})
+        for index in pinned:
+            prompt_cache._mark(history[index], None)
+        return history
+
+    def plan(self, history, last_gap_seconds=10, primed_at=None):
+        timestamps = [self.now - timedelta(seconds=last_gap_seconds)] * len(history)
+        return prompt_cache.plan_breakpoints(history, timestamps, 'claude-sonnet', now=self.now, primed_at=primed_at)
+
+    def test_warm_chat(self):
+        self.assertEqual(self.plan(self.history(4)), {3: None, 0: None, 1: None})
+
+    def test_anchor_stride(self):
+        self.assertNotIn(15, self.plan(self.history(36)))
+        self.assertEqual(self.plan(self.history(37))[15], None)
+        self.assertIn(15, self.plan(self.history(52))) # Stays put for a whole stride
+        self.assertIn(31, self.plan(self.history(53)))
+
+    def test_budget_is_shared_with_pinned_breakpoints(self):
+        plan = self.plan(self.history(40, pinned=(5,)))
+        self.assertEqual(plan, {39: None, 0: None, 37: None}) # The anchor (15) did not fit
+        plan = self.plan(self.history(40, pinned=(5, 7, 9, 11)))
+        self.assertEqual(plan, {})
+
+    @override_settings(NEURONEKO_PROMPT_CACHE_STABLE_TTL="1h")
+    def test_long_ttl_after_a_short_one_is_downgraded(self):
+        self.assertEqual(self.plan(self.history(40)), {39: None, 0: "1h", 37: None, 15: "1h"})
+        # Cold, so only the stable breakpoints are placed, but the pinned one (short) comes before the anchor
+        self.assertEqual(self.plan(self.history(40, pinned=(5,)), last_gap_seconds=3600), {0: "1h", 15: None})
+
+    def test_cold_chat_skips_rolling_breakpoints(self):
+        self.assertEqual(self.plan(self.history(40), last_gap_seconds=3600), {0: None, 15: None})
+        # A prefix primed while the user was typing makes it warm again
+        self.assertIn(39, self.plan(self.history(40), last_gap_seconds=3600, primed_at=self.now - timedelta(seconds=30)))
+
+    def test_short_prefixes_are_not_marked(self):
+        history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}, {"role": "user", "content": "Bye"}]
+        self.assertEqual(self.plan(history), {})
+
+
+class RateLimiterTests(SimpleTestCase):
+    def test_token_bucket_refills_continuously(self):
+        bucket = rate_limiter._TokenBucket(600)
+        bucket.consume(600, now=bucket.updated_at)
+        start = bucket.updated_at
+        self.assertAlmostEqual(bucket.wait_time(100, start), 10.0) # 600 per minute = 10 per second
+        self.assertEqual(bucket.wait_time(100, start + 10.0), 0.0)
+        self.assertEqual(bucket.wait_time(5000, start + 60.0), 0.0) # Oversized requests need a full bucket only
+
+    def test_token_bucket_correction(self):
+        bucket = rate_limiter._TokenBucket(1000)
+        now = bucket.updated_at
+        bucket.consume(500, now)
+        bucket.adjust(-300, now) # Estimated 500, used 200
+        self.assertAlmostEqual(bucket.level, 800)
+        bucket.adjust(1000, now) # Under-estimated: paid back from future capacity
+        self.assertAlmostEqual(bucket.level, -200)
+
+    def test_release_corrects_with_input_tokens(self):
+        async def run():
+            limiter = rate_limiter._EndpointLimiter(None, 1000, None)
+            permit = await limiter.acquire(400)
+            limiter.release(permit, actual_tokens=100)
+            return limiter.token_bucket.level
+
+        self.assertAlmostEqual(asyncio.run(run()), 900, delta=1) # 1000 - 400 estimated + 300 refunded
+
+    def test_aimd_window(self):
+        async def run():
+            limiter = rate_limiter._EndpointLimiter(None, None, 8)
+            limiter.release(await limiter.acquire(1), throttled=True, retry_after=None)
+            halved = limiter.concurrency_limit
+            for _ in range(4): # About one window's worth of successes
+                limiter.release(await limiter.acquire(1))
+            return halved, limiter.concurrency_limit
+
+        halved, recovered = asyncio.run(run())
+        self.assertEqual(halved, 4.0)
+        self.assertGreater(recovered, 4.9)
+        self.assertLess(recovered, 5.1)
+
+    def test_aimd_window_bounds(self):
+        async def run():
+            limiter = rate_limiter._EndpointLimiter(None, None, 2)
+            for _ in range(5):
+                limiter.release(await limiter.acquire(1), throttled=True)
+            floor = limiter.concurrency_limit
+            for _ in range(50):
+                limiter.release(await limiter.acquire(1))
+            return floor, limiter.concurrency_limit
+
+        self.assertEqual(asyncio.run(run()), (rate_limiter.MIN_CONCURRENCY, 2.0))
+
+    def test_queue_positions_are_reported(self):
+        async def run():
+            limiter = rate_limiter._EndpointLimiter(None, None, 1)
+            positions = {"second": [], "third": []}
+
+            async def report(name):
+                async def on_queued(position):
+                    positions[name].append(position)
+                return on_queued
+
+            first = await limiter.acquire(1)
+            second = asyncio.ensure_future(limiter.acquire(1, await report("second")))
+            await asyncio.sleep(0)
+            third = asyncio.ensure_future(limiter.acquire(1, await report("third")))
+            await asyncio.sleep(0)
+            limiter.release(first)
+            second_permit = await second
+            await asyncio.sleep(0.01) # The third request moves up while the second runs
+            limiter.release(second_permit)
+            limiter.release(await third)
+            return positions
+
+        self.assertEqual(asyncio.run(run()), {"second": [1], "third": [2, 1]})
+
+
+class GenerationTimerTests(SimpleTestCase):
+    def test_summary(self):
+        clock = iter([0.0, 1.0, 1.1, 1.3, 1.6, 2.0, 3.0])
+        with mock.patch('chat.telemetry.time.monotonic', lambda: next(clock)):
+            timer = telemetry.GenerationTimer()
+            timer.on_metadata({"endpoint_id": 7, "queue_wait_ms": 250})
+            for _ in range(5):
+                timer.on_delta()
+            summary = timer.summary(output_tokens=20)
+        self.assertEqual(summary, {
+            'endpoint_used_id': 7,
+            'queue_wait_ms': 250,
+            'time_to_first_token_ms': 1000,
+            'inter_token_p50_ms': 200, # Gaps of 100, 200, 300 and 400 ms
+            'inter_token_p95_ms': 400,
+            'inter_token_p99_ms': 400,
+            'total_duration_ms': 3000,
+            'output_tokens_per_second': 10.0, # 20 tokens over the 2 s after the first one
+        })
+
+    def test_summary_without_text(self):
+        summary = telemetry.GenerationTimer().summary(output_tokens=None)
+        self.assertIsNone(summary['time_to_first_token_ms'])
+        self.assertIsNone(summary['inter_token_p50_ms'])
+        self.assertIsNone(summary['output_tokens_per_second'])
+
+
+@override_settings(NEURONEKO_ROUTING_SPREAD=0)
+class EndpointRoutingTests(TransactionTestCase):
+    FAST = {"ttft_ms": 0, "tokens_per_second": 10000, "output_tokens": 5, "jitter": 0}
+
+    def setUp(self):
+        endpoint_router._stats.clear()
+        resilience._breakers.clear()
+        self.user = User.objects.create_user("routing")
+
+    def create_model(self, name, options=None, input_price=None):
+        endpoint = AIEndpoint.objects.create(user=self.user, name=name, provider='fake', apikey='fake', options={**self.FAST, **(options or {})})
+        return AIModel.objects.create(name=name, model_id='fake-standard', endpoint=endpoint, input_cost_per_million_tokens=input_price)
+
+    def test_rank_by_ttft_and_error_rate(self):
+        slow, fast, flaky, unmeasured = (self.create_model(name) for name in ("slow", "fast", "flaky", "unmeasured"))
+        endpoint_router.record_result(slow.endpoint, ttft=2.0)
+        endpoint_router.record_result(fast.endpoint, ttft=0.5)
+        endpoint_router.record_result(flaky.endpoint, ttft=0.4)
+        endpoint_router.record_result(flaky.endpoint, error=True)
+        ranked = endpoint_router.rank([slow, flaky, unmeasured, fast])
+        # The flaky endpoint's lowest TTFT does not make up for its errors; unmeasured ones score like the best known TTFT
+        self.assertEqual(ranked, [unmeasured, fast, flaky, slow])
+
+    def test_failover_before_delivery_prices_with_the_serving_model(self):
+        primary = self.create_model("primary", {"error_rate": 1.0}, input_price=1)
+        backup = self.create_model("backup", input_price=3)
+        endpoint_router.record_result(primary.endpoint, ttft=0.01) # Tried first
+        endpoint_router.record_result(backup.endpoint, ttft=1.0)
+        chat = Chat.objects.create(user=self.user, title="Failover", ai_model_used=primary)
+        assistant_msg = Message.objects.create(chat=chat, role='assistant', message="")
+        consumer = StreamingChatConsumer()
+        sent = []
+
+        async def send_to_client(payload):
+            sent.append(payload)
+
+        consumer.send_to_client = send_to_client
+        asyncio.run(consumer._stream_into_message(primary, [{"role": "user", "content": "Hi"}], assistant_msg, 1.0, 10))
+        assistant_msg.refresh_from_db()
+        self.assertEqual(len(assistant_msg.message.split()), 5)
+        self.assertEqual(assistant_msg.endpoint_used_id, backup.endpoint.id)
+        self.assertEqual(assistant_msg.ai_model_id, backup.id)
+        self.assertFalse([payload for payload in sent if payload['type'] == 'stream_error']) # The 429 never reached the client
@@ -0,0 +1,156 @@
+# chat/timeouts.py
+"""
+Per-model timeout budgets for provider requests.
+
+Each AIModel can bound four phases of a request (blank fields fall back to the
+NEURONEKO_TIMEOUT_* settings; 0 or None disables a budget):
+
+- connect:      establishing the connection to the provider. httpx enforces it, through
+                the request hook installed on the pooled clients (see provider_clients.py).
+- first_token:  from sending the request until the first text arrives.
+- idle:         the longest gap between stream chunks once text is flowing. Off by default.
+- total:        the whole attempt. Off by default.
+
+Budgets apply per attempt, so a retry or failover starts with fresh budgets. When one runs
+out, the attempt is cancelled, which closes the upstream stream, and a retryable error
+carrying "timeout": <kind> takes its place. The usual retry, failover and breaker logic in
+api_client.py then handles it like any other transient error. A timeout after text has
+reached the client ends the stream like a cancel: the text so far is kept.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from django.conf import settings
+
+from . import provider_clients
+
+TIMEOUT_KINDS = ('connect', 'first_token', 'idle', 'total')
+
+DEFAULT_BUDGETS = {
+    'connect': 10.0,
+    'first_token': 120.0,
+    # Off unless a model opts in: a slow but healthy stream must not be cut off part way
+    'idle': None,
+    'total': None,
+}
+
+TIMEOUT_DESCRIPTIONS = {
+    'connect': "Could not connect to the provider within {seconds:g}s.",
+    'first_token': "No response from the model within {seconds:g}s (first-token timeout).",
+    'idle': "The stream stalled for more than {seconds:g}s (idle timeout).",
+    'total': "The generation exceeded its {seconds:g}s time budget (total timeout).",
+}
+
+
+def budgets(model) -> Dict[str, Optional[float]]:
+    """The model's budgets in seconds, by kind. None means unbounded."""
+    result = {}
+    for kind in TIMEOUT_KINDS:
+        value = getattr(model, f"{kind}_timeout", None)
+        if value is None:
+            value = getattr(settings, f"NEURONEKO_TIMEOUT_{kind.upper()}", DEFAULT_BUDGETS[kind])
+        result[kind] = float(value) if value else None
+    return result
+
+
+def timeout_error(kind: str, seconds: Optional[float]) -> Dict[str, Any]:
+    """The error fields for a timeout of the given kind, merged into error chunks and static error payloads."""
+    return {
+        "message": TIMEOUT_DESCRIPTIONS[kind].format(seconds=seconds or 0),
+        "status_code": None,
+        "retryable": True,
+        "retry_after": None,
+        "timeout": kind,
+    }
+
+
+def _next_deadline(limits: Dict[str, Optional[float]], state: Dict[str, Optional[float]]):
+    """The (deadline, kind) that expires first in the attempt's current phase, or (None, None)."""
+    candidates = []
+    if limits['total']:
+        candidates.append((state['started_at'] + limits['total'], 'total'))
+    if state['first_token_at'] is None:
+        if limits['first_token']:
+            candidates.append((state['started_at'] + limits['first_token'], 'first_token'))
+    elif limits['idle']:
+        candidates.append((state['last_chunk_at'] + limits['idle'], 'idle'))
+    return min(candidates) if candidates else (None, None)
+
+
+async def _cancel_and_wait(task: asyncio.Task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"Provider attempt raised while being cancelled: {type(e).__name__} {e}")
+
+
+async def run_stream_attempt(
+    model,
+    dispatch: Callable[[Callable[[Dict[str, Any]], Awaitable[None]]], Awaitable[None]],
+    on_chunk_callback: Callable[[Dict[str, Any]], Awaitable[None]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Runs one streaming attempt under the model's budgets.
+    Args:
+        model: The AIModel instance (for its budgets).
+        dispatch: Starts the attempt; called with the chunk callback to use.
+        on_chunk_callback: Receives the attempt's chunks.
+    Returns:
+        The timeout error fields if a budget ran out (the attempt has been cancelled), else None.
+    """
+    limits = budgets(model)
+    now = time.monotonic()
+    state = {'started_at': now, 'last_chunk_at': now, 'first_token_at': None}
+
+    async def watched_callback(chunk):
+        state['last_chunk_at'] = time.monotonic()
+        if state['first_token_at'] is None and chunk.get("type") in ("delta", "stop"):
+            state['first_token_at'] = state['last_chunk_at']
+        await on_chunk_callback(chunk)
+
+    # The attempt task copies the current context, so the connect budget reaches the httpx hook
+    token = provider_clients.connect_timeout.set(limits['connect'])
+    try:
+        task = asyncio.ensure_future(dispatch(watched_callback))
+    finally:
+        provider_clients.connect_timeout.reset(token)
+
+    try:
+        while True:
+            deadline, kind = _next_deadline(limits, state)
+            done, _ = await asyncio.wait({task}, timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if done:
+                task.result() # Re-raises what the attempt raised
+                return None
+            # The deadline may have moved while waiting (a chunk arrived); only act on a real expiry
+            deadline, kind = _next_deadline(limits, state)
+            if deadline is not None and time.monotonic() >= deadline:
+                await _cancel_and_wait(task)
+                print(f"Stream attempt for model {model.model_id} hit its {kind} timeout ({limits[kind]:g}s).")
+                return timeout_error(kind, limits[kind])
+    except asyncio.CancelledError:
+        # The caller was cancelled (user cancel, disconnect): stop the attempt too
+        await _cancel_and_wait(task)
+        raise
+
+
+async def run_static_attempt(model, dispatch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Runs one static completion attempt under the model's connect and total budgets.
+    Returns:
+        The attempt's response, or a standardized error response if the total budget ran out.
+    """
+    limits = budgets(model)
+    token = provider_clients.connect_timeout.set(limits['connect'])
+    try:
+        return await asyncio.wait_for(dispatch(), timeout=limits['total'])
+    except asyncio.TimeoutError:
+        print(f"Static completion for model {model.model_id} hit its total timeout ({limits['total']:g}s).")
+        return {"id": None, "content": None, "role": "error", "model_used": model.model_id, "stop_reason": "error", "usage": None,
+                "error": {"type": "TimeoutError", **timeout_error('total', limits['total'])}}
+    finally:
+        provider_clients.connect_timeout.reset(token)
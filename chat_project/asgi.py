@@ -21,9 +21,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
 django_asgi_app = get_asgi_application()
 
 import chat.routing
+from chat.lifespan import lifespan_app
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    "lifespan": lifespan_app,
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(
@@ -147,3 +147,115 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels.layers.InMemoryChannelLayer'
     }
 }
+
+# Provider clients (chat/provider_clients.py)
+# One warm, pooled set of HTTP/SDK clients is kept per AIEndpoint and API key.
+NEURONEKO_PROVIDER_MAX_CONNECTIONS = 100
+NEURONEKO_PROVIDER_MAX_KEEPALIVE_CONNECTIONS = 20
+NEURONEKO_PROVIDER_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept open
+NEURONEKO_PROVIDER_CONNECT_TIMEOUT = 10.0
+NEURONEKO_PROVIDER_READ_TIMEOUT = 600.0
+NEURONEKO_PROVIDER_HTTP2 = False  # Requires the optional 'h2' package (pip install httpx[http2])
+# TLS certificate verification for every provider client. Only turn this off for a
+# local or proxied endpoint with a self-signed certificate.
+NEURONEKO_PROVIDER_SSL_VERIFY = True
+
+# Streaming engine for stream_completion: 'sdk' (provider SDK event objects) or
+# 'raw_sse' (parse the provider's SSE stream directly; Anthropic and OpenAI only).
+NEURONEKO_STREAM_ENGINE = 'sdk'
+
+# Retries and circuit breaking for provider calls (chat/resilience.py)
+NEURONEKO_RETRY_MAX_RETRIES = 2  # retries before the first token reaches the client
+NEURONEKO_RETRY_BASE_DELAY = 0.5  # seconds; exponential backoff with full jitter
+NEURONEKO_RETRY_MAX_DELAY = 8.0
+NEURONEKO_RETRY_MAX_RETRY_AFTER = 30.0  # give up instead of honouring longer retry-after values
+NEURONEKO_CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive upstream failures before an endpoint's circuit opens
+NEURONEKO_CIRCUIT_RECOVERY_TIMEOUT = 30.0  # seconds before a trial request is let through
+
+# Latency-aware routing across endpoints that serve the same model_id (chat/endpoint_router.py)
+NEURONEKO_ENDPOINT_ROUTING = True
+NEURONEKO_ROUTING_SPREAD = 0.25  # random spread applied to scores so near-equal endpoints share load
+
+# Per-endpoint client-side rate limiting (chat/rate_limiter.py); AIEndpoint fields override these
+NEURONEKO_RATE_LIMIT_RPM = None  # requests per minute, None = unlimited
+NEURONEKO_RATE_LIMIT_TPM = None  # input tokens per minute, None = unlimited
+NEURONEKO_RATE_LIMIT_MAX_CONCURRENCY = 8  # AIMD concurrency ceiling, None = unlimited
+
+# Opt-in static completion cache (chat/completion_cache.py), used with get_static_completion(use_cache=True)
+NEURONEKO_COMPLETION_CACHE_MAX_ENTRIES = 512
+NEURONEKO_COMPLETION_CACHE_TTL = 3600  # seconds
+NEURONEKO_COMPLETION_CACHE_DIR = None  # e.g. BASE_DIR / 'completion_cache' to persist entries across restarts
+
+# Provider model listings are cached per endpoint for this many seconds (chat/model_catalog.py)
+NEURONEKO_MODEL_CATALOG_TTL = 600
+
+# Background endpoint health prober (chat/health.py)
+NEURONEKO_HEALTH_PROBE_ENABLED = True
+NEURONEKO_HEALTH_PROBE_INTERVAL = 60.0  # seconds between probe rounds
+NEURONEKO_HEALTH_PROBE_TIMEOUT = 10.0
+NEURONEKO_HEALTH_HISTORY_SIZE = 30  # probes kept per endpoint for latency/error-rate history
+
+# Pre-open the chat model's provider connection when a chat websocket connects or its model
+# is switched (chat/prewarm.py), and refresh it every interval while the socket is open.
+# Keep the interval below NEURONEKO_PROVIDER_KEEPALIVE_EXPIRY so the connection is not dropped.
+NEURONEKO_PREWARM_CONNECTIONS = True
+NEURONEKO_PREWARM_INTERVAL = 60.0
+
+# Frames buffered between the provider stream reader and the websocket writer (chat/stream_relay.py)
+NEURONEKO_STREAM_RELAY_MAX_PENDING = 256
+
+# Upper bound on the samples a single 'generate_samples' request may stream at once
+NEURONEKO_MAX_SAMPLES = 4
+# Upper bound on the models a single 'start_fan_out_generation' request may query at once
+NEURONEKO_MAX_FAN_OUT_MODELS = 4
+# Seconds a disconnect waits for a cancelled generation to save its partial content
+NEURONEKO_CANCEL_CLEANUP_TIMEOUT = 5.0
+# Generations run detached from the websocket that started them (chat/generation_registry.py):
+# a reconnecting client reattaches and replays missed frames from its last offset.
+NEURONEKO_GENERATION_DETACHED = True  # False: cancel on disconnect when no other socket is attached
+NEURONEKO_GENERATION_BUFFER_FRAMES = 2048  # frames kept per generation for replay
+NEURONEKO_GENERATION_RETENTION = 60.0  # seconds a finished generation stays available for replay
+# Default timeout budgets per generation attempt, in seconds (chat/timeouts.py). AIModel fields
+# override them per model; 0 or None disables a budget. A timeout is a retryable error.
+NEURONEKO_TIMEOUT_CONNECT = 10.0
+NEURONEKO_TIMEOUT_FIRST_TOKEN = 120.0
+NEURONEKO_TIMEOUT_IDLE = None  # opt in per model
+NEURONEKO_TIMEOUT_TOTAL = None  # opt in per model
+
+# Provider batch APIs for bulk offline jobs (chat/batch.py, manage.py run_batch_jobs)
+NEURONEKO_BATCH_PRICE_FACTOR = 0.5  # batch requests are billed at this fraction of the model's prices
+NEURONEKO_BATCH_POLL_INTERVAL = 60  # seconds between polls with run_batch_jobs --wait
+# Per-provider base URL overrides for batch calls, e.g. the local stand-in:
+# {'anthropic': 'http://127.0.0.1:8765', 'openai': 'http://127.0.0.1:8765/v1'}
+NEURONEKO_BATCH_BASE_URLS = {}
+
+# Baseline options for 'fake' provider endpoints (chat/fake_provider.py); per-endpoint options override these
+NEURONEKO_FAKE_PROVIDER_DEFAULTS = {}
+
+# Record/replay of provider streams (chat/cassettes.py)
+NEURONEKO_CASSETTE_RECORD_DIR = None  # set to a directory to record every real provider stream
+NEURONEKO_CASSETTE_DIR = None  # cassettes played back by 'replay' endpoints (per-endpoint "cassette_dir" option overrides)
+NEURONEKO_CASSETTE_REPLAY_SPEED = 1.0  # timing divisor; 0 replays without delays
+
+# Automatic Anthropic prompt-cache breakpoints on the stable prefix (chat/prompt_cache.py)
+NEURONEKO_PROMPT_CACHE_AUTO = True
+NEURONEKO_PROMPT_CACHE_STABLE_TTL = None  # "1h" for the system prompt/anchor breakpoints (costs 2x to write instead of 1.25x)
+# Opt-in: prime the cache for the saved prefix while the user types (chat/cache_prewarm.py).
+# Each priming is a cache write plus one output token; at most one per chat per interval (seconds).
+NEURONEKO_PROMPT_CACHE_PREWARM = False
+NEURONEKO_PROMPT_CACHE_PREWARM_INTERVAL = 30.0
+
+# Google context caching of long chat prefixes (chat/google_cache.py)
+NEURONEKO_GOOGLE_CACHE_ENABLED = True
+NEURONEKO_GOOGLE_CACHE_MIN_TOKENS = 4096  # estimated prefix size below which no cache is created (model minimums apply)
+NEURONEKO_GOOGLE_CACHE_REBUILD_TOKENS = 8192  # uncached suffix size that triggers caching a longer prefix
+NEURONEKO_GOOGLE_CACHE_TTL = 600  # seconds; extended while the cache is in use
+NEURONEKO_GOOGLE_CACHE_MAX_PER_CHAT = 2  # handles kept per chat (branches); least recently used are deleted
+
+# Chain OpenAI turns through stored Responses API responses instead of resending history
+# (per endpoint: options {"chain_responses": true})
+NEURONEKO_OPENAI_CHAIN_RESPONSES = False
+
+# Default token counting for 'openai_compatible' endpoints without a tokenizer of their own:
+# "server", "hf:<repo>", "tiktoken:<encoding>" or "chars" (see chat/utils.py)
+NEURONEKO_OPENAI_COMPATIBLE_TOKENIZER = "tiktoken:o200k_base"